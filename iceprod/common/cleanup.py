@@ -0,0 +1,216 @@
+"""
+Async filesystem cleanup.
+
+Scan and delete directory trees in a thread pool, so large or slow
+filesystems do not block the event loop.
+"""
+import asyncio
+import logging
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, NamedTuple
+
+from wipac_dev_tools.prometheus_tools import GlobalLabels, PromWrapper
+
+from iceprod.common.prom_utils import HistogramBuckets
+
+logger = logging.getLogger('cleanup')
+
+
+class ScanEntry(NamedTuple):
+    """A directory entry, with its lstat result"""
+    path: Path
+    stat: os.stat_result
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.stat.st_mode)
+
+
+def scandir(path: str | Path) -> list[ScanEntry]:
+    """
+    List a directory, with lstat results.  This is blocking.
+
+    Args:
+        path: directory to list
+
+    Returns:
+        list of ScanEntry
+    """
+    ret = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                ret.append(ScanEntry(Path(entry.path), entry.stat(follow_symlinks=False)))
+            except FileNotFoundError:
+                continue
+    return ret
+
+
+def rmtree(path: str | Path) -> tuple[int, int]:
+    """
+    Delete a file or directory tree, without following symlinks.  This is blocking.
+
+    Args:
+        path: path to delete
+
+    Returns:
+        tuple: (entries removed, bytes freed)
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0, 0
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+        return 1, st.st_size
+
+    entries = 0
+    size = 0
+    with os.scandir(path) as it:
+        children = list(it)
+    for entry in children:
+        if entry.is_dir(follow_symlinks=False):
+            e, s = rmtree(entry.path)
+        else:
+            try:
+                s = entry.stat(follow_symlinks=False).st_size
+                os.unlink(entry.path)
+                e = 1
+            except FileNotFoundError:
+                e, s = 0, 0
+        entries += e
+        size += s
+    os.rmdir(path)
+    return entries + 1, size
+
+
+@dataclass
+class CleanupStats:
+    """Stats for a cleanup cycle"""
+    scanned: int = 0
+    removed: int = 0
+    bytes_freed: int = 0
+    errors: int = 0
+    duration: float = 0.
+    complete: bool = True
+
+
+class AsyncCleaner:
+    """
+    Scan and delete directory trees off the event loop.
+
+    Deletions run in parallel in a thread pool, up to `max_workers` at a
+    time.  Each cleanup cycle can have a time budget.  Once the budget
+    runs out, scans return None and deletions are skipped, leaving
+    the rest for the next cycle.
+
+    Example::
+
+        async with cleaner.cycle() as stats, asyncio.TaskGroup() as tg:
+            for entry in await cleaner.scandir(path) or []:
+                if entry.stat.st_mtime < old_time:
+                    tg.create_task(cleaner.rmtree(entry.path))
+        logger.info('freed %d bytes', stats.bytes_freed)
+
+    Args:
+        max_workers: max parallel scans and deletions
+        time_budget: max seconds per cycle (None for unlimited)
+        prometheus: global labels for metrics
+    """
+    def __init__(self, max_workers: int = 8, time_budget: float | None = None, prometheus: GlobalLabels | None = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cleanup')
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.time_budget = time_budget
+        self.prometheus = prometheus if prometheus else GlobalLabels({'type': 'cleanup'})
+        self.stats = CleanupStats()
+        self._start = time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        """Has the time budget for this cycle run out?"""
+        if self.time_budget is None or time.monotonic() - self._start < self.time_budget:
+            return False
+        self.stats.complete = False
+        return True
+
+    @asynccontextmanager
+    async def cycle(self) -> AsyncIterator[CleanupStats]:
+        """
+        Run a cleanup cycle, resetting the stats and time budget.
+        """
+        self.stats = CleanupStats()
+        self._start = time.monotonic()
+        try:
+            yield self.stats
+        finally:
+            self._finish_cycle()
+
+    @PromWrapper(lambda self: self.prometheus.histogram('iceprod_cleanup_cycle_seconds', 'Filesystem cleanup cycle time', buckets=HistogramBuckets.TENMINUTE))
+    def _finish_cycle(self, prom_histogram):
+        self.stats.duration = time.monotonic() - self._start
+        prom_histogram.observe(self.stats.duration)
+        logger.info('cleanup cycle: %r', self.stats)
+
+    @PromWrapper(lambda self: self.prometheus.counter('iceprod_cleanup_entries_scanned', 'Filesystem cleanup entries scanned'))
+    def _scanned(self, prom_counter, entries: int):
+        self.stats.scanned += entries
+        prom_counter.inc(entries)
+
+    @PromWrapper(lambda self: self.prometheus.counter('iceprod_cleanup_bytes_freed', 'Filesystem cleanup bytes freed'))
+    def _removed(self, prom_counter, entries: int, size: int):
+        self.stats.removed += entries
+        self.stats.bytes_freed += size
+        prom_counter.inc(size)
+
+    async def scandir(self, path: str | Path) -> list[ScanEntry] | None:
+        """
+        List a directory, with lstat results.
+
+        Returns None if the time budget has run out, so callers can tell
+        a skipped scan from an empty directory.
+
+        Args:
+            path: directory to list
+
+        Returns:
+            list of ScanEntry, or None if skipped
+        """
+        if self.expired:
+            return None
+        async with self.semaphore:
+            ret = await asyncio.get_running_loop().run_in_executor(self.executor, scandir, path)
+        self._scanned(len(ret))
+        return ret
+
+    async def rmtree(self, path: str | Path) -> bool:
+        """
+        Delete a file or directory tree.
+
+        Errors are logged, not raised.
+
+        Args:
+            path: path to delete
+
+        Returns:
+            bool: True if deleted, False if skipped or failed
+        """
+        if self.expired:
+            return False
+        async with self.semaphore:
+            if self.expired:
+                return False
+            try:
+                entries, size = await asyncio.get_running_loop().run_in_executor(self.executor, rmtree, path)
+            except OSError:
+                logger.warning('failed to delete %s', path, exc_info=True)
+                self.stats.errors += 1
+                return False
+        self._scanned(entries)
+        self._removed(entries, size)
+        return True
@@ -6,9 +6,12 @@ from dataclasses import KW_ONLY, asdict, dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Any, AsyncIterator, Literal
 
-from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+from wipac_dev_tools.prometheus_tools import AsyncPromWrapper, GlobalLabels, PromWrapper
 
 from .mongo import CollectionIndexes, Mongo
+from .prom_utils import HistogramBuckets
 
 type Payload = dict[str, Any]
 
@@ -17,6 +20,18 @@ class FailMessage(Exception):
     pass
 
 
+def _utc(dt: datetime) -> datetime:
+    """Mongo returns naive datetimes in UTC"""
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def _age(dt: datetime, now: datetime | None = None) -> float:
+    """Get the age of a datetime in seconds."""
+    if not now:
+        now = datetime.now(timezone.utc)
+    return (_utc(now) - _utc(dt)).total_seconds()
+
+
 @dataclass
 class Message:
     """Mongo Queue Message"""
@@ -44,8 +59,12 @@ class AsyncMongoQueue:
         worker_id: unique id for consumer / worker
         deadline: number of days messages should remain on the queue in any state
         extra_indexes: payload indexes to apply
+        notify: wake up consumers on new messages instead of only polling
         **mongo_args: any extra args to Mongo, such as write concern or timeout
     """
+    #: how often to update the queue depth metrics, in seconds
+    MONITOR_INTERVAL = 60
+
     def __init__(
         self,
         *,
@@ -54,6 +73,7 @@ class AsyncMongoQueue:
         worker_id: str | None = None,
         deadline: float = 1.0,
         extra_indexes: CollectionIndexes | None = None,
+        notify: bool = False,
         **mongo_args
     ):
         self.client = Mongo(url=url, **mongo_args)
@@ -62,10 +82,84 @@ class AsyncMongoQueue:
         self.worker_id = worker_id or uuid.uuid4().hex
         self.deadline = deadline
         self.extra_indexes = extra_indexes
+        self.notify = notify
+        self.change_streams_enabled = False
+        self._notify_event = asyncio.Event()
+        self._watch_task: asyncio.Task | None = None
+        self.prometheus = GlobalLabels()
 
     async def close(self):
+        await self.stop_notifications()
         await self.client.close()
 
+    async def start_notifications(self):
+        """
+        Start listening for new messages.
+
+        Uses a change stream if the server supports it (replica sets),
+        otherwise only pushes from this process will wake up consumers.
+        """
+        if self.notify and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_notifications(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self._watch_task = None
+
+    async def _watch(self):
+        """Watch the collection for new or released messages."""
+        pipeline = [{'$match': {'$or': [
+            {'operationType': 'insert'},
+            {'operationType': 'update', 'updateDescription.updatedFields.status': 'queued'},
+        ]}}]
+        while True:
+            try:
+                async with await self.collection.watch(pipeline) as stream:
+                    self.change_streams_enabled = True
+                    async for _ in stream:
+                        self._notify_event.set()
+            except OperationFailure:
+                logging.info('mongo_queue: change streams not available, using local notifications', exc_info=True)
+                self.change_streams_enabled = False
+                return
+            except Exception:
+                logging.info('mongo_queue: change stream failed, restarting', exc_info=True)
+                self.change_streams_enabled = False
+                await asyncio.sleep(1)
+
+    def _notify(self):
+        if self.notify:
+            self._notify_event.set()
+
+    async def wait_for_message(self, timeout: float) -> bool:
+        """
+        Wait for a new message to be pushed, or the timeout to expire.
+
+        A wakeup does not guarantee that a message is available to `pop`,
+        as another consumer may have already claimed it.
+
+        Args:
+            timeout: max time to wait, in seconds
+
+        Returns:
+            True if woken up by a notification, False on timeout
+        """
+        if not self.notify:
+            await asyncio.sleep(timeout)
+            return False
+        try:
+            await asyncio.wait_for(self._notify_event.wait(), timeout=timeout)
+        except TimeoutError:
+            return False
+        self._notify_event.clear()
+        return True
+
     async def setup(self):
         """Initializes indexes for performance and priority fetching."""
         await self.client.ping()
@@ -91,6 +185,7 @@ class AsyncMongoQueue:
             indexes[self.collection_name].update(self.extra_indexes)
         await self.client.create_indexes(indexes=indexes)
         asyncio.create_task(self.clean_task())
+        asyncio.create_task(self.monitor_task())
 
     async def push(self, payload: Payload, priority: int = 0) -> str:
         """
@@ -111,6 +206,7 @@ class AsyncMongoQueue:
             created_at=datetime.now(timezone.utc),
         )
         await self.collection.insert_one(asdict(message))
+        self._notify()
         return message.uuid
 
     async def push_if_not_exists(self, payload: Payload, filter_payload: Payload | None = None, priority: int = 0) -> str:
@@ -149,8 +245,68 @@ class AsyncMongoQueue:
         )
         if not ret:
             raise Exception('failed to push')
+        self._notify()
         return ret['uuid']
 
+    async def push_many(self, payloads: list[Payload], filter_keys: list[str] | None = None, priority: int = 0) -> list[str | None]:
+        """
+        Adds many new messages to the queue with a single unordered bulk write.
+
+        If `filter_keys` is given, deduplicates on those payload keys the
+        same way as `push_if_not_exists`, both against existing queued or
+        processing messages and within `payloads`.
+
+        Args:
+            payloads: list of message data
+            filter_keys: payload keys to filter on for deduplication (if None, no deduplication)
+            priority: priority of the messages (higher is better)
+
+        Returns:
+            list of Message ids for inserted messages, None for duplicates
+        """
+        now = datetime.now(timezone.utc)
+        ret: list[str | None] = [None] * len(payloads)
+        ops: list[InsertOne | UpdateOne] = []
+        op_index: list[int] = []
+        seen = set()
+        for i, payload in enumerate(payloads):
+            message = Message(
+                uuid=uuid.uuid4().hex,
+                payload=payload,
+                status='queued',
+                priority=priority,
+                created_at=now,
+            )
+            if filter_keys is None:
+                ops.append(InsertOne(asdict(message)))
+            else:
+                key = tuple(repr(payload.get(name)) for name in filter_keys)
+                if key in seen:
+                    continue
+                seen.add(key)
+                query = {
+                    f'payload.{name}': payload.get(name) for name in filter_keys
+                }
+                query['status'] = {'$in': ['queued', 'processing']}
+                ops.append(UpdateOne(query, {'$setOnInsert': asdict(message)}, upsert=True))
+            op_index.append(i)
+            ret[i] = message.uuid
+
+        if not ops:
+            return ret
+
+        result = await self.collection.bulk_write(ops, ordered=False)
+        if filter_keys is not None:
+            # only upserted operations actually inserted a message
+            inserted = set(result.upserted_ids or {})
+            for j, i in enumerate(op_index):
+                if j not in inserted:
+                    ret[i] = None
+
+        if any(ret):
+            self._notify()
+        return ret
+
     async def get_status(self, message_id: str) -> None | str:
         """Get the status if a message exists"""
         ret = await self.collection.find_one(
@@ -209,11 +365,21 @@ class AsyncMongoQueue:
         ret = await self.collection.count_documents(query, maxTimeMS=1000)
         return ret
 
-    async def pop(self, timeout_seconds: float = 300.) -> Message | None:
-        """Atomically grabs the next available message (or an abandoned timed-out one)."""
+    async def pop(self, timeout_seconds: float = 300., query: dict[str, Any] | None = None) -> Message | None:
+        """
+        Atomically grabs the next available message (or an abandoned timed-out one).
+
+        Args:
+            timeout_seconds: processing time after which a message can be re-claimed
+            query: extra filter on messages, using mongo `.` notation
+
+        Returns:
+            Message, or None if nothing is available
+        """
         timeout_cutoff = datetime.now(timezone.utc) - timedelta(seconds=timeout_seconds)
 
         query = {
+            **(query or {}),
             '$or': [
                 {'status': 'queued'},
                 {'status': 'processing', 'locked_at': {'$lt': timeout_cutoff}}
@@ -239,6 +405,67 @@ class AsyncMongoQueue:
         )
         if ret:
             ret = Message(**ret)
+            self._observe_pop(ret)
+        return ret
+
+    async def pop_many(self, n: int, timeout_seconds: float = 300., query: dict[str, Any] | None = None) -> list[Message]:
+        """
+        Grabs up to `n` available messages (or abandoned timed-out ones).
+
+        Uses the same ordering and timeout semantics as `pop`, but claims
+        the whole batch with a single sorted scan and a single update.
+        Messages claimed by another worker between the scan and the update
+        are skipped, so fewer than `n` messages may be returned.
+
+        Args:
+            n: max number of messages to claim
+            timeout_seconds: processing time after which a message can be re-claimed
+            query: extra filter on messages, using mongo `.` notation
+
+        Returns:
+            list of Messages, in queue order
+        """
+        if n < 1:
+            return []
+        now = datetime.now(timezone.utc)
+        timeout_cutoff = now - timedelta(seconds=timeout_seconds)
+
+        query = {
+            **(query or {}),
+            '$or': [
+                {'status': 'queued'},
+                {'status': 'processing', 'locked_at': {'$lt': timeout_cutoff}}
+            ]
+        }
+        sort = [('priority', DESCENDING), ('attempts', ASCENDING), ('created_at', ASCENDING)]
+
+        candidates = [row['uuid'] async for row in self.collection.find(query, projection={'_id': False, 'uuid': True}, sort=sort, limit=n)]
+        if not candidates:
+            return []
+
+        # claim all candidates that are still available
+        query['uuid'] = {'$in': candidates}
+        update = {
+            '$set': {
+                'status': 'processing',
+                'locked_at': now,
+                'worker_id': self.worker_id
+            },
+            '$inc': {'attempts': 1},
+        }
+        await self.collection.update_many(query, update)
+
+        ret = []
+        claimed_query = {
+            'uuid': {'$in': candidates},
+            'status': 'processing',
+            'locked_at': now,
+            'worker_id': self.worker_id,
+        }
+        async for row in self.collection.find(claimed_query, projection={'_id': False}, sort=sort):
+            message = Message(**row)
+            self._observe_pop(message)
+            ret.append(message)
         return ret
 
     async def update_payload(self, message_id: str, payload: Payload):
@@ -251,29 +478,32 @@ class AsyncMongoQueue:
             {'$set': update}
         )
 
-    async def complete(self, message_id: str):
-        """Acknowledges and sets the state to 'completed' upon successful processing."""
-        await self.collection.update_one(
+    async def _finish(self, message_id: str, update: dict[str, Any], outcome: str):
+        """Update a processing message, observing the processing duration."""
+        ret = await self.collection.find_one_and_update(
             {'uuid': message_id},
-            {'$set': {'status': 'complete'}}
+            {'$set': update},
+            projection={'_id': False, 'status': True, 'locked_at': True},
+            return_document=ReturnDocument.BEFORE,
         )
+        if ret and ret['status'] == 'processing' and ret.get('locked_at'):
+            self._observe_processing(_age(ret['locked_at']), outcome)
+
+    async def complete(self, message_id: str):
+        """Acknowledges and sets the state to 'completed' upon successful processing."""
+        await self._finish(message_id, {'status': 'complete'}, 'complete')
 
     async def release(self, message_id: str):
         """Re-releases the message back to 'queued' state."""
-        await self.collection.update_one(
-            {'uuid': message_id},
-            {'$set': {'status': 'queued', 'locked_at': None, 'worker_id': None}}
-        )
+        await self._finish(message_id, {'status': 'queued', 'locked_at': None, 'worker_id': None}, 'release')
+        self._notify()
 
     async def fail(self, message_id: str, error_message: str | None = None):
         """Acknowledges and sets the state to 'error' upon a failed processing."""
         data = {'status': 'error'}
         if error_message:
             data['error_message'] = error_message
-        await self.collection.update_one(
-            {'uuid': message_id},
-            {'$set': data}
-        )
+        await self._finish(message_id, data, 'error')
 
     @asynccontextmanager
     async def process_next(self, timeout_seconds=300) -> AsyncIterator[Payload | None]:
@@ -309,3 +539,51 @@ class AsyncMongoQueue:
 
             # make sure to run at least 10 times more often than the deadline interval
             await asyncio.sleep(self.deadline*8640)
+
+    # Metrics #
+
+    @PromWrapper(lambda self: self.prometheus.histogram('iceprod_mongo_queue_wait', 'IceProd mongo queue time from push to pop', labels=['queue'], finalize=False, buckets=HistogramBuckets.QUEUE))
+    @PromWrapper(lambda self: self.prometheus.counter('iceprod_mongo_queue_retries', 'IceProd mongo queue messages popped more than once', labels=['queue'], finalize=False))
+    def _observe_pop(self, prom_retries, prom_wait, message: Message):
+        labels = {'queue': self.collection_name}
+        if message.locked_at:
+            prom_wait.labels(labels).observe(max(0., _age(message.created_at, now=message.locked_at)))
+        if message.attempts > 1:
+            prom_retries.labels(labels).inc()
+
+    @PromWrapper(lambda self: self.prometheus.histogram('iceprod_mongo_queue_processing', 'IceProd mongo queue time from pop to completion', labels=['queue', 'outcome'], finalize=False, buckets=HistogramBuckets.QUEUE))
+    def _observe_processing(self, prom_histogram, duration: float, outcome: str):
+        prom_histogram.labels({'queue': self.collection_name, 'outcome': outcome}).observe(max(0., duration))
+
+    @AsyncPromWrapper(lambda self: self.prometheus.gauge('iceprod_mongo_queue_oldest_queued', 'IceProd mongo queue age of oldest queued message in seconds', labels=['queue'], finalize=False))
+    @AsyncPromWrapper(lambda self: self.prometheus.gauge('iceprod_mongo_queue_depth', 'IceProd mongo queue messages by status', labels=['queue', 'status'], finalize=False))
+    async def update_metrics(self, prom_depth, prom_oldest):
+        """Update the queue depth and age metrics."""
+        counts = {status: 0 for status in ('queued', 'processing', 'error', 'complete')}
+        cursor = await self.collection.aggregate([
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ])
+        async for row in cursor:
+            counts[row['_id']] = row['count']
+        for status, num in counts.items():
+            prom_depth.labels({'queue': self.collection_name, 'status': status}).set(num)
+
+        age = 0.
+        ret = await self.collection.find_one(
+            {'status': 'queued'},
+            projection={'_id': False, 'created_at': True},
+            sort=[('created_at', ASCENDING)],
+        )
+        if ret:
+            age = max(0., _age(ret['created_at']))
+        prom_oldest.labels({'queue': self.collection_name}).set(age)
+
+    async def monitor_task(self):
+        """Periodically update the metrics."""
+        while True:
+            try:
+                await self.update_metrics()
+            except Exception:
+                logging.info('mongo_queue.update_metrics failed', exc_info=True)
+
+            await asyncio.sleep(self.MONITOR_INTERVAL)
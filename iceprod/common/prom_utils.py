@@ -3,6 +3,7 @@ Some Prometheus utilities.
 """
 import asyncio
 import time
+from typing import Any
 
 from prometheus_client import Histogram
 from tornado.web import RequestHandler
@@ -35,9 +36,17 @@ class HistogramBuckets:
     #: Timer bucket up to 1 hour
     HOUR = [10, 60, 120, 300, 600, 1200, 1800, 2400, 3000, 3600]
 
+    #: Queue bucket from 10ms up to 1 hour
+    QUEUE = [.01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+
 
 class PromRequestMixin(RequestHandler):
     PromHTTPHistogram = Histogram('http_request_duration_seconds', 'HTTP request duration in seconds', labelnames=('method', 'handler', 'status'), buckets=HistogramBuckets.API)
+    PromCompressionRatio = Histogram('http_response_compression_ratio', 'HTTP response compressed size as a fraction of the original size', labelnames=('handler', 'encoding'), buckets=[.01, .02, .05, .1, .15, .2, .3, .4, .5, .75, 1])
+    PromCompressionTime = Histogram('http_response_compression_seconds', 'HTTP response compression CPU time in seconds', labelnames=('handler', 'encoding'), buckets=HistogramBuckets.SECOND)
+
+    #: response compressor with `encoding`, `raw_size`, `compressed_size`, and `cpu_time` attributes
+    prom_compression: Any = None
 
     def prepare(self):
         super().prepare()
@@ -46,14 +55,26 @@ class PromRequestMixin(RequestHandler):
     def on_finish(self):
         super().on_finish()
         end_time = time.monotonic()
+        handler = f'{self.__class__.__module__.split(".")[-1]}.{self.__class__.__name__}'
         self.PromHTTPHistogram.labels(
             method=str(self.request.method).lower(),
-            handler=f'{self.__class__.__module__.split(".")[-1]}.{self.__class__.__name__}',
+            handler=handler,
             status=str(self.get_status()),
         ).observe(end_time - self._prom_start_time)
+        c = self.prom_compression
+        if c and c.encoding and c.raw_size:
+            self.PromCompressionRatio.labels(handler=handler, encoding=c.encoding).observe(c.compressed_size / c.raw_size)
+            self.PromCompressionTime.labels(handler=handler, encoding=c.encoding).observe(c.cpu_time)
 
 
 class AsyncMonitor(GlobalLabels):
+    """
+    Monitor the asyncio event loop.
+
+    Records the number of running tasks, and the event loop lag: how
+    much later than requested the monitor wakes up from a sleep.  A
+    large lag means something is blocking the event loop.
+    """
     SLEEP_TIME = 5
 
     def __init__(self, *args, **kwargs):
@@ -74,8 +95,11 @@ class AsyncMonitor(GlobalLabels):
             finally:
                 self._task = None
 
-    @AsyncPromWrapper(lambda self: self.prometheus.gauge('asyncio_tasks_running', 'Python asyncio tasks active'))
-    async def _monitor(self, prom_gauge):
+    @AsyncPromWrapper(lambda self: self.gauge('asyncio_tasks_running', 'Python asyncio tasks active'))
+    @AsyncPromWrapper(lambda self: self.histogram('asyncio_loop_lag_seconds', 'Python asyncio event loop lag', buckets=HistogramBuckets.TENSECOND))
+    async def _monitor(self, prom_histogram, prom_gauge):
         while True:
             prom_gauge.set(len(asyncio.all_tasks()))
+            start = time.monotonic()
             await asyncio.sleep(self.SLEEP_TIME)
+            prom_histogram.observe(max(0., time.monotonic() - start - self.SLEEP_TIME))
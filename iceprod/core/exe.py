@@ -380,8 +380,9 @@ class WriteToScript:
         workdir: a directory to write the task and any related files
         options: extra dataset config options
         logger: a logger object, for localized logging
+        cfgparser: a config parser for the dataset, to reuse across tasks (optional)
     """
-    def __init__(self, task: config.Task, workdir: Path, options: Optional[dict] = None, logger: Optional[logging.Logger] = None):
+    def __init__(self, task: config.Task, workdir: Path, options: Optional[dict] = None, logger: Optional[logging.Logger] = None, cfgparser: Optional[ConfigParser] = None):
         self.task = task
         self.workdir = workdir
         self.logger = logger if logger else logging.getLogger()
@@ -391,7 +392,7 @@ class WriteToScript:
         self._fill_options()
         if options:
             self.options.update(options)
-        self.cfgparser = ConfigParser(self.task.dataset, logger=self.logger)
+        self.cfgparser = cfgparser if cfgparser else ConfigParser(self.task.dataset, logger=self.logger)
 
         # set up script
         self.infiles: set[Data] = set()
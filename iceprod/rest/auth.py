@@ -1,9 +1,12 @@
 import logging
+import time
 import uuid
 from functools import wraps
-from typing import Protocol
+from typing import Any, Protocol
 
 import pymongo
+from cachetools import TTLCache
+from prometheus_client import Counter, Histogram
 from rest_tools.server import (
     RestHandler,
     TokenAttributeRoleMappingProtocol,
@@ -13,16 +16,49 @@ from rest_tools.server import (
 from tornado.web import HTTPError
 
 from iceprod.common.mongo import AsyncDatabase
+from iceprod.common.prom_utils import HistogramBuckets
 from iceprod.roles_groups import GROUPS, ROLES
 
 logger = logging.getLogger('rest-auth')
 
 
+class AttrAuthCache:
+    """
+    A bounded TTL cache of attribute auth lookups.
+
+    Only found attributes are cached, so a newly created attribute is
+    visible immediately.  Local changes should call `invalidate`; changes
+    made by other processes are visible after at most `ttl` seconds.
+
+    Args:
+        maxsize: max number of attributes to cache
+        ttl: time to live for each attribute, in seconds
+    """
+    PromCacheCounter = Counter('iceprod_rest_attr_auth_cache', 'IceProd REST attr auth cache lookups', labelnames=('result',))
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.cache: TTLCache[tuple[str, str], dict[str, Any]] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, arg: str, val: str) -> dict[str, Any] | None:
+        ret = self.cache.get((arg, val), None)
+        self.PromCacheCounter.labels(result='hit' if ret is not None else 'miss').inc()
+        return ret
+
+    def set(self, arg: str, val: str, auths: dict[str, Any]):
+        self.cache[(arg, val)] = auths
+
+    def invalidate(self, arg: str, val: str):
+        self.cache.pop((arg, val), None)
+
+
 class AuthProtocol(Protocol):
     auth_db: AsyncDatabase
+    auth_cache: AttrAuthCache | None
 
 
 class AttrAuthMixin(TokenAttributeRoleMappingProtocol, AuthProtocol, RestHandler):
+    PromAttrAuthHistogram = Histogram('iceprod_rest_attr_auth_lookup_seconds', 'IceProd REST attr auth database lookup duration in seconds', buckets=HistogramBuckets.DB)
+
     async def add_user(self, username):
         """
         Add a user to the auth database.
@@ -77,6 +113,71 @@ class AttrAuthMixin(TokenAttributeRoleMappingProtocol, AuthProtocol, RestHandler
         )
         if ret is None:
             raise RuntimeError('failed to insert auth')
+        if self.auth_cache:
+            self.auth_cache.invalidate(arg, val)
+
+    async def get_attr_auth(self, arg, val):
+        """
+        Get the auth for an attribute, using the cache if available.
+
+        Args:
+            arg (str): attribute name to look up
+            val (str): attribute value
+
+        Returns:
+            dict: auths, or None if not found
+        """
+        if self.auth_cache:
+            ret = self.auth_cache.get(arg, val)
+            if ret is not None:
+                return ret
+        start_time = time.monotonic()
+        ret = await self.auth_db.attr_auths.find_one({arg: val}, projection={'_id':False})
+        self.PromAttrAuthHistogram.observe(time.monotonic() - start_time)
+        if ret and self.auth_cache:
+            self.auth_cache.set(arg, val, ret)
+        return ret
+
+    async def get_attr_auths(self, arg, vals):
+        """
+        Get the auths for many values of an attribute, using the cache if available.
+
+        Values not in the cache are looked up with a single query.
+
+        Args:
+            arg (str): attribute name to look up
+            vals (iterable): attribute values
+
+        Returns:
+            dict: {val: auths} for found values
+        """
+        ret = {}
+        missing = []
+        for val in set(vals):
+            auths = self.auth_cache.get(arg, val) if self.auth_cache else None
+            if auths is not None:
+                ret[val] = auths
+            else:
+                missing.append(val)
+        if missing:
+            start_time = time.monotonic()
+            async for row in self.auth_db.attr_auths.find({arg: {'$in': missing}}, projection={'_id':False}):
+                val = row[arg]
+                ret[val] = row
+                if self.auth_cache:
+                    self.auth_cache.set(arg, val, row)
+            self.PromAttrAuthHistogram.observe(time.monotonic() - start_time)
+        return ret
+
+    def _attr_auth_allowed(self, auths, role):
+        """Check auths for the current user and groups, returning a boolean."""
+        try:
+            if role+'_groups' not in auths:
+                return False
+            return bool(set(auths.get(role+'_groups', [])) & set(self.auth_groups) or
+                        self.current_user in auths.get(role+'_users', []))
+        except (TypeError, ValueError, KeyError):
+            return False
 
     async def check_attr_auth(self, arg, val, role):
         """
@@ -90,7 +191,7 @@ class AttrAuthMixin(TokenAttributeRoleMappingProtocol, AuthProtocol, RestHandler
         """
         ret = None
         try:
-            ret = await self.auth_db.attr_auths.find_one({arg: val}, projection={'_id':False})
+            ret = await self.get_attr_auth(arg, val)
             if not ret:
                 raise HTTPError(403, reason='attr not found')
             elif role+'_groups' not in ret:
@@ -126,6 +227,25 @@ class AttrAuthMixin(TokenAttributeRoleMappingProtocol, AuthProtocol, RestHandler
             return False
         return True
 
+    async def manual_attr_auth_many(self, arg, vals, role, token_role_bypass=['admin', 'system']):
+        """
+        Manually run check_attr_auth on many values at once.
+
+        Args:
+            arg (str): attribute name to check
+            vals (iterable): attribute values
+            role (str): the role to check for (read|write)
+            token_role_bypass (list): token roles that bypass this auth (default: admin,system)
+
+        Returns:
+            set: authorized values
+        """
+        if any(r in self.auth_roles for r in token_role_bypass):
+            logger.debug('token role bypass')
+            return set(vals)
+        auths = await self.get_attr_auths(arg, vals)
+        return {val for val in auths if self._attr_auth_allowed(auths[val], role)}
+
 
 #: match token roles and groups
 authorization = token_attribute_role_mapping_auth(role_attrs=ROLES, group_attrs=GROUPS)
@@ -1,32 +1,38 @@
 import logging
+from collections.abc import AsyncIterable
 from typing import Any
 
 from rest_tools.server import RestHandler, RestHandlerSetup
 from tornado.escape import json_encode
+from tornado.web import HTTPError
+from wipac_dev_tools import strtobool
 
 from iceprod.common.prom_utils import PromRequestMixin
 from iceprod.util import VERSION_STRING
 
 from ..common.mongo import AsyncDatabase, AsyncMongoClient
-from .auth import AttrAuthMixin
+from .auth import AttrAuthCache, AttrAuthMixin
+from .compression import CompressionTransform
 
 logger = logging.getLogger('rest')
 
 type DB = AsyncMongoClient | AsyncDatabase
 
 
-def IceProdRestConfig(config: dict[str, Any], database: DB | None = None, auth_database: AsyncDatabase | None = None, s3conn=None):
+def IceProdRestConfig(config: dict[str, Any], database: DB | None = None, auth_database: AsyncDatabase | None = None, s3conn=None, auth_cache: AttrAuthCache | None = None, compression: dict[str, Any] | None = None):
     if config:
         config['server_header'] = 'IceProd/' + VERSION_STRING
     ret = RestHandlerSetup(config)
     ret['database'] = database
     ret['s3'] = s3conn
+    ret['auth_cache'] = auth_cache
+    ret['compression'] = compression
     return ret
 
 
 class APIBase(AttrAuthMixin, PromRequestMixin, RestHandler):
     """Default REST handler"""
-    def initialize(self, *args, database: DB, db_client: AsyncMongoClient | None = None, s3=None, **kwargs):  # type: ignore[override]
+    def initialize(self, *args, database: DB, db_client: AsyncMongoClient | None = None, s3=None, auth_cache: AttrAuthCache | None = None, compression: dict[str, Any] | None = None, **kwargs):  # type: ignore[override]
         logger.debug('initialze APIBase: args=%r, kwargs=%r', args, kwargs)
         super().initialize(*args, **kwargs)
         logger.debug('do rest of initialize APIBase')
@@ -34,6 +40,8 @@ class APIBase(AttrAuthMixin, PromRequestMixin, RestHandler):
         self.db_client = db_client
         self.auth_db: AsyncDatabase | None = db_client['auth'] if db_client else None  # type: ignore
         self.s3 = s3
+        self.auth_cache = auth_cache
+        self.compression = compression
 
     def get_template_namespace(self):
         namespace = super().get_template_namespace()
@@ -63,6 +71,10 @@ class APIBase(AttrAuthMixin, PromRequestMixin, RestHandler):
         self.set_header('Expires', '0')
         # Set Content Security Policy to deny all
         self.set_header('Content-Security-Policy', "default-src 'none'; frame-ancestors 'none';")
+        # Compress the response if the client supports it
+        if self.compression:
+            self.prom_compression = CompressionTransform(self.request, **self.compression)
+            self._transforms.append(self.prom_compression)
 
     def write(self, chunk: str | bytes | dict | list) -> None:  # type: ignore[override]
         """Write dict or list to json"""
@@ -71,3 +83,40 @@ class APIBase(AttrAuthMixin, PromRequestMixin, RestHandler):
             super().write(json_encode(chunk))
         else:
             super().write(chunk)
+
+    async def write_ndjson(self, cursor: AsyncIterable[dict], buffer_size: int = 1000) -> None:
+        """
+        Stream rows to newline-delimited json.
+
+        Output is flushed every `buffer_size` rows, so memory use does
+        not depend on the total number of rows.
+
+        Args:
+            cursor: async iterable of rows, such as a mongo cursor
+            buffer_size: number of rows to buffer before flushing
+        """
+        self.set_header("Content-Type", "application/x-ndjson")
+        n = 0
+        async for row in cursor:
+            super().write(json_encode(row) + '\n')
+            n += 1
+            if n >= buffer_size:
+                n = 0
+                await self.flush()
+        self.finish()
+
+    def get_stream_args(self) -> tuple[bool, int]:
+        """
+        Get the `stream` and `buffer_size` params for streaming handlers.
+
+        Returns:
+            tuple: (stream, buffer_size)
+        """
+        stream = strtobool(self.get_argument('stream', 'false'))
+        try:
+            buffer_size = int(self.get_argument('buffer_size', '1000'))
+        except ValueError:
+            raise HTTPError(400, reason='Bad argument "buffer_size": must be integer')
+        if buffer_size < 1:
+            raise HTTPError(400, reason='Bad argument "buffer_size": must be positive')
+        return stream, buffer_size
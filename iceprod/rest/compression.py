@@ -0,0 +1,132 @@
+"""
+Negotiated response compression.
+"""
+import time
+import zlib
+from typing import Any
+
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+from tornado.web import OutputTransform
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
+
+
+#: supported encodings, in order of server preference
+ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+
+
+def negotiate_encoding(accept_encoding: str, encodings: list[str] | tuple[str, ...] = ENCODINGS) -> str | None:
+    """
+    Pick a content encoding based on an `Accept-Encoding` header.
+
+    Args:
+        accept_encoding: the header value
+        encodings: allowed encodings, in order of preference
+
+    Returns:
+        str: the encoding, or None for no compression
+    """
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        name = name.strip().lower()
+        q = 1.
+        for p in params:
+            k, _, v = p.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.
+        if name:
+            qvalues[name] = q
+    best = None
+    best_q = 0.
+    for enc in encodings:
+        if enc not in ENCODINGS:
+            continue
+        q = qvalues.get(enc, qvalues.get('*', 0.))
+        if q > best_q:
+            best = enc
+            best_q = q
+    return best
+
+
+class CompressionTransform(OutputTransform):
+    """
+    Compress the response body with the negotiated encoding.
+
+    Responses smaller than `min_size` are sent uncompressed, unless they
+    are streamed in multiple chunks.  Streamed chunks are flushed through
+    the compressor so the client can decode them as they arrive.
+
+    Sizes and CPU time are kept for metrics.
+
+    Args:
+        request: the http request
+        encodings: allowed encodings, in order of preference
+        min_size: minimum response size to compress, in bytes
+    """
+    CONTENT_TYPES = {
+        'application/json',
+        'application/x-ndjson',
+        'application/javascript',
+        'application/xml',
+    }
+    GZIP_LEVEL = 6
+    ZSTD_LEVEL = 3
+
+    def __init__(self, request: HTTPServerRequest, encodings: list[str] | tuple[str, ...] = ENCODINGS, min_size: int = 1024):
+        self.encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''), encodings)
+        self.min_size = min_size
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.cpu_time = 0.
+        self._compressor: Any = None
+
+    def _compressible_type(self, ctype: str) -> bool:
+        return ctype.startswith('text/') or ctype in self.CONTENT_TYPES
+
+    def transform_first_chunk(self, status_code: int, headers: HTTPHeaders, chunk: bytes, finishing: bool) -> tuple[int, HTTPHeaders, bytes]:
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        ctype = str(headers.get('Content-Type', '')).split(';')[0]
+        if (self.encoding and self._compressible_type(ctype)
+                and (not finishing or len(chunk) >= self.min_size)
+                and 'Content-Encoding' not in headers):
+            headers['Content-Encoding'] = self.encoding
+            if self.encoding == 'zstd':
+                self._compressor = zstandard.ZstdCompressor(level=self.ZSTD_LEVEL).compressobj()
+            else:
+                self._compressor = zlib.compressobj(self.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            chunk = self.transform_chunk(chunk, finishing)
+            if 'Content-Length' in headers:
+                # the original content length is no longer correct
+                if finishing:
+                    headers['Content-Length'] = str(len(chunk))
+                else:
+                    del headers['Content-Length']
+        else:
+            self.encoding = None
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk: bytes, finishing: bool) -> bytes:
+        if not self._compressor:
+            return chunk
+        start = time.thread_time()
+        ret = self._compressor.compress(chunk)
+        if finishing:
+            ret += self._compressor.flush()
+        elif self.encoding == 'zstd':
+            ret += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        else:
+            ret += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.thread_time() - start
+        self.raw_size += len(chunk)
+        self.compressed_size += len(ret)
+        return ret
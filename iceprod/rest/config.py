@@ -24,6 +24,10 @@ class DefaultConfig:
     ROUTE_STATS_WINDOW_SIZE: int = 1000
     ROUTE_STATS_WINDOW_TIME: int = 3600
     ROUTE_STATS_TIMEOUT: int = 60
+    ATTR_AUTH_CACHE_SIZE: int = 10000
+    ATTR_AUTH_CACHE_TTL: int = 60
+    COMPRESSION_ENCODINGS: str = 'zstd,gzip'
+    COMPRESSION_MIN_SIZE: int = 1024
     CI_TESTING: str = ''
 
 
@@ -67,6 +67,7 @@ class MultiDatasetHandler(APIBase):
             status: | separated list of status filters
             groups: | separated list of groups to filter on
             users: | separated list of users to filter on
+            updated_since: only datasets updated at or after this timestamp
             keys: | separated list of keys to return for each dataset
 
         Returns:
@@ -85,6 +86,9 @@ class MultiDatasetHandler(APIBase):
         users = self.get_argument('users', None)
         if users:
             query['username'] = {'$in': users.split('|')}
+        updated_since = self.get_argument('updated_since', None)
+        if updated_since:
+            query['last_update'] = {'$gte': updated_since}
 
         projection = {'_id': False}
         keys = self.get_argument('keys', None)
@@ -94,9 +98,9 @@ class MultiDatasetHandler(APIBase):
 
         ret = {}
         async for row in self.db.datasets.find(query, projection=projection):
-            k = row['dataset_id']
-            if await self.manual_attr_auth('dataset_id', k, 'read'):
-                ret[k] = row
+            ret[row['dataset_id']] = row
+        allowed = await self.manual_attr_auth_many('dataset_id', ret, 'read')
+        ret = {k: v for k, v in ret.items() if k in allowed}
         self.write(ret)
         self.finish()
 
@@ -173,6 +177,7 @@ class MultiDatasetHandler(APIBase):
         if 'status' not in data:
             data['status'] = DATASET_STATUS_START
         data['start_date'] = nowstr()
+        data['last_update'] = data['start_date']
         if self.auth_roles == ['user'] or 'username' not in data:
             data['username'] = self.current_user
         if 'priority' not in data:
@@ -260,7 +265,7 @@ class DatasetDescriptionHandler(APIBase):
 
         ret = await self.db.datasets.find_one_and_update(
             {'dataset_id':dataset_id},
-            {'$set':{'description': data['description']}},
+            {'$set':{'description': data['description'], 'last_update': nowstr()}},
             projection=['_id']
         )
         if not ret:
@@ -297,7 +302,7 @@ class DatasetStatusHandler(APIBase):
         logging.debug('prev_statuses: %r', prev_statuses)
         ret = await self.db.datasets.find_one_and_update(
             {'dataset_id': dataset_id, 'status': {'$in': prev_statuses}},
-            {'$set': {'status': data['status']}},
+            {'$set': {'status': data['status'], 'last_update': nowstr()}},
             projection=['_id']
         )
         if not ret:
@@ -337,7 +342,7 @@ class DatasetPriorityHandler(APIBase):
 
         ret = await self.db.datasets.find_one_and_update(
             {'dataset_id':dataset_id},
-            {'$set':{'priority': data['priority']}},
+            {'$set':{'priority': data['priority'], 'last_update': nowstr()}},
             projection=['_id']
         )
         if not ret:
@@ -398,6 +403,7 @@ class DatasetJobsSubmittedHandler(APIBase):
                 {'$set':{
                     'jobs_submitted': jobs_submitted,
                     'tasks_submitted': int(jobs_submitted*ret['tasks_per_job']),
+                    'last_update': nowstr(),
                 }},
                 projection=['_id']
             )
@@ -433,7 +439,7 @@ class DatasetHardResetHandler(APIBase):
         """
         ret = await self.db.datasets.find_one_and_update(
             {'dataset_id': dataset_id},
-            {'$set': {'status': DATASET_STATUS_START}},
+            {'$set': {'status': DATASET_STATUS_START, 'last_update': nowstr()}},
             projection=['_id']
         )
         if not ret:
@@ -458,7 +464,7 @@ class DatasetTruncateHandler(APIBase):
         """
         ret = await self.db.datasets.find_one_and_update(
             {'dataset_id': dataset_id, 'status': {'$ne': 'complete'}},
-            {'$set': {'truncated': True}},
+            {'$set': {'truncated': True, 'last_update': nowstr()}},
             projection=['_id']
         )
         if not ret:
@@ -487,9 +493,11 @@ class DatasetSummariesStatusHandler(APIBase):
             dict: {<status>: [<dataset_id>,]}
         """
         cursor = self.db.datasets.find(projection={'_id': False, 'status': True, 'dataset_id': True})
+        rows = await cursor.to_list()
+        allowed = await self.manual_attr_auth_many('dataset_id', [row['dataset_id'] for row in rows], 'read')
         ret = defaultdict(list)
-        async for row in cursor:
-            if await self.manual_attr_auth('dataset_id', row['dataset_id'], 'read'):
+        for row in rows:
+            if row['dataset_id'] in allowed:
                 ret[row['status']].append(row['dataset_id'])
         ret2 = {}
         for k in sorted(ret, key=dataset_status_sort):
@@ -2,13 +2,19 @@ import json
 import logging
 import uuid
 from collections import defaultdict
+from functools import partial
+from typing import Any
 
 import pymongo
+import pymongo.asynchronous.client_session
+import pymongo.errors
 import tornado.web
 
 from iceprod.server.states import (
     JOB_STATUS,
     JOB_STATUS_START,
+    TASK_STATUS,
+    TASK_STATUS_START,
     job_prev_statuses,
     job_status_sort,
 )
@@ -16,6 +22,7 @@ from iceprod.server.util import nowstr
 
 from ..auth import attr_auth, authorization
 from ..base_handler import APIBase
+from .tasks import TaskCounters
 
 logger = logging.getLogger('rest.jobs')
 
@@ -41,6 +48,7 @@ def setup(handler_cfg):
             (r'/datasets/(?P<dataset_id>\w+)/job_actions/bulk_suspend', DatasetJobBulkSuspendHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/job_actions/bulk_reset', DatasetJobBulkResetHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/job_actions/bulk_hard_reset', DatasetJobBulkHardResetHandler, handler_cfg),
+            (r'/datasets/(?P<dataset_id>\w+)/job_actions/bulk_materialize', DatasetJobBulkMaterializeHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/job_summaries/status', DatasetJobSummariesStatusHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/job_counts/status', DatasetJobCountsStatusHandler, handler_cfg),
         ],
@@ -49,6 +57,7 @@ def setup(handler_cfg):
             'jobs': {
                 'job_id_index': {'keys': 'job_id', 'unique': True},
                 'dataset_id_index': {'keys': 'dataset_id', 'unique': False},
+                'dataset_job_index_index': {'keys': [('dataset_id', pymongo.ASCENDING), ('job_index', pymongo.ASCENDING)], 'unique': False},
             }
         }
     }
@@ -185,13 +194,16 @@ class DatasetMultiJobsHandler(APIBase):
             job_index: job_index to filter by
             status: | separated list of job status to filter by
             keys: | separated list of keys to return for each task
+            stream: bool to stream the jobs as newline-delimited json
+            buffer_size: number of jobs to buffer before flushing when streaming (default 1000)
 
         Args:
             dataset_id (str): dataset id
 
         Returns:
-            dict: {'job_id':{job_data}}
+            dict: {'job_id':{job_data}}, or one {job_data} per line if streaming
         """
+        stream, buffer_size = self.get_stream_args()
         filters = {'dataset_id':dataset_id}
         status = self.get_argument('status', None)
         if status:
@@ -213,6 +225,11 @@ class DatasetMultiJobsHandler(APIBase):
             projection.update({x:True for x in keys.split('|') if x})
             projection['job_id'] = True
 
+        if stream:
+            cursor = self.db.jobs.find(filters, projection=projection, batch_size=buffer_size)
+            await self.write_ndjson(cursor, buffer_size)
+            return
+
         cursor = self.db.jobs.find(filters, projection=projection)
         ret = {}
         async for row in cursor:
@@ -463,6 +480,201 @@ class DatasetJobBulkHardResetHandler(APIBase):
         self.finish()
 
 
+class DatasetJobBulkMaterializeHandler(APIBase):
+    """
+    Create many jobs and their tasks at once.
+    """
+    TASK_FIELDS = {
+        'task_index': int,
+        'name': str,
+        'depends': list,
+        'requirements': dict,
+        'priority': float,
+    }
+
+    def _validate_task(self, job_index: int, task: Any) -> None:
+        if not isinstance(task, dict):
+            raise tornado.web.HTTPError(400, reason=f'job {job_index}: task should be a dict')
+        for k, t in self.TASK_FIELDS.items():
+            if k not in task:
+                raise tornado.web.HTTPError(400, reason=f'job {job_index}: task missing key: {k}')
+            if t is float and isinstance(task[k], int) and not isinstance(task[k], bool):
+                task[k] = float(task[k])
+            elif not isinstance(task[k], t) or isinstance(task[k], bool):
+                raise tornado.web.HTTPError(400, reason=f'job {job_index}: task key {k} should be of type {t.__name__}')
+        if set(task).difference(self.TASK_FIELDS):
+            raise tornado.web.HTTPError(400, reason=f'job {job_index}: invalid task keys found')
+
+    async def _run_query(
+        self,
+        session: pymongo.asynchronous.client_session.AsyncClientSession,
+        *,
+        dataset_id: str,
+        jobs: list[dict[str, Any]],
+        status: str,
+    ) -> list[dict[str, Any]]:
+        assert self.db_client
+        tasks_db = self.db_client['tasks']
+
+        # write to the dataset, so concurrent materializations of the same
+        # dataset conflict and retry instead of both reading no existing jobs
+        ret = await self.db_client['datasets'].datasets.update_one(
+            {'dataset_id': dataset_id},
+            {'$inc': {'materialize_seq': 1}},
+            session=session,
+        )
+        if not ret.matched_count:
+            raise tornado.web.HTTPError(404, reason='Dataset not found')
+
+        # skip jobs that already exist, so retries are safe
+        existing = {}
+        job_indexes = [job['job_index'] for job in jobs]
+        query = {'dataset_id': dataset_id, 'job_index': {'$in': job_indexes}}
+        async for row in self.db.jobs.find(query, projection={'_id': False, 'job_id': True, 'job_index': True}, session=session):
+            existing[row['job_index']] = row['job_id']
+        existing_task_ids: dict[str, list[str]] = {job_id: [] for job_id in existing.values()}
+        if existing_task_ids:
+            query = {'dataset_id': dataset_id, 'job_id': {'$in': list(existing_task_ids)}}
+            projection = {'_id': False, 'job_id': True, 'task_id': True}
+            async for row in tasks_db.tasks.find(query, projection=projection, sort=[('task_index', pymongo.ASCENDING)], session=session):
+                existing_task_ids[row['job_id']].append(row['task_id'])
+
+        now = nowstr()
+        results = []
+        new_jobs = []
+        new_tasks = []
+        for job in jobs:
+            job_index = job['job_index']
+            if job_index in existing:
+                job_id = existing[job_index]
+                results.append({
+                    'job_index': job_index,
+                    'job_id': job_id,
+                    'task_ids': existing_task_ids[job_id],
+                    'created': False,
+                })
+                continue
+            job_id = uuid.uuid1().hex
+            new_jobs.append({
+                'dataset_id': dataset_id,
+                'job_index': job_index,
+                'job_id': job_id,
+                'status': JOB_STATUS_START,
+                'status_changed': now,
+            })
+            task_ids = {task['task_index']: uuid.uuid1().hex for task in job['tasks']}
+            for task in job['tasks']:
+                # an int is the task_index of another task in this job
+                depends = [task_ids[dep] if isinstance(dep, int) else dep for dep in task['depends']]
+                new_tasks.append({
+                    'dataset_id': dataset_id,
+                    'job_id': job_id,
+                    'task_id': task_ids[task['task_index']],
+                    'task_index': task['task_index'],
+                    'job_index': job_index,
+                    'name': task['name'],
+                    'depends': depends,
+                    'requirements': task['requirements'],
+                    'priority': task['priority'],
+                    'status': status,
+                    'status_changed': now,
+                    'failures': 0,
+                    'evictions': 0,
+                    'walltime': 0.0,
+                    'walltime_err': 0.0,
+                    'walltime_err_n': 0,
+                    'site': '',
+                    'instance_id': '',
+                })
+            results.append({
+                'job_index': job_index,
+                'job_id': job_id,
+                'task_ids': [task_ids[task['task_index']] for task in job['tasks']],
+                'created': True,
+            })
+
+        if new_jobs:
+            await self.db.jobs.insert_many(new_jobs, ordered=False, session=session)
+        if new_tasks:
+            await tasks_db.tasks.insert_many(new_tasks, ordered=False, session=session)
+            counters = TaskCounters(tasks_db)
+            for task in new_tasks:
+                counters.add(task)
+            await counters.apply(session=session)
+        return results
+
+    @authorization(roles=['admin', 'system'])
+    async def post(self, dataset_id):
+        """
+        Create many jobs and their tasks in a single transaction.
+
+        This is idempotent on job_index: jobs that already exist are
+        not modified, and are returned with their existing task ids and
+        `created` set to false.
+
+        Task dependencies can be a task_id, or the task_index of
+        another task in the same job.
+
+        Body args (json):
+            jobs (list): [{'job_index': <int>, 'tasks': [{task_index, name, depends, requirements, priority}]}]
+            status (str): (optional) status of new tasks
+
+        Args:
+            dataset_id (str): dataset id
+
+        Returns:
+            dict: {'results': [{'job_index': <int>, 'job_id': <str>, 'task_ids': [<str>], 'created': <bool>}]}
+        """
+        data = json.loads(self.request.body) if self.request.body else None
+        if (not data) or not isinstance(data.get('jobs', None), list):
+            raise tornado.web.HTTPError(400, reason='Missing jobs in body')
+        jobs = data['jobs']
+        if len(jobs) > 10000:
+            raise tornado.web.HTTPError(400, reason='Too many jobs specified (limit: 10k)')
+        if sum(len(job.get('tasks', [])) for job in jobs if isinstance(job, dict)) > 100000:
+            raise tornado.web.HTTPError(400, reason='Too many tasks specified (limit: 100k)')
+        status = data.get('status', TASK_STATUS_START)
+        if status not in TASK_STATUS:
+            raise tornado.web.HTTPError(400, reason='invalid status')
+
+        job_indexes = set()
+        for job in jobs:
+            if not isinstance(job, dict) or not isinstance(job.get('job_index', None), int) or not isinstance(job.get('tasks', None), list):
+                raise tornado.web.HTTPError(400, reason='jobs should have a job_index and a list of tasks')
+            job_index = job['job_index']
+            if job_index in job_indexes:
+                raise tornado.web.HTTPError(400, reason=f'duplicate job_index {job_index}')
+            job_indexes.add(job_index)
+            for task in job['tasks']:
+                self._validate_task(job_index, task)
+            task_indexes = {task['task_index'] for task in job['tasks']}
+            if len(task_indexes) != len(job['tasks']):
+                raise tornado.web.HTTPError(400, reason=f'job {job_index}: duplicate task_index')
+            for task in job['tasks']:
+                for dep in task['depends']:
+                    if isinstance(dep, int) and (isinstance(dep, bool) or dep not in task_indexes or dep >= task['task_index']):
+                        raise tornado.web.HTTPError(400, reason=f'job {job_index}: bad depends {dep}')
+                    elif not isinstance(dep, (int, str)):
+                        raise tornado.web.HTTPError(400, reason=f'job {job_index}: bad depends {dep}')
+
+        assert self.db_client
+        async with self.db_client.start_session() as session:
+            try:
+                ret = await session.with_transaction(partial(
+                    self._run_query,
+                    dataset_id=dataset_id,
+                    jobs=jobs,
+                    status=status,
+                ))
+            except (pymongo.errors.ConnectionFailure, pymongo.errors.OperationFailure):
+                logger.warning('error in transaction:', exc_info=True)
+                self.send_error(500, reason="Transaction error")
+                return
+
+        self.write({'results': ret})
+        self.finish()
+
+
 class DatasetJobSummariesStatusHandler(APIBase):
     """
     Handle job summary grouping by status.
@@ -26,6 +26,7 @@ def setup(handler_cfg):
     return {
         'routes': [
             (r'/logs', MultiLogsHandler, handler_cfg),
+            (r'/logs/bulk', BulkLogsHandler, handler_cfg),
             (r'/logs/(?P<log_id>\w+)', LogsHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/logs', DatasetMultiLogsHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/logs/(?P<log_id>\w+)', DatasetLogsHandler, handler_cfg),
@@ -62,7 +63,7 @@ class MultiLogsHandler(APIBase):
         Returns:
             dict: {log_id: {keys}}
         """
-        query = {}
+        query: dict[str, Any] = {'pending': {'$exists': False}}
         projection = {'_id': False, 'log_id': True}
         try:
             limit = int(self.get_argument('limit', 0))
@@ -134,6 +135,59 @@ class MultiLogsHandler(APIBase):
         self.finish()
 
 
+class BulkLogsHandler(APIBase):
+    """
+    Handle bulk logs requests.
+    """
+    @authorization(roles=['admin', 'system'])
+    async def post(self):
+        """
+        Create many log entries at once.
+
+        Each log has the same fields as a single log entry.  Large logs can
+        skip the API and go directly to S3: leave out the `data` field, and
+        the result will have a presigned `upload_url` to PUT the data to.
+        These logs stay pending, and hidden, until the upload is confirmed
+        with a PATCH to the log.
+
+        Body args (json):
+            logs (list): [{data, dataset_id, task_id, name}]
+
+        Returns:
+            dict: {'results': [{'log_id': <log_id>, 'upload_url': <url>}]}
+        """
+        data = json.loads(self.request.body)
+        if (not data) or not isinstance(data.get('logs', None), list):
+            raise tornado.web.HTTPError(400, reason='Missing logs in body')
+        for log in data['logs']:
+            if not isinstance(log, dict):
+                raise tornado.web.HTTPError(400, reason='logs must be dicts')
+            if 'data' not in log and not self.s3:
+                raise tornado.web.HTTPError(400, reason='data field not in body and s3 disabled')
+
+        timestamp = nowstr()
+        results = []
+        for log in data['logs']:
+            if 'name' not in log:
+                log['name'] = 'log'
+            log_id = uuid.uuid1().hex
+            log['log_id'] = log_id
+            log['timestamp'] = timestamp
+            result = {'log_id': log_id}
+            if 'data' not in log:
+                result['upload_url'] = self.s3.put_presigned(log_id)
+                log['pending'] = True
+            elif self.s3 and len(log['data']) > 1000000:
+                await self.s3.put(log_id, log['data'])
+                del log['data']
+            results.append(result)
+        if data['logs']:
+            await self.db.logs.insert_many(data['logs'])
+        self.set_status(201)
+        self.write({'results': results})
+        self.finish()
+
+
 class LogsHandler(APIBase):
     """
     Handle logs requests.
@@ -149,7 +203,7 @@ class LogsHandler(APIBase):
         Returns:
             dict: all body fields
         """
-        ret = await self.db.logs.find_one({'log_id':log_id}, projection={'_id':False})
+        ret = await self.db.logs.find_one({'log_id':log_id, 'pending': {'$exists': False}}, projection={'_id':False})
         if not ret:
             self.send_error(404, reason="Log not found")
         else:
@@ -161,6 +215,28 @@ class LogsHandler(APIBase):
             self.write(ret)
             self.finish()
 
+    @authorization(roles=['admin', 'system'])
+    async def patch(self, log_id):
+        """
+        Confirm the S3 upload of a pending log entry.
+
+        Args:
+            log_id (str): the log id of the entry
+
+        Returns:
+            dict: empty dict on success
+        """
+        if not self.s3:
+            raise tornado.web.HTTPError(400, reason='s3 disabled')
+        if not await self.s3.exists(log_id):
+            raise tornado.web.HTTPError(400, reason='log data not uploaded')
+        ret = await self.db.logs.update_one({'log_id':log_id}, {'$unset': {'pending': ''}})
+        if not ret.matched_count:
+            self.send_error(404, reason="Log not found")
+        else:
+            self.write({})
+            self.finish()
+
     @authorization(roles=['admin', 'system'])
     async def delete(self, log_id):
         """
@@ -276,7 +352,7 @@ class DatasetLogsHandler(APIBase):
             dict: all body fields
         """
         ret = await self.db.logs.find_one(
-            {'dataset_id':dataset_id,'log_id':log_id},
+            {'dataset_id':dataset_id,'log_id':log_id,'pending':{'$exists':False}},
             projection={'_id':False}
         )
         if not ret:
@@ -316,7 +392,7 @@ class DatasetTaskLogsHandler(APIBase):
         Returns:
             dict: {'logs': [log entry dict, log entry dict]}
         """
-        filters = {'dataset_id': dataset_id, 'task_id': task_id}
+        filters = {'dataset_id': dataset_id, 'task_id': task_id, 'pending': {'$exists': False}}
 
         num = self.get_argument('num', None)
         if num:
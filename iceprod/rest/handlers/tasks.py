@@ -3,7 +3,7 @@ import logging
 import math
 import re
 import uuid
-from collections import defaultdict
+from collections import Counter, defaultdict
 from functools import partial
 from typing import Any
 
@@ -29,6 +29,283 @@ from ..base_handler import APIBase
 
 logger = logging.getLogger('rest.tasks')
 
+#: task fields needed to update the task counters
+COUNTER_PROJECTION = {'_id': False, 'dataset_id': True, 'name': True, 'status': True, 'task_index': True}
+
+
+class TaskCounters:
+    """
+    Incrementally maintained task counts, by dataset, task name, and status.
+
+    Accumulate status changes, then apply them to the `task_counters`
+    collection in a single bulk write.
+
+    Changes must be applied after the tasks themselves are updated.
+    Datasets that do not have counters yet are rebuilt from the tasks
+    instead of applying the changes.
+
+    Args:
+        db: the tasks database
+    """
+    def __init__(self, db):
+        self.db = db
+        self.deltas: Counter[tuple[str, str, str]] = Counter()
+        self.ordering: dict[tuple[str, str], int] = {}
+
+    def add(self, task: dict[str, Any], status: str | None = None, num: int = 1):
+        """Add `num` tasks to the counters (use a negative number to remove)"""
+        key = (task['dataset_id'], task['name'], status if status else task['status'])
+        self.deltas[key] += num
+        self.ordering[key[:2]] = task.get('task_index', 0)
+
+    def move(self, task: dict[str, Any], old_status: str, new_status: str, num: int = 1):
+        """Move `num` tasks from one status to another"""
+        if old_status != new_status:
+            self.add(task, old_status, -num)
+            self.add(task, new_status, num)
+
+    @property
+    def dataset_ids(self) -> set[str]:
+        return {k[0] for k in self.deltas}
+
+    async def apply(self, session=None):
+        """Write the accumulated changes to the database"""
+        dataset_ids = self.dataset_ids
+        if not dataset_ids:
+            return
+        initialized = set()
+        query = {'dataset_id': {'$in': list(dataset_ids)}}
+        async for row in self.db.task_counter_datasets.find(query, projection={'_id': False, 'dataset_id': True}, session=session):
+            initialized.add(row['dataset_id'])
+        for dataset_id in dataset_ids - initialized:
+            await rebuild_task_counters(self.db, dataset_id, session=session)
+
+        ops = []
+        for (dataset_id, name, status), num in self.deltas.items():
+            if num and dataset_id in initialized:
+                ops.append(pymongo.UpdateOne(
+                    {'dataset_id': dataset_id, 'name': name, 'status': status},
+                    {'$inc': {'count': num}, '$setOnInsert': {'task_index': self.ordering[(dataset_id, name)]}},
+                    upsert=True,
+                ))
+        if ops:
+            await self.db.task_counters.bulk_write(ops, ordered=False, session=session)
+        self.deltas.clear()
+
+
+async def _rebuild_task_counters(session, *, db, dataset_id: str) -> dict[str, dict[str, int]]:
+    expected = {}
+    ordering = {}
+    cursor = await db.tasks.aggregate([
+        {'$match': {'dataset_id': dataset_id}},
+        {'$group': {
+            '_id': {'name': '$name', 'status': '$status'},
+            'ordering': {'$min': '$task_index'},
+            'total': {'$sum': 1},
+        }},
+    ], session=session)
+    async for row in cursor:
+        key = (row['_id']['name'], row['_id']['status'])
+        expected[key] = row['total']
+        ordering[key[0]] = row['ordering']
+
+    current = {}
+    async for row in db.task_counters.find({'dataset_id': dataset_id}, projection={'_id': False}, session=session):
+        current[(row['name'], row['status'])] = row['count']
+
+    drift: defaultdict[str, dict[str, int]] = defaultdict(dict)
+    for key in set(expected) | set(current):
+        diff = expected.get(key, 0) - current.get(key, 0)
+        if diff:
+            drift[key[0]][key[1]] = diff
+
+    # replace the counters, instead of applying the drift
+    await db.task_counters.delete_many({'dataset_id': dataset_id}, session=session)
+    docs = [
+        {'dataset_id': dataset_id, 'name': name, 'status': status, 'count': count, 'task_index': ordering[name]}
+        for (name, status), count in expected.items()
+    ]
+    if docs:
+        await db.task_counters.insert_many(docs, session=session)
+    await db.task_counter_datasets.update_one(
+        {'dataset_id': dataset_id},
+        {'$set': {'dataset_id': dataset_id, 'rebuilt': nowstr()}},
+        upsert=True,
+        session=session,
+    )
+    if drift:
+        logger.info('task counter drift for dataset %s: %r', dataset_id, dict(drift))
+    return dict(drift)
+
+
+async def rebuild_task_counters(db, dataset_id: str, session=None) -> dict[str, dict[str, int]]:
+    """
+    Rebuild the task counters for a dataset from the tasks themselves.
+
+    The counters are replaced in a transaction, so concurrent updates
+    either see the rebuilt counters or conflict and retry.
+
+    Args:
+        db: the tasks database
+        dataset_id: dataset id
+        session: (optional) run in an existing transaction
+
+    Returns:
+        dict: drift that was repaired, as {<name>: {<status>: expected - counted}}
+    """
+    if session is not None:
+        return await _rebuild_task_counters(session, db=db, dataset_id=dataset_id)
+    async with db.client.start_session() as session:
+        return await session.with_transaction(partial(_rebuild_task_counters, db=db, dataset_id=dataset_id))
+
+
+async def update_many_with_counters(db, query: dict[str, Any], update: dict[str, Any], status: str):
+    """
+    Update many tasks to a new status, keeping the task counters in sync.
+
+    The old statuses are aggregated before the update.  If the tasks
+    changed in between, the affected datasets are rebuilt instead.
+
+    Args:
+        db: the tasks database
+        query: tasks to update
+        update: mongo update, including setting the status
+        status: the new status
+
+    Returns:
+        UpdateResult
+    """
+    counters = TaskCounters(db)
+    matched = 0
+    cursor = await db.tasks.aggregate([
+        {'$match': query},
+        {'$group': {
+            '_id': {'dataset_id': '$dataset_id', 'name': '$name', 'status': '$status'},
+            'task_index': {'$min': '$task_index'},
+            'total': {'$sum': 1},
+        }},
+    ])
+    async for row in cursor:
+        task = dict(row['_id'], task_index=row['task_index'])
+        counters.move(task, task['status'], status, num=row['total'])
+        matched += row['total']
+
+    ret = await db.tasks.update_many(query, update)
+    if ret.matched_count == matched:
+        await counters.apply()
+    else:
+        for dataset_id in counters.dataset_ids:
+            await rebuild_task_counters(db, dataset_id)
+    return ret
+
+
+def processing_update(data: dict[str, Any]) -> dict[str, Any]:
+    """Build the mongo update for a task action of queued -> processing"""
+    update_query = {
+        '$set': {
+            'status': 'processing',
+            'status_changed': nowstr(),
+        },
+    }
+    if 'site' in data:
+        update_query['$set']['site'] = data['site']
+    return update_query
+
+
+def error_update(data: dict[str, Any], final_status: str, task: dict[str, Any] | None) -> dict[str, Any]:
+    """
+    Build the mongo update for a task action on error.
+
+    Resource requirements are increased based on the resources used.
+
+    Args:
+        data: action args
+        final_status: new status (waiting or failed)
+        task: the current task, to get current requirements
+
+    Returns:
+        dict: mongo update
+    """
+    update_query: defaultdict[str, dict[str, str | int | float]] = defaultdict(dict,{
+        '$set': {
+            'status': final_status,
+            'status_changed': nowstr(),
+            'instance_id': '',
+        },
+        '$inc': {
+            'failures': 1,
+        },
+    })
+    if 'time_used' in data:
+        update_query['$inc']['walltime_err_n'] = 1
+        update_query['$inc']['walltime_err'] = data['time_used']/3600.
+    elif 'resources' in data and 'time' in data['resources']:
+        update_query['$inc']['walltime_err_n'] = 1
+        update_query['$inc']['walltime_err'] = data['resources']['time']
+    for k in ('cpu','memory','disk','time'):
+        if 'resources' in data and k in data['resources']:
+            try:
+                new_val = float(data['resources'][k])
+                old_val: float = task['requirements'][k] if task and k in task['requirements'] else Resources.defaults[k]  # type: ignore
+                if k == 'cpu':  # special handling for cpu
+                    if new_val <= 1.1 or new_val > 20:
+                        continue
+                    if new_val < old_val*1.1:
+                        continue
+                    new_val = old_val+1  # increase linearly
+                elif new_val < 0.5:
+                    logger.info('ignoring val below 0.5 for %s: %f', k, new_val)
+                    continue
+                else:
+                    new_val *= 1.5  # increase new request by 1.5
+                if isinstance(Resources.defaults[k], (int, list)):
+                    new_val = math.ceil(new_val)
+            except Exception:
+                logger.info('error converting requirement %r',
+                            data['resources'][k], exc_info=True)
+            else:
+                update_query['$max']['requirements.'+k] = new_val
+
+        site = 'unknown'
+        if 'site' in data:
+            site = data['site']
+            update_query['$set']['site'] = site
+    return update_query
+
+
+def complete_update(data: dict[str, Any]) -> dict[str, Any]:
+    """Build the mongo update for a task action of processing -> complete"""
+    update_query = {
+        '$set': {
+            'status': 'complete',
+            'status_changed': nowstr(),
+            'instance_id': '',
+        },
+    }
+    if 'time_used' in data:
+        update_query['$set']['walltime'] = data['time_used']/3600.
+    if 'site' in data:
+        update_query['$set']['site'] = data['site']
+    return update_query
+
+
+async def get_task_counters(db, dataset_id: str) -> list[dict[str, Any]]:
+    """
+    Get the task counters for a dataset.
+
+    Datasets created before the counters existed are rebuilt on first use.
+
+    Args:
+        db: the tasks database
+        dataset_id: dataset id
+
+    Returns:
+        list: counter docs
+    """
+    if not await db.task_counter_datasets.find_one({'dataset_id': dataset_id}):
+        await rebuild_task_counters(db, dataset_id)
+    return [row async for row in db.task_counters.find({'dataset_id': dataset_id}, projection={'_id': False})]
+
 
 def setup(handler_cfg):
     """
@@ -49,6 +326,8 @@ def setup(handler_cfg):
             (r'/task_actions/waiting', TasksActionsWaitingHandler, handler_cfg),
             (r'/task_actions/queue', TasksActionsQueueHandler, handler_cfg),
             (r'/task_actions/queue_many', TasksActionsBulkQueueHandler, handler_cfg),
+            (r'/task_actions/bulk_transitions', TasksActionsBulkTransitionsHandler, handler_cfg),
+            (r'/task_actions/bulk_priority', TasksActionsBulkPriorityHandler, handler_cfg),
             (r'/task_counts/status', TaskCountsStatusHandler, handler_cfg),
             (r'/tasks/(?P<task_id>\w+)/task_actions/processing', TasksActionsProcessingHandler, handler_cfg),
             (r'/tasks/(?P<task_id>\w+)/task_actions/reset', TasksActionsErrorHandler, handler_cfg),
@@ -60,6 +339,7 @@ def setup(handler_cfg):
             (r'/datasets/(?P<dataset_id>\w+)/task_summaries/status', DatasetTaskSummaryStatusHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/task_counts/status', DatasetTaskCountsStatusHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/task_counts/name_status', DatasetTaskCountsNameStatusHandler, handler_cfg),
+            (r'/datasets/(?P<dataset_id>\w+)/task_counts/rebuild', DatasetTaskCountsRebuildHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/task_actions/bulk_status/(?P<status>\w+)', DatasetTaskBulkStatusHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/task_actions/bulk_suspend', DatasetTaskBulkSuspendHandler, handler_cfg),
             (r'/datasets/(?P<dataset_id>\w+)/task_actions/bulk_reset', DatasetTaskBulkResetHandler, handler_cfg),
@@ -77,11 +357,18 @@ def setup(handler_cfg):
                 'job_id_index': {'keys': 'job_id', 'unique': False},
                 'status_index': {'keys': 'status', 'unique': False},
                 'priority_index': {'keys': [('status', pymongo.ASCENDING), ('priority', pymongo.DESCENDING)], 'unique': False},
+                'status_changed_index': {'keys': 'status_changed', 'unique': False},
             },
             'dataset_files': {
                 'dataset_id_index': {'keys': 'dataset_id', 'unique': False},
                 'task_id_index': {'keys': 'task_id', 'unique': False},
-            }
+            },
+            'task_counters': {
+                'dataset_name_status_index': {'keys': [('dataset_id', pymongo.ASCENDING), ('name', pymongo.ASCENDING), ('status', pymongo.ASCENDING)], 'unique': True},
+            },
+            'task_counter_datasets': {
+                'dataset_id_index': {'keys': 'dataset_id', 'unique': True},
+            },
         }
     }
 
@@ -98,13 +385,18 @@ class MultiTasksHandler(APIBase):
         Params (optional):
             status: | separated list of task status to filter by
             site: site to filter on
+            status_changed_since: only tasks with a status change at or after this timestamp
             keys: | separated list of keys to return for each task
             sort: | separated list of sort key=values, with values of 1 or -1
             limit: number of tasks to return
+            stream: bool to stream the tasks as newline-delimited json
+            buffer_size: number of tasks to buffer before flushing when streaming (default 1000)
 
         Returns:
-            dict: {'tasks': [<task>]}
+            dict: {'tasks': [<task>]}, or one <task> per line if streaming
         """
+        stream, buffer_size = self.get_stream_args()
+
         filters = {}
 
         if status := self.get_argument('status', None):
@@ -113,6 +405,9 @@ class MultiTasksHandler(APIBase):
         if site := self.get_argument('site', None):
             filters['site'] = {'$regex': '^'+re.escape(site)}
 
+        if status_changed_since := self.get_argument('status_changed_since', None):
+            filters['status_changed'] = {'$gte': status_changed_since}
+
         mongo_sort = []
         if sort := self.get_argument('sort', None):
             for s in sort.split('|'):
@@ -134,6 +429,11 @@ class MultiTasksHandler(APIBase):
         projection = {x:True for x in self.get_argument('keys','').split('|') if x}
         projection['_id'] = False
 
+        if stream:
+            cursor = self.db.tasks.find(filters, projection=projection, sort=mongo_sort, limit=limit, batch_size=buffer_size)
+            await self.write_ndjson(cursor, buffer_size)
+            return
+
         ret = []
         async for row in self.db.tasks.find(filters, projection=projection, sort=mongo_sort, limit=limit):
             ret.append(row)
@@ -206,6 +506,9 @@ class MultiTasksHandler(APIBase):
             data['instance_id'] = ''
 
         await self.db.tasks.insert_one(data)
+        counters = TaskCounters(self.db)
+        counters.add(data)
+        await counters.apply()
         self.set_status(201)
         self.write({'result': task_id})
         self.finish()
@@ -251,12 +554,24 @@ class TasksHandler(APIBase):
         if not data:
             raise tornado.web.HTTPError(400, reason='Missing update data')
 
-        ret = await self.db.tasks.find_one_and_update(
-            {'task_id':task_id},
-            {'$set':data},
-            projection={'_id':False},
-            return_document=pymongo.ReturnDocument.AFTER
-        )
+        if 'status' in data:
+            ret = await self.db.tasks.find_one_and_update(
+                {'task_id':task_id},
+                {'$set':data},
+                projection=COUNTER_PROJECTION,
+            )
+            if ret:
+                counters = TaskCounters(self.db)
+                counters.move(ret, ret['status'], data['status'])
+                await counters.apply()
+                ret = await self.db.tasks.find_one({'task_id':task_id}, projection={'_id':False})
+        else:
+            ret = await self.db.tasks.find_one_and_update(
+                {'task_id':task_id},
+                {'$set':data},
+                projection={'_id':False},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
         if not ret:
             self.send_error(404, reason="Task not found")
         else:
@@ -304,11 +619,16 @@ class TasksStatusHandler(APIBase):
         if instance_id:
             search['instance_id'] = instance_id
 
-        ret = await self.db.tasks.update_one(
+        ret = await self.db.tasks.find_one_and_update(
             search,
-            {'$set': update_data}
+            {'$set': update_data},
+            projection=COUNTER_PROJECTION,
         )
-        if (not ret) or ret.modified_count < 1:
+        if ret:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], status)
+            await counters.apply()
+        else:
             ret = await self.db.tasks.find_one({'task_id': task_id})
             if not ret:
                 self.send_error(404, reason="Task not found")
@@ -448,11 +768,16 @@ class DatasetTasksStatusHandler(APIBase):
         if data['status'] == 'reset':
             update_data['failures'] = 0
 
-        ret = await self.db.tasks.update_one(
+        ret = await self.db.tasks.find_one_and_update(
             {'task_id': task_id, 'dataset_id': dataset_id, 'status': {'$in': task_prev_statuses(data['status'])}},
-            {'$set': update_data}
+            {'$set': update_data},
+            projection=COUNTER_PROJECTION,
         )
-        if (not ret) or ret.modified_count < 1:
+        if ret:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], data['status'])
+            await counters.apply()
+        else:
             ret = await self.db.tasks.find_one({'task_id': task_id, 'dataset_id': dataset_id})
             if not ret:
                 self.send_error(404, reason="Task not found")
@@ -497,11 +822,15 @@ class DatasetTasksForceStatusHandler(APIBase):
         if data['status'] == 'reset':
             update_data['failures'] = 0
 
-        ret = await self.db.tasks.update_one({'task_id':task_id,'dataset_id':dataset_id},
-                                             {'$set':update_data})
-        if (not ret) or ret.modified_count < 1:
+        ret = await self.db.tasks.find_one_and_update({'task_id':task_id,'dataset_id':dataset_id},
+                                                      {'$set':update_data},
+                                                      projection=COUNTER_PROJECTION)
+        if not ret:
             self.send_error(404, reason="Task not found")
         else:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], data['status'])
+            await counters.apply()
             self.write({})
             self.finish()
 
@@ -602,8 +931,28 @@ class DatasetTaskCountsStatusHandler(TaskCountsStatusHandler):
         Returns:
             dict: {<status>: num}
         """
-        match = {'dataset_id': dataset_id}
-        await self.counts(match=match)
+        if self.get_argument('gpu', None) is not None:
+            # counters are not split by requirements
+            match = {'dataset_id': dataset_id}
+            await self.counts(match=match)
+            return
+
+        status_list = None
+        status = self.get_argument('status', None)
+        if status:
+            status_list = status.split('|')
+            if any(s not in TASK_STATUS for s in status_list):
+                raise tornado.web.HTTPError(400, reason='Unknown task status')
+
+        ret: Counter[str] = Counter()
+        for row in await get_task_counters(self.db, dataset_id):
+            if row['count'] > 0 and (not status_list or row['status'] in status_list):
+                ret[row['status']] += row['count']
+        ret2 = {}
+        for k in sorted(ret, key=task_status_sort):
+            ret2[k] = ret[k]
+        self.write(ret2)
+        self.finish()
 
 
 class DatasetTaskCountsNameStatusHandler(APIBase):
@@ -622,19 +971,12 @@ class DatasetTaskCountsNameStatusHandler(APIBase):
         Returns:
             dict: {<name>: {<status>: num}}
         """
-        cursor = await self.db.tasks.aggregate([
-            {'$match':{'dataset_id': dataset_id}},
-            {'$group':{
-                '_id':{'name': '$name', 'status': '$status'},
-                'ordering': {'$first': '$task_index'},
-                'total': {'$sum': 1}
-            }},
-        ])
         ret = defaultdict(dict)
         ordering = {}
-        async for row in cursor:
-            ret[row['_id']['name']][row['_id']['status']] = row['total']
-            ordering[row['_id']['name']] = row['ordering']
+        for row in await get_task_counters(self.db, dataset_id):
+            if row['count'] > 0:
+                ret[row['name']][row['status']] = row['count']
+                ordering[row['name']] = row['task_index']
         ret2 = {}
         for k in sorted(ordering, key=lambda n:ordering[n]):
             ret2[k] = ret[k]
@@ -642,6 +984,27 @@ class DatasetTaskCountsNameStatusHandler(APIBase):
         self.finish()
 
 
+class DatasetTaskCountsRebuildHandler(APIBase):
+    """
+    Handle task counter consistency checks.
+    """
+    @authorization(roles=['admin', 'system'])
+    async def post(self, dataset_id):
+        """
+        Check the task counters for a dataset against the tasks,
+        and repair any drift.
+
+        Args:
+            dataset_id (str): dataset id
+
+        Returns:
+            dict: {'drift': {<name>: {<status>: num}}}
+        """
+        drift = await rebuild_task_counters(self.db, dataset_id)
+        self.write({'drift': drift})
+        self.finish()
+
+
 class DatasetTaskStatsHandler(APIBase):
     """
     Handle task stats
@@ -714,7 +1077,7 @@ class TasksActionsWaitingHandler(APIBase):
         }
         val = {'$set': {'status': 'waiting'}}
 
-        ret = await self.db.tasks.update_many(query, val)
+        ret = await update_many_with_counters(self.db, query, val, 'waiting')
         waiting = ret.modified_count
         logger.info(f'waiting {waiting} tasks')
         self.write({'waiting': waiting})
@@ -785,6 +1148,9 @@ class TasksActionsQueueHandler(APIBase):
             logger.info('filter_query: %r', filter_query)
             self.send_error(404, reason="Task not found")
         else:
+            counters = TaskCounters(self.db)
+            counters.move(ret, 'waiting', 'queued')
+            await counters.apply()
             self.write(ret)
             self.finish()
 
@@ -850,6 +1216,10 @@ class TasksActionsBulkQueueHandler(APIBase):
             logger.error('ret: %r', ret)
             logger.error('num: %d, ret: %d, matched: %d, modified: %d', num, len(ret), update_ret.matched_count, update_ret.modified_count)
             raise Exception('did not update the right number of tasks')
+        counters = TaskCounters(self.db)
+        for row in ret:
+            counters.move(row, 'waiting', 'queued')
+        await counters.apply(session=session)
         return ret
 
     @authorization(roles=['admin', 'system'])
@@ -966,15 +1336,7 @@ class TasksActionsProcessingHandler(APIBase):
             'status': {'$in': task_prev_statuses('processing')},
             'instance_id': data['instance_id'],
         }
-        update_query = {
-            '$set': {
-                'status': 'processing',
-                'status_changed': nowstr(),
-            },
-        }
-
-        if 'site' in data:
-            update_query['$set']['site'] = data['site']
+        update_query = processing_update(data)
 
         ret = await self.db.tasks.find_one_and_update(
             filter_query,
@@ -990,6 +1352,10 @@ class TasksActionsProcessingHandler(APIBase):
             elif ret['status'] != 'processing':
                 self.send_error(400, reason="Bad state transition for status")
                 return
+        else:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], 'processing')
+            await counters.apply()
 
         self.write(ret)
         self.finish()
@@ -1028,52 +1394,8 @@ class TasksActionsErrorHandler(APIBase):
             'status': {'$in': task_prev_statuses(self.final_status)},
             'instance_id': data['instance_id'],
         }
-        update_query: defaultdict[str, dict[str, str | int | float]] = defaultdict(dict,{
-            '$set': {
-                'status': self.final_status,
-                'status_changed': nowstr(),
-                'instance_id': '',
-            },
-            '$inc': {
-                'failures': 1,
-            },
-        })
-
         task = await self.db.tasks.find_one(filter_query)
-        if 'time_used' in data:
-            update_query['$inc']['walltime_err_n'] = 1
-            update_query['$inc']['walltime_err'] = data['time_used']/3600.
-        elif 'resources' in data and 'time' in data['resources']:
-            update_query['$inc']['walltime_err_n'] = 1
-            update_query['$inc']['walltime_err'] = data['resources']['time']
-        for k in ('cpu','memory','disk','time'):
-            if 'resources' in data and k in data['resources']:
-                try:
-                    new_val = float(data['resources'][k])
-                    old_val: float = task['requirements'][k] if task and k in task['requirements'] else Resources.defaults[k]  # type: ignore
-                    if k == 'cpu':  # special handling for cpu
-                        if new_val <= 1.1 or new_val > 20:
-                            continue
-                        if new_val < old_val*1.1:
-                            continue
-                        new_val = old_val+1  # increase linearly
-                    elif new_val < 0.5:
-                        logger.info('ignoring val below 0.5 for %s: %f', k, new_val)
-                        continue
-                    else:
-                        new_val *= 1.5  # increase new request by 1.5
-                    if isinstance(Resources.defaults[k], (int, list)):
-                        new_val = math.ceil(new_val)
-                except Exception:
-                    logger.info('error converting requirement %r',
-                                data['resources'][k], exc_info=True)
-                else:
-                    update_query['$max']['requirements.'+k] = new_val
-
-            site = 'unknown'
-            if 'site' in data:
-                site = data['site']
-                update_query['$set']['site'] = site
+        update_query = error_update(data, self.final_status, task)
 
         ret = await self.db.tasks.find_one_and_update(
             filter_query,
@@ -1089,6 +1411,10 @@ class TasksActionsErrorHandler(APIBase):
             elif ret['status'] != self.final_status:
                 self.send_error(400, reason="Bad state transition for status")
                 return
+        else:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], self.final_status)
+            await counters.apply()
 
         self.write(ret)
         self.finish()
@@ -1127,18 +1453,7 @@ class TasksActionsCompleteHandler(APIBase):
             'status': {'$in': task_prev_statuses('complete')},
             'instance_id': data['instance_id'],
         }
-        update_query = {
-            '$set': {
-                'status': 'complete',
-                'status_changed': nowstr(),
-                'instance_id': '',
-            },
-        }
-
-        if 'time_used' in data:
-            update_query['$set']['walltime'] = data['time_used']/3600.
-        if 'site' in data:
-            update_query['$set']['site'] = data['site']
+        update_query = complete_update(data)
 
         ret = await self.db.tasks.find_one_and_update(
             filter_query,
@@ -1154,11 +1469,196 @@ class TasksActionsCompleteHandler(APIBase):
             elif ret['status'] != 'complete':
                 self.send_error(400, reason="Bad state transition for status")
                 return
+        else:
+            counters = TaskCounters(self.db)
+            counters.move(ret, ret['status'], 'complete')
+            await counters.apply()
 
         self.write(ret)
         self.finish()
 
 
+class TasksActionsBulkTransitionsHandler(APIBase):
+    """
+    Handle many task actions at once.
+
+    This is the bulk version of the queued (status), processing, reset,
+    failed, and complete task actions.
+    """
+    #: action name: final status
+    ACTIONS = {
+        'queued': 'queued',
+        'processing': 'processing',
+        'reset': 'waiting',
+        'failed': 'failed',
+        'complete': 'complete',
+    }
+
+    def _update_query(self, action: str, transition: dict[str, Any], task: dict[str, Any]) -> dict[str, Any]:
+        """Build the mongo update for a task action"""
+        status = self.ACTIONS[action]
+        if action == 'queued':
+            return {'$set': {'status': status, 'status_changed': nowstr()}}
+        elif action == 'processing':
+            return processing_update(transition)
+        elif action == 'complete':
+            return complete_update(transition)
+        else:
+            return error_update(transition, status, task)
+
+    @authorization(roles=['admin', 'system'])
+    async def post(self):
+        """
+        Apply many task actions in a single bulk write.
+
+        Each transition has the same body args as the single task action,
+        plus the task_id and action name.  Results are reported for each
+        transition in the same order, using http status codes:
+
+        * 200: success, or the task was already in the final status
+        * 400: invalid transition, or bad state transition for status
+        * 404: task not found
+
+        Body args (json):
+            transitions (list): [{task_id, instance_id, action, ...}]
+
+        Returns:
+            dict: {'results': [{'task_id': <task_id>, 'code': <int>, 'reason': <str>}]}
+        """
+        data = json.loads(self.request.body)
+        if (not data) or not isinstance(data.get('transitions', None), list):
+            raise tornado.web.HTTPError(400, reason='Missing transitions in body')
+        transitions = data['transitions']
+        if len(transitions) > 10000:
+            raise tornado.web.HTTPError(400, reason='Too many transitions specified (limit: 10k)')
+
+        task_ids = {t['task_id'] for t in transitions if isinstance(t, dict) and isinstance(t.get('task_id', None), str)}
+        tasks = {}
+        projection = dict(COUNTER_PROJECTION, task_id=True, instance_id=True, requirements=True)
+        async for row in self.db.tasks.find({'task_id': {'$in': list(task_ids)}}, projection=projection):
+            tasks[row['task_id']] = row
+
+        results: list[dict[str, Any]] = []
+        ops = []
+        op_results = []
+        seen = set()
+        counters = TaskCounters(self.db)
+        for t in transitions:
+            if not isinstance(t, dict) or not isinstance(t.get('task_id', None), str) or t.get('action', None) not in self.ACTIONS:
+                results.append({'task_id': t.get('task_id', None) if isinstance(t, dict) else None, 'code': 400, 'reason': 'Invalid transition'})
+                continue
+            task_id = t['task_id']
+            action = t['action']
+            status = self.ACTIONS[action]
+            instance_id = t.get('instance_id', '')
+            if action != 'queued' and not instance_id:
+                results.append({'task_id': task_id, 'code': 400, 'reason': 'Missing instance_id'})
+                continue
+            if task_id in seen:
+                results.append({'task_id': task_id, 'code': 400, 'reason': 'Duplicate task_id'})
+                continue
+            seen.add(task_id)
+
+            task = tasks.get(task_id, None)
+            if (not task) or (action != 'queued' and task['instance_id'] != instance_id):
+                results.append({'task_id': task_id, 'code': 404, 'reason': 'Task not found'})
+                continue
+            if task['status'] not in task_prev_statuses(status) or (instance_id and task['instance_id'] != instance_id):
+                if task['status'] == status:
+                    results.append({'task_id': task_id, 'code': 200, 'reason': ''})
+                else:
+                    results.append({'task_id': task_id, 'code': 400, 'reason': 'Bad state transition for status'})
+                continue
+
+            filter_query = {
+                'task_id': task_id,
+                'status': {'$in': task_prev_statuses(status)},
+            }
+            if instance_id:
+                filter_query['instance_id'] = instance_id
+            ops.append(pymongo.UpdateOne(filter_query, self._update_query(action, t, task)))
+            counters.move(task, task['status'], status)
+            ret = {'task_id': task_id, 'code': 200, 'reason': ''}
+            results.append(ret)
+            op_results.append((ret, status))
+
+        if ops:
+            bulk_ret = await self.db.tasks.bulk_write(ops, ordered=False)
+            if bulk_ret.modified_count == len(ops):
+                await counters.apply()
+            else:
+                # some tasks changed underneath us, so check which ones
+                logger.info('bulk transitions: %d ops, %d modified', len(ops), bulk_ret.modified_count)
+                statuses = {}
+                changed_ids = [ret['task_id'] for ret, _ in op_results]
+                async for row in self.db.tasks.find({'task_id': {'$in': changed_ids}}, projection={'_id': False, 'task_id': True, 'status': True}):
+                    statuses[row['task_id']] = row['status']
+                for ret, status in op_results:
+                    if statuses.get(ret['task_id'], None) != status:
+                        ret['code'] = 400
+                        ret['reason'] = 'Bad state transition for status'
+                for dataset_id in counters.dataset_ids:
+                    await rebuild_task_counters(self.db, dataset_id)
+
+        self.write({'results': results})
+        self.finish()
+
+
+class TasksActionsBulkPriorityHandler(APIBase):
+    """
+    Set the priority of many tasks at once.
+    """
+    @authorization(roles=['admin', 'system'])
+    async def post(self):
+        """
+        Set many task priorities in a single unordered bulk write.
+
+        Results are reported for each task, using http status codes:
+
+        * 200: success
+        * 400: invalid priority
+        * 404: task not found
+
+        Body args (json):
+            priorities (dict): {<task_id>: <priority>}
+
+        Returns:
+            dict: {'results': {<task_id>: {'code': <int>, 'reason': <str>}}}
+        """
+        data = json.loads(self.request.body)
+        if (not data) or not isinstance(data.get('priorities', None), dict):
+            raise tornado.web.HTTPError(400, reason='Missing priorities in body')
+        priorities = data['priorities']
+        if len(priorities) > 10000:
+            raise tornado.web.HTTPError(400, reason='Too many priorities specified (limit: 10k)')
+
+        results: dict[str, dict[str, Any]] = {}
+        valid = {}
+        for task_id, priority in priorities.items():
+            if isinstance(priority, bool) or not isinstance(priority, (int, float)):
+                results[task_id] = {'code': 400, 'reason': 'Invalid priority'}
+            else:
+                valid[task_id] = priority
+
+        found = set()
+        async for row in self.db.tasks.find({'task_id': {'$in': list(valid)}}, projection={'_id': False, 'task_id': True}):
+            found.add(row['task_id'])
+
+        ops = []
+        for task_id, priority in valid.items():
+            if task_id not in found:
+                results[task_id] = {'code': 404, 'reason': 'Task not found'}
+                continue
+            ops.append(pymongo.UpdateOne({'task_id': task_id}, {'$set': {'priority': priority}}))
+            results[task_id] = {'code': 200, 'reason': ''}
+
+        if ops:
+            await self.db.tasks.bulk_write(ops, ordered=False)
+
+        self.write({'results': results})
+        self.finish()
+
+
 class TaskBulkStatusHandler(APIBase):
     """
     Update the status of multiple tasks at once.
@@ -1193,7 +1693,7 @@ class TaskBulkStatusHandler(APIBase):
             'instance_id': '',
         }
 
-        ret = await self.db.tasks.update_many(query, {'$set': update_data})
+        ret = await update_many_with_counters(self.db, query, {'$set': update_data}, status)
         if (not ret) or ret.modified_count < 1:
             self.send_error(404, reason="Tasks not found")
         else:
@@ -1240,7 +1740,7 @@ class DatasetTaskBulkStatusHandler(APIBase):
         if status == 'reset':
             update_data['failures'] = 0
 
-        ret = await self.db.tasks.update_many(query, {'$set': update_data})
+        ret = await update_many_with_counters(self.db, query, {'$set': update_data}, status)
         if (not ret) or ret.modified_count < 1:
             self.send_error(404, reason="Tasks not found")
         else:
@@ -1291,7 +1791,7 @@ class DatasetTaskBulkSuspendHandler(APIBase):
                     raise tornado.web.HTTPError(400, reason='Too many tasks specified (limit: 100k)')
                 query['task_id'] = {'$in': tasks}
 
-        await self.db.tasks.update_many(query, {'$set': update_data})
+        await update_many_with_counters(self.db, query, {'$set': update_data}, 'suspended')
         self.write({})
         self.finish()
 
@@ -1339,7 +1839,7 @@ class DatasetTaskBulkResetHandler(APIBase):
                     raise tornado.web.HTTPError(400, reason='Too many tasks specified (limit: 100k)')
                 query['task_id'] = {'$in': tasks}
 
-        await self.db.tasks.update_many(query, {'$set': update_data})
+        await update_many_with_counters(self.db, query, {'$set': update_data}, TASK_STATUS_START)
         self.write({})
         self.finish()
 
@@ -1388,7 +1888,7 @@ class DatasetTaskBulkHardResetHandler(APIBase):
                     raise tornado.web.HTTPError(400, reason='Too many tasks specified (limit: 100k)')
                 query['task_id'] = {'$in': tasks}
 
-        await self.db.tasks.update_many(query, {'$set': update_data})
+        await update_many_with_counters(self.db, query, {'$set': update_data}, TASK_STATUS_START)
         self.write({})
         self.finish()
 
@@ -18,6 +18,7 @@ from iceprod.common.prom_utils import AsyncMonitor
 from iceprod.s3 import S3, boto3
 from iceprod.util import VERSION_STRING
 
+from .auth import AttrAuthCache
 from .base_handler import IceProdRestConfig
 from .config import get_config
 
@@ -84,7 +85,15 @@ class Server:
         )
         self.indexes = defaultdict(partial(defaultdict, dict))
 
-        kwargs = IceProdRestConfig(rest_config, database=self.db_client.client, s3conn=s3conn)
+        auth_cache = None
+        if config.ATTR_AUTH_CACHE_SIZE > 0 and config.ATTR_AUTH_CACHE_TTL > 0:
+            auth_cache = AttrAuthCache(maxsize=config.ATTR_AUTH_CACHE_SIZE, ttl=config.ATTR_AUTH_CACHE_TTL)
+
+        compression = None
+        if encodings := [e.strip() for e in config.COMPRESSION_ENCODINGS.split(',') if e.strip()]:
+            compression = {'encodings': encodings, 'min_size': config.COMPRESSION_MIN_SIZE}
+
+        kwargs = IceProdRestConfig(rest_config, database=self.db_client.client, s3conn=s3conn, auth_cache=auth_cache, compression=compression)
 
         server = RestServer(debug=config.DEBUG, max_body_size=config.MAX_BODY_SIZE)
 
@@ -8,14 +8,16 @@ import argparse
 import asyncio
 import logging
 import os
-import shutil
 from collections import defaultdict
 from datetime import UTC, datetime, timedelta
+from functools import partial
 from typing import Any
 
 from wipac_dev_tools import from_environment
+from wipac_dev_tools.prometheus_tools import GlobalLabels
 
 from iceprod.client_auth import add_auth_to_argparse, create_rest_client
+from iceprod.common.cleanup import AsyncCleaner
 from iceprod.server.util import str2datetime
 
 logger = logging.getLogger('job_temp_cleaning')
@@ -24,17 +26,15 @@ logger = logging.getLogger('job_temp_cleaning')
 listing = dict[str, list[str]]
 
 
-def list_dataset_job_dirs_fs(path: str, *, prefix: str | None = None) -> listing:
+async def list_dataset_job_dirs_fs(cleaner: AsyncCleaner, path: str, *, prefix: str | None = None) -> listing:
     dataset_dirs = defaultdict(list)
     if prefix:
         path = os.path.join(path, prefix)
-        dataset_dirs[prefix] = os.listdir(path)
+        dataset_dirs[prefix] = [e.path.name for e in await cleaner.scandir(path) or []]
     else:
-        dirs = os.listdir(path)
-        for d in dirs:
-            p = os.path.join(path, d)
-            if os.path.isdir(p):
-                dataset_dirs[d] = os.listdir(p)
+        for d in await cleaner.scandir(path) or []:
+            if d.is_dir:
+                dataset_dirs[d.path.name] = [e.path.name for e in await cleaner.scandir(d.path) or []]
     return dataset_dirs
 
 
@@ -144,6 +144,8 @@ def main():
     add_auth_to_argparse(parser)
     parser.add_argument('-d', '--dataset', type=str, help='dataset num (optional)')
     parser.add_argument('--site-temp', default=config['SITE_TEMP'], help='site temp location')
+    parser.add_argument('--parallel', type=int, default=16, help='max parallel deletions')
+    parser.add_argument('--time-budget', type=float, default=None, help='max time to spend deleting, in seconds (optional)')
     parser.add_argument('--log-level', default='info', help='log level')
     parser.add_argument('--debug', default=False, action='store_true', help='debug enabled')
 
@@ -156,13 +158,18 @@ def main():
 
     if os.path.exists(args.site_temp):
         logging.info('using local filesystem')
-        listdir = list_dataset_job_dirs_fs
-        rmtree = shutil.rmtree
+        cleaner = AsyncCleaner(max_workers=args.parallel, time_budget=args.time_budget, prometheus=GlobalLabels({'type': 'job_temp_cleaning'}))
+        listdir = partial(list_dataset_job_dirs_fs, cleaner)
+        rmtree = cleaner.rmtree
     else:
         raise RuntimeError('unknown type of scratch')
 
+    async def clean():
+        async with cleaner.cycle():
+            await run(rest_client, args.site_temp, list_dirs=listdir, rmtree=rmtree, dataset=args.dataset, debug=args.debug)
+
     logging.info('temp dir: %r', args.site_temp)
-    asyncio.run(run(rest_client, args.site_temp, list_dirs=listdir, rmtree=rmtree, dataset=args.dataset, debug=args.debug))
+    asyncio.run(clean())
 
 
 if __name__ == '__main__':
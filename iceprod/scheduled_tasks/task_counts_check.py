@@ -0,0 +1,58 @@
+"""
+Check task counters for drift.
+
+Compare the incrementally maintained task counters of each active
+dataset against the tasks themselves, and repair any drift.
+"""
+
+import argparse
+import asyncio
+import logging
+
+from iceprod.client_auth import add_auth_to_argparse, create_rest_client
+
+logger = logging.getLogger('task_counts_check')
+
+#: dataset statuses where task counts can change
+DATASET_STATUS = ('processing', 'suspended', 'errors')
+
+
+async def run(rest_client, debug=False):
+    """
+    Actual runtime / loop.
+
+    Args:
+        rest_client (:py:class:`iceprod.core.rest_client.Client`): rest client
+        debug (bool): debug flag to propagate exceptions
+    """
+    datasets = await rest_client.request('GET', '/dataset_summaries/status')
+    dataset_ids = [d for status in DATASET_STATUS for d in datasets.get(status, [])]
+    for dataset_id in dataset_ids:
+        try:
+            ret = await rest_client.request('POST', f'/datasets/{dataset_id}/task_counts/rebuild')
+            if ret.get('drift', {}):
+                logger.warning('dataset %s task counter drift repaired: %r', dataset_id, ret['drift'])
+        except Exception:
+            logger.error('error checking dataset %s task counters', dataset_id, exc_info=True)
+            if debug:
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a scheduled task once')
+    add_auth_to_argparse(parser)
+    parser.add_argument('--log-level', default='info', help='log level')
+    parser.add_argument('--debug', default=False, action='store_true', help='debug enabled')
+
+    args = parser.parse_args()
+
+    logformat = '%(asctime)s %(levelname)s %(name)s %(module)s:%(lineno)s - %(message)s'
+    logging.basicConfig(format=logformat, level=getattr(logging, args.log_level.upper()))
+
+    rest_client = create_rest_client(args)
+
+    asyncio.run(run(rest_client, debug=args.debug))
+
+
+if __name__ == '__main__':
+    main()
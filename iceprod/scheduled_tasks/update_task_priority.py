@@ -7,7 +7,7 @@ import asyncio
 import logging
 
 from iceprod.client_auth import add_auth_to_argparse, create_rest_client
-from iceprod.server.priority import Priority
+from iceprod.server.priority import Priority, update_task_prios
 
 logger = logging.getLogger('update_task_priority')
 
@@ -72,18 +72,13 @@ async def run(rest_client, dataset_id=None, status=None, debug=False):
         logger.warning(f'len(tasks2) = {len(tasks2)}')
 
         # update priorities
-        futures = set()
-        for task in tasks2:
-            if len(futures) >= 20:
-                done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
-                futures = pending
-            p = await prio.get_task_prio(task['dataset_id'], task['task_id'])
-            logger.info('updating priority for %s.%s = %.4f', task['dataset_id'], task['task_id'], p)
-            t = asyncio.create_task(rest_client.request('PATCH', f'/tasks/{task["task_id"]}', {'priority': p}))
-            futures.add(t)
-        while futures:
-            done, pending = await asyncio.wait(futures)
-            futures = pending
+        prios = await prio.get_task_prios((task['dataset_id'], task['task_id']) for task in tasks2)
+        priorities = {}
+        for task, p in zip(tasks2, prios):
+            logger.debug('updating priority for %s.%s = %.4f', task['dataset_id'], task['task_id'], p)
+            priorities[task['task_id']] = p
+        num = await update_task_prios(rest_client, priorities)
+        logger.info('updated priority for %d tasks', num)
 
     except Exception:
         logger.error('error updating task priority', exc_info=True)
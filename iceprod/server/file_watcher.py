@@ -0,0 +1,177 @@
+"""
+Wait for files to change.
+
+Uses inotify on Linux, and falls back to polling file stats elsewhere.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import time
+from pathlib import Path
+
+logger = logging.getLogger('file_watcher')
+
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_inotify()
+
+
+class FileWatcher:
+    """
+    Wait for any of a set of files to change.
+
+    Changes are latched until `clear` is called, so a change that happens
+    while the caller is busy is not lost::
+
+        while True:
+            watcher.clear()
+            process_files()
+            await watcher.wait(timeout=60)
+
+    Args:
+        poll_interval: seconds between checks when polling
+        use_inotify: use inotify if available
+    """
+    def __init__(self, poll_interval: float = .5, use_inotify: bool = True):
+        self.poll_interval = poll_interval
+        self._changed = asyncio.Event()
+        self._watches: dict[str, int] = {}
+        self._stats: dict[str, tuple[int, int] | None] = {}
+        self._fd: int | None = None
+        if use_inotify and _libc:
+            fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                logger.info('inotify unavailable, polling instead: %s', os.strerror(ctypes.get_errno()))
+            else:
+                self._fd = fd
+
+    @property
+    def inotify(self) -> bool:
+        """Is inotify in use?"""
+        return self._fd is not None
+
+    def add(self, path: str | Path):
+        """Start watching a file"""
+        path = str(path)
+        if path in self._watches or path in self._stats:
+            return
+        if self._fd is not None:
+            wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), IN_WATCH_MASK)
+            if wd >= 0:
+                self._watches[path] = wd
+                return
+            logger.info('cannot inotify %s, polling instead: %s', path, os.strerror(ctypes.get_errno()))
+        self._stats[path] = self._stat(path)
+
+    def remove(self, path: str | Path):
+        """Stop watching a file"""
+        path = str(path)
+        if (wd := self._watches.pop(path, None)) is not None and self._fd is not None:
+            # fails harmlessly if the file is already gone
+            _libc.inotify_rm_watch(self._fd, wd)
+        self._stats.pop(path, None)
+
+    def close(self):
+        """Stop watching all files"""
+        if self._fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._fd)
+            except RuntimeError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+        self._watches.clear()
+        self._stats.clear()
+
+    def clear(self):
+        """
+        Reset the changed state.
+
+        Call this before reading the files, so any later change wakes up `wait`.
+        """
+        self._changed.clear()
+        if self._fd is not None:
+            self._drain()
+        for path in self._stats:
+            self._stats[path] = self._stat(path)
+
+    @staticmethod
+    def _stat(path: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _poll(self):
+        for path, old in self._stats.items():
+            new = self._stat(path)
+            if new != old:
+                self._stats[path] = new
+                self._changed.set()
+
+    def _drain(self):
+        # which file changed does not matter, so discard the events
+        try:
+            while os.read(self._fd, 65536):  # type: ignore
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_inotify(self):
+        self._drain()
+        self._changed.set()
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """
+        Wait for a change to any watched file.
+
+        Args:
+            timeout: max seconds to wait
+
+        Returns:
+            bool: True if a file changed, False on timeout
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        if self._fd is not None:
+            asyncio.get_running_loop().add_reader(self._fd, self._read_inotify)
+        try:
+            while not self._changed.is_set():
+                self._poll()
+                if self._changed.is_set():
+                    break
+                wait_time = self.poll_interval if self._stats else None
+                if end is not None:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    wait_time = remaining if wait_time is None else min(wait_time, remaining)
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=wait_time)
+                except TimeoutError:
+                    pass
+        finally:
+            if self._fd is not None:
+                asyncio.get_running_loop().remove_reader(self._fd)
+        return self._changed.is_set()
@@ -10,6 +10,7 @@ import logging
 import os
 import socket
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from enum import StrEnum
 from pathlib import Path
@@ -31,7 +32,7 @@ from iceprod.core import functions
 from iceprod.core.config import Dataset, Job, Task
 from iceprod.core.defaults import add_default_options
 from iceprod.core.resources import Resources, rounded_requirements
-from iceprod.server.priority import Priority
+from iceprod.server.priority import Priority, PriorityCache
 from iceprod.server.states import JOB_STATUS_START
 from iceprod.server.util import nowstr
 from iceprod.util import VERSION_STRING
@@ -63,6 +64,18 @@ class BaseGrid:
     Do not use this class directly.  Use one of the plugins.
     """
 
+    #: max time to wait for more task actions before sending a batch, in seconds
+    TASK_ACTION_BATCH_DELAY = .1
+
+    #: task action name: single request method and url
+    TASK_ACTION_URLS = {
+        'queued': ('PUT', '/tasks/{}/status'),
+        'processing': ('POST', '/tasks/{}/task_actions/processing'),
+        'reset': ('POST', '/tasks/{}/task_actions/reset'),
+        'failed': ('POST', '/tasks/{}/task_actions/failed'),
+        'complete': ('POST', '/tasks/{}/task_actions/complete'),
+    }
+
     def __init__(self, cfg, rest_client, cred_client):
         self.cfg = cfg
         self.rest_client = rest_client
@@ -100,6 +113,19 @@ class BaseGrid:
         # dataset lookup cache
         self.dataset_cache = TTLCache(maxsize=100, ttl=60)
 
+        # dataset priority cache, refreshed incrementally
+        self.priority_cache = PriorityCache(self.rest_client)
+
+        # task action batching
+        self.task_action_batch_size = queue_cfg.get('task_action_batch_size', 0)
+        self._task_actions: list[tuple[dict[str, Any], asyncio.Future]] = []
+        self._task_actions_timer: asyncio.TimerHandle | None = None
+        self._task_actions_sending: set[asyncio.Task] = set()
+
+        # log uploads: files are read in a thread pool, and large files go directly to S3
+        self.log_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='grid-logs')
+        self.log_s3_size = queue_cfg.get('log_s3_size', 1000000)
+
         i = Info('iceprod', 'IceProd information')
         i.info({
             'name': str(self.site),
@@ -148,8 +174,8 @@ class BaseGrid:
 
     @cached(TTLCache(10, 900), key=lambda _: 'self')  # ty: ignore
     async def _get_priority_object(self) -> Priority:
-        p = Priority(rest_client=self.rest_client)
-        await p._populate_dataset_cache()
+        p = Priority(rest_client=self.rest_client, cache=self.priority_cache)
+        await p.refresh()
         return p
 
     @AsyncPromWrapper(lambda self: self.prometheus.counter('iceprod_grid_queue_tasks', 'IceProd grid tasks queued', labels=['step'], finalize=False))
@@ -345,25 +371,145 @@ class BaseGrid:
 
     # Task Actions #
 
-    async def _upload_log(self, task: GridTask, name: str, data: str):
+    async def _task_action(self, task: GridTask, action: str, args: dict[str, Any]):
         """
-        Upload a log to the IceProd API.
+        Send a task action to the IceProd API.
+
+        If `task_action_batch_size` is set, concurrent actions are
+        collected and sent in bulk requests.  Errors are raised the same
+        way for both paths.
 
         Args:
             task: IceProd task info
-            name: log name
-            data: log text data
+            action: action name (queued|processing|reset|failed|complete)
+            args: action args
+
+        Raises:
+            requests.exceptions.HTTPError: on failure
         """
-        args = {
-            'dataset_id': task.dataset_id,
-            'task_id': task.task_id,
-            'name': name,
-            'data': data,
-        }
+        if self.task_action_batch_size <= 0:
+            method, url = self.TASK_ACTION_URLS[action]
+            if action == 'queued':
+                args = dict(args, status='queued')
+            await self.rest_client.request(method, url.format(task.task_id), args)
+            return
+
+        if any(t['task_id'] == task.task_id for t, _ in self._task_actions):
+            # keep multiple actions for the same task in separate batches
+            self._send_task_actions()
+        fut = asyncio.get_running_loop().create_future()
+        self._task_actions.append(({'task_id': task.task_id, 'action': action, **args}, fut))
+        if len(self._task_actions) >= self.task_action_batch_size:
+            self._send_task_actions()
+        elif not self._task_actions_timer:
+            self._task_actions_timer = asyncio.get_running_loop().call_later(self.TASK_ACTION_BATCH_DELAY, self._send_task_actions)
+
+        code, reason = await fut
+        if code != 200:
+            response = requests.Response()
+            response.status_code = code
+            response.reason = reason
+            raise requests.exceptions.HTTPError(f'{code} Error: {reason} for task {task.task_id}', response=response)
+
+    def _send_task_actions(self):
+        """Send the current batch of task actions in the background"""
+        if self._task_actions_timer:
+            self._task_actions_timer.cancel()
+            self._task_actions_timer = None
+        batch, self._task_actions = self._task_actions, []
+        if batch:
+            t = asyncio.create_task(self._bulk_task_actions(batch))
+            self._task_actions_sending.add(t)
+            t.add_done_callback(self._task_actions_sending.discard)
+
+    @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_task_actions_bulk', 'IceProd grid bulk task action calls', buckets=HistogramBuckets.MINUTE))
+    async def _bulk_task_actions(self, batch: list[tuple[dict[str, Any], asyncio.Future]]):
+        """
+        Send a batch of task actions in one request, and resolve
+        each action with its (code, reason) result.
+
+        A batch has at most one action per task, so results are matched
+        by task_id.  Actions without a result fail.
+        """
+        try:
+            ret = await self.rest_client.request('POST', '/task_actions/bulk_transitions', {'transitions': [t for t, _ in batch]})
+            results = {r['task_id']: r for r in ret['results'] if isinstance(r, dict) and 'task_id' in r}
+            for t, fut in batch:
+                if fut.done():
+                    continue
+                if r := results.get(t['task_id']):
+                    fut.set_result((r['code'], r.get('reason', '')))
+                else:
+                    fut.set_exception(Exception(f'missing bulk transition result for task {t["task_id"]}'))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    async def _upload_logs(self, task: GridTask, logs: dict[str, str | Path]):
+        """
+        Upload several logs to the IceProd API in one request.
+
+        Log files are read in a thread pool.  Files larger than
+        `log_s3_size` are streamed directly to S3 instead, then the
+        pending log entry is confirmed, or deleted if the upload failed.
+
+        Args:
+            task: IceProd task info
+            logs: dict of log name: log text data or path to log file
+        """
+        loop = asyncio.get_running_loop()
+        entries: list[dict[str, str | None]] = []
+        s3_paths: dict[int, Path] = {}
+        for name, data in logs.items():
+            entry = {
+                'dataset_id': task.dataset_id,
+                'task_id': task.task_id,
+                'name': name,
+            }
+            if isinstance(data, Path):
+                try:
+                    size = (await loop.run_in_executor(self.log_executor, data.stat)).st_size
+                    if self.log_s3_size and size > self.log_s3_size:
+                        s3_paths[len(entries)] = data
+                    else:
+                        entry['data'] = await loop.run_in_executor(self.log_executor, data.read_text)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    logger.warning('cannot read log %s', data, exc_info=True)
+                    continue
+            else:
+                entry['data'] = data
+            entries.append(entry)
+        if not entries:
+            return
+
         try:
-            await self.rest_client.request('POST', '/logs', args)
+            ret = await self.rest_client.request('POST', '/logs/bulk', {'logs': entries})
         except requests.exceptions.HTTPError:
-            logger.warning('cannot upload log', exc_info=True)
+            logger.warning('cannot upload logs', exc_info=True)
+            return
+
+        for i, path in s3_paths.items():
+            log_id = ret['results'][i]['log_id']
+            method = 'PATCH'
+            try:
+                await loop.run_in_executor(self.log_executor, self._put_log_file, ret['results'][i]['upload_url'], path)
+            except Exception:
+                logger.warning('cannot upload log %s to S3', path, exc_info=True)
+                method = 'DELETE'
+            try:
+                await self.rest_client.request(method, f'/logs/{log_id}')
+            except requests.exceptions.HTTPError:
+                logger.warning('cannot finish pending log %s', log_id, exc_info=True)
+
+    @staticmethod
+    def _put_log_file(url: str, path: Path):
+        """Stream a log file to a presigned url.  This is blocking."""
+        with path.open('rb') as f:
+            r = requests.put(url, data=f, timeout=600)
+        r.raise_for_status()
 
     async def _upload_stats(self, task: GridTask, stats: dict):
         """
@@ -406,11 +552,10 @@ class BaseGrid:
             raise RuntimeError("Either task_id or instance_id is empty")
 
         args = {
-            'status': 'queued',
             'instance_id': task.instance_id,
         }
         try:
-            await self.rest_client.request('PUT', f'/tasks/{task.task_id}/status', args)
+            await self._task_action(task, 'queued', args)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code != 404:
                 raise
@@ -433,7 +578,7 @@ class BaseGrid:
         if site:
             args['site'] = site
         try:
-            await self.rest_client.request('POST', f'/tasks/{task.task_id}/task_actions/processing', args)
+            await self._task_action(task, 'processing', args)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code != 404:
                 raise
@@ -461,13 +606,13 @@ class BaseGrid:
         if reason:
             args['reason'] = reason
         try:
-            await self.rest_client.request('POST', f'/tasks/{task.task_id}/task_actions/reset', args)
+            await self._task_action(task, 'reset', args)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code != 404:
                 raise
         else:
             if reason:
-                await self._upload_log(task, 'stdlog', reason)
+                await self._upload_logs(task, {'stdlog': reason})
 
     @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_task_failure', 'IceProd grid.task_failure calls', buckets=HistogramBuckets.MINUTE))
     async def task_failure(self, task: GridTask, reason: str | None = None, stats: dict | None = None, stdout: Path | None = None, stderr: Path | None = None):
@@ -500,19 +645,22 @@ class BaseGrid:
             if site := stats.get('site'):
                 args['site'] = site
         try:
-            await self.rest_client.request('POST', f'/tasks/{task.task_id}/task_actions/failed', args)
+            await self._task_action(task, 'failed', args)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code != 404:
                 raise
         else:
-            if stats is not None:
-                await self._upload_stats(task, stats)
-            if stdout and stdout.exists():
-                await self._upload_log(task, 'stdout', stdout.read_text())
-            if stderr and stderr.exists():
-                await self._upload_log(task, 'stderr', stderr.read_text())
+            logs: dict[str, str | Path] = {}
+            if stdout:
+                logs['stdout'] = stdout
+            if stderr:
+                logs['stderr'] = stderr
             if reason:
-                await self._upload_log(task, 'stdlog', reason)
+                logs['stdlog'] = reason
+            async with asyncio.TaskGroup() as tg:
+                if stats is not None:
+                    tg.create_task(self._upload_stats(task, stats))
+                tg.create_task(self._upload_logs(task, logs))
 
     @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_task_success', 'IceProd grid.task_success calls', buckets=HistogramBuckets.MINUTE))
     async def task_success(self, task: GridTask, stats: dict | None = None, stdout: Path | None = None, stderr: Path | None = None):
@@ -543,14 +691,17 @@ class BaseGrid:
                 args['time_used'] = resources['time']*3600.
 
         try:
-            await self.rest_client.request('POST', f'/tasks/{task.task_id}/task_actions/complete', args)
+            await self._task_action(task, 'complete', args)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code != 404:
                 raise
         else:
-            if stats is not None:
-                await self._upload_stats(task, stats)
-            if stdout and stdout.exists():
-                await self._upload_log(task, 'stdout', stdout.read_text())
-            if stderr and stderr.exists():
-                await self._upload_log(task, 'stderr', stderr.read_text())
+            logs: dict[str, str | Path] = {}
+            if stdout:
+                logs['stdout'] = stdout
+            if stderr:
+                logs['stderr'] = stderr
+            async with asyncio.TaskGroup() as tg:
+                if stats is not None:
+                    tg.create_task(self._upload_stats(task, stats))
+                tg.create_task(self._upload_logs(task, logs))
@@ -12,18 +12,20 @@ import logging
 import os
 import re
 import shutil
-import stat
 import subprocess
 import time
-from collections import Counter, defaultdict
-from collections.abc import Iterable
+from collections import Counter, defaultdict, deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
+from functools import partial
 from pathlib import Path
-from typing import Any, Generator, NamedTuple
+from typing import Any, Generator, NamedTuple, TypeVar
 
 import classad2 as classad  # type: ignore
 import htcondor2 as htcondor  # type: ignore
+from cachetools import LRUCache
 from wipac_dev_tools.prometheus_tools import (
     AsyncPromTimer,
     AsyncPromWrapper,
@@ -32,11 +34,13 @@ from wipac_dev_tools.prometheus_tools import (
     PromWrapper,
 )
 
+from iceprod.common.cleanup import AsyncCleaner
 from iceprod.common.prom_utils import HistogramBuckets
-from iceprod.core.config import Task
-from iceprod.core.exe import Data, Transfer, WriteToScript
+from iceprod.core.config import Dataset, Task
+from iceprod.core.exe import ConfigParser, Data, Transfer, WriteToScript
 from iceprod.server import grid
 from iceprod.server.config import IceProdConfig
+from iceprod.server.file_watcher import FileWatcher
 from iceprod.server.util import str2datetime
 
 logger = logging.getLogger('condor')
@@ -56,6 +60,47 @@ def check_output_clean_env(*args, **kwargs):
     return subprocess.check_output(*args, **kwargs)
 
 
+T = TypeVar('T')
+
+
+async def run_in_executor(executor: Executor, fn: Callable[..., T], *args, timeout: float | None = None, **kwargs) -> T:
+    """
+    Run a blocking call in an executor, keeping the event loop responsive.
+
+    On timeout a `TimeoutError` is raised, but the call itself cannot be
+    interrupted, so it keeps its executor thread busy until it returns.
+
+    Args:
+        executor: the executor to run in
+        fn: the blocking function
+        timeout: max seconds to wait for the result
+    """
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(executor, partial(fn, *args, **kwargs)), timeout=timeout)
+
+
+def read_jel(filename: str, events: Any = None) -> tuple[Any, list]:
+    """
+    Read all new events from a Job Event Log.  This is blocking.
+
+    Args:
+        filename: JEL filename
+        events: JEL events iterator, or None to open the JEL
+
+    Returns:
+        tuple: (events iterator, list of new events)
+    """
+    if events is None:
+        events = htcondor.JobEventLog(filename).events(0)
+    ret: list = []
+    try:
+        # events read before an error are kept
+        ret.extend(events)
+    except Exception:
+        logger.warning('error reading condor log %s', filename, exc_info=True)
+    return events, ret
+
+
 @enum.unique
 class JobStatus(enum.StrEnum):
     IDLE = enum.auto()       # job is waiting in the queue
@@ -184,8 +229,157 @@ class CondorJobId(NamedTuple):
         return f'{self.cluster_id}.{self.proc_id}'
 
 
+class CondorJobs(dict[CondorJobId, CondorJob]):
+    """
+    A dict of jobs, with an index of jobs by submit dir.
+
+    Jobs can get their submit dir after being added, so call `reindex`
+    whenever a job's submit dir changes.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._submit_dirs: dict[CondorJobId, Path] = {}
+        self._jobs_by_submit_dir: defaultdict[Path, set[CondorJobId]] = defaultdict(set)
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, job_id: CondorJobId, job: CondorJob):
+        super().__setitem__(job_id, job)
+        self.reindex(job_id)
+
+    def __delitem__(self, job_id: CondorJobId):
+        super().__delitem__(job_id)
+        self._unindex(job_id)
+
+    def update(self, *args, **kwargs):
+        for job_id, job in dict(*args, **kwargs).items():
+            self[job_id] = job
+
+    def pop(self, job_id: CondorJobId, *args):
+        self._unindex(job_id)
+        return super().pop(job_id, *args)
+
+    def clear(self):
+        super().clear()
+        self._submit_dirs.clear()
+        self._jobs_by_submit_dir.clear()
+
+    def _unindex(self, job_id: CondorJobId):
+        if (submit_dir := self._submit_dirs.pop(job_id, None)) is not None:
+            job_ids = self._jobs_by_submit_dir[submit_dir]
+            job_ids.discard(job_id)
+            if not job_ids:
+                del self._jobs_by_submit_dir[submit_dir]
+
+    def reindex(self, job_id: CondorJobId):
+        """Update the submit dir index for a job"""
+        self._unindex(job_id)
+        if (submit_dir := self[job_id].submit_dir) is not None:
+            self._submit_dirs[job_id] = submit_dir
+            self._jobs_by_submit_dir[submit_dir].add(job_id)
+
+    def get_by_submit_dir(self, submit_dir: Path) -> list[CondorJobId]:
+        """Get the ids of all jobs using a submit dir"""
+        return list(self._jobs_by_submit_dir.get(submit_dir, ()))
+
+
+class QueueDecision(NamedTuple):
+    """The inputs and result of a queue sizing decision"""
+    num: int
+    cap: int
+    idle: int
+    target_idle: float
+    start_rate: float
+    completion_rate: float
+    schedd_latency: float
+
+
+class QueueController:
+    """
+    Adaptive queue sizing.
+
+    Keeps enough idle jobs on the queue to feed the pool for `idle_time`
+    seconds, based on the rate that idle jobs start running and the rate
+    that jobs complete over the last `window` seconds.  Submissions are
+    scaled down when the schedd response time goes above `max_latency`.
+    The result never goes above the hard cap from the static limits.
+
+    Until a full window of events has been observed, the hard cap is used.
+
+    Times are unix timestamps, so recorded job events can be replayed.
+
+    Args:
+        idle_time: seconds of idle jobs to keep on the queue
+        min_idle: min number of idle jobs to keep on the queue
+        max_latency: schedd response time (seconds) to start backing off
+        window: seconds of events to measure rates over
+    """
+    #: weight of the newest schedd response time in the moving average
+    LATENCY_WEIGHT = .2
+
+    def __init__(self, idle_time: float = 600., min_idle: int = 10, max_latency: float = 10., window: float = 900., now: float | None = None):
+        self.idle_time = idle_time
+        self.min_idle = min_idle
+        self.max_latency = max_latency
+        self.window = window
+        self.start_time = time.time() if now is None else now
+        self.starts: deque[float] = deque()
+        self.completions: deque[float] = deque()
+        self.schedd_latency = 0.
+
+    def observe_start(self, timestamp: float | None = None):
+        """Record an idle job starting to run"""
+        self.starts.append(time.time() if timestamp is None else timestamp)
+
+    def observe_completion(self, timestamp: float | None = None):
+        """Record a job leaving the queue"""
+        self.completions.append(time.time() if timestamp is None else timestamp)
+
+    def observe_latency(self, seconds: float):
+        """Record a schedd response time"""
+        self.schedd_latency += self.LATENCY_WEIGHT * (seconds - self.schedd_latency)
+
+    def _rate(self, events: deque[float], now: float) -> float:
+        while events and events[0] < now - self.window:
+            events.popleft()
+        return len(events) / self.window
+
+    def size(self, idle: int, cap: int, now: float | None = None) -> QueueDecision:
+        """
+        Decide how many jobs to submit.
+
+        Args:
+            idle: number of idle jobs on the queue
+            cap: max number of jobs to submit, from the static limits
+            now: current time
+
+        Returns:
+            QueueDecision: the decision and its inputs
+        """
+        if now is None:
+            now = time.time()
+        cap = max(0, cap)
+        start_rate = self._rate(self.starts, now)
+        completion_rate = self._rate(self.completions, now)
+        if now - self.start_time < self.window:
+            return QueueDecision(cap, cap, idle, float('nan'), start_rate, completion_rate, self.schedd_latency)
+
+        # completions also free up slots, which idle jobs should be ready for
+        demand = max(start_rate, completion_rate)
+        target_idle = max(float(self.min_idle), demand * self.idle_time)
+        num = target_idle - idle
+        if self.schedd_latency > self.max_latency:
+            num *= self.max_latency / self.schedd_latency
+        num = int(max(0, min(cap, num)))
+        return QueueDecision(num, cap, idle, target_idle, start_rate, completion_rate, self.schedd_latency)
+
+
 class CondorSubmit:
-    """Factory for submitting HTCondor jobs"""
+    """
+    Factory for submitting HTCondor jobs.
+
+    Schedd methods like `get_jobs` are blocking, so they should be run
+    through `call` to keep them off the event loop.
+    """
     AD_DEFAULTS = {
         'request_cpus': 1,
         'request_gpus': 'UNDEFINED',
@@ -206,10 +400,11 @@ class CondorSubmit:
         'HoldReason', 'RemoveReason', 'Reason', 'MachineAttrGLIDEIN_Site0',
     ] + _GENERIC_ADS
     AD_PROJECTION_QUEUE = ['JobStatus', 'RemotePool', 'RemoteHost'] + _GENERIC_ADS
+    AD_PROJECTION_STATE = ['ClusterId', 'ProcId', 'JobStatus']
     AD_PROJECTION_HISTORY = [
         'JobStatus', 'ExitCode', 'RemoveReason', 'LastHoldReason', 'CpusUsage', 'RemoteSysCpu', 'RemoteUserCpu',
         'GpusUsage', 'GPUsAverageUsage', 'GPUsMemoryUsage', 'ResidentSetSize_RAW', 'DiskUsage_RAW', 'LastRemoteWallClockTime',
-        'LastRemoteHost', 'LastRemotePool', 'MachineAttrGLIDEIN_Site0',
+        'LastRemoteHost', 'LastRemotePool', 'MachineAttrGLIDEIN_Site0', 'CompletionDate',
     ] + _GENERIC_ADS
 
     def __init__(self, cfg: IceProdConfig, submit_dir: Path, credentials_dir: Path, prom_global=None):
@@ -217,6 +412,10 @@ class CondorSubmit:
         self.submit_dir = submit_dir
         self.credentials_dir = credentials_dir
         self.condor_schedd = htcondor.Schedd()
+        # the schedd is not thread safe, so serialize all calls to it
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='condor-schedd')
+        self.timeout = self.cfg['queue'].get('batch_timeout', 300)
+        self.latency_callback: Callable[[float], None] | None = None
         self.prometheus = prom_global if prom_global else GlobalLabels({
             "type": "condor"
         })
@@ -233,9 +432,40 @@ class CondorSubmit:
         # a mapping of url prefix to oauth service name
         self.oauth_service_mapping = self.cfg['oauth_services']
 
+        # per-dataset config parsers and per-task submit file headers,
+        # reused as long as the dataset config object is the same
+        self._cfgparsers: LRUCache[str, ConfigParser] = LRUCache(maxsize=100)
+        self._submit_headers: LRUCache[tuple, tuple[dict, str, str]] = LRUCache(maxsize=100)
+
     def _restart_schedd(self):
         self.condor_schedd = htcondor.Schedd()
 
+    async def call(self, fn: Callable[..., T], *args, latency: bool = True, **kwargs) -> T:
+        """
+        Run a blocking schedd call in the schedd thread.
+
+        Raises `TimeoutError` if the call takes longer than the
+        `batch_timeout` config setting.
+
+        The time spent in the call itself, not waiting for other calls,
+        is reported to `latency_callback` if set.  Bulk queries and submits
+        scale with the number of jobs, so they set `latency=False`.
+
+        Args:
+            fn: the blocking function, such as `self.get_jobs`
+            latency: report the response time to `latency_callback`
+        """
+        if not (latency and self.latency_callback):
+            return await run_in_executor(self.executor, fn, *args, timeout=self.timeout, **kwargs)
+
+        def timed() -> tuple[T, float]:
+            start = time.monotonic()
+            ret = fn(*args, **kwargs)
+            return ret, time.monotonic() - start
+        ret, duration = await run_in_executor(self.executor, timed, timeout=self.timeout)
+        self.latency_callback(duration)
+        return ret
+
     def condor_plugin_discovery(self):
         """Find all available HTCondor transfer plugins, and copy them to the submit_dir"""
         ret = {}
@@ -492,28 +722,40 @@ class CondorSubmit:
 
         return token_transform, block, reqs
 
-    @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_condor_submit', 'IceProd grid condor.submit calls', buckets=HistogramBuckets.MINUTE))
-    @AsyncPromWrapper(lambda self: self.prometheus.histogram('iceprod_grid_condor_schedd_submit', 'IceProd grid htcondor.schedd.submit calls', buckets=HistogramBuckets.MINUTE))
-    async def submit(self, prom_histogram, tasks: list[Task], jel: Path) -> dict[CondorJobId, CondorJob]:
+    def get_cfgparser(self, dataset: Dataset) -> ConfigParser:
         """
-        Submit multiple jobs to Condor as a single batch.
+        Get a config parser for a dataset.
 
-        Assumes that the resource requirements are identical.
+        Creating a parser validates the dataset config, so parsers are
+        cached until the dataset config changes.
+        """
+        parser = self._cfgparsers.get(dataset.dataset_id)
+        if parser is None or parser.config is not dataset.config:
+            parser = ConfigParser(dataset)
+            self._cfgparsers[dataset.dataset_id] = parser
+        return parser
+
+    def get_submit_header(self, task: Task, jel: Path, oauth_block: str) -> tuple[str, str]:
+        """
+        Get the common part of the submit file for a dataset task.
+
+        The header is cached until the dataset config changes.
 
         Args:
-            tasks: IceProd Tasks to submit
+            task: a task with the dataset and task config
             jel: common job event log
+            oauth_block: oauth submit lines
 
         Returns:
-            dict of new jobs
+            tuple: (submit file header, base requirements expression)
         """
-        jel_dir = jel.parent
-        transfer_plugin_str = ';'.join(f'{k}={v}' for k,v in self.transfer_plugins.items())
+        key = (task.dataset.dataset_id, task.task_index, str(jel), oauth_block)
+        if (cached := self._submit_headers.get(key)) and cached[0] is task.dataset.config:
+            return cached[1], cached[2]
 
-        # the tasks all have the same basic config, so just get the first one
-        task_config = tasks[0].get_task_config()
+        transfer_plugin_str = ';'.join(f'{k}={v}' for k,v in self.transfer_plugins.items())
 
-        oauth_file_transform, oauth_block, oauth_reqs = self.oauth_submit(tasks[0])
+        task_config = task.get_task_config()
 
         submitfile = f"""
 output = $(initialdir)/condor.out
@@ -522,7 +764,7 @@ log = {jel}
 
 notification = never
 job_ad_information_attrs = {" ".join(self.AD_INFO)}
-batch_name = Dataset {tasks[0].dataset.dataset_num}
+batch_name = Dataset {task.dataset.dataset_num}
 
 +IsIceProdJob = True
 +IceProdSite = "{self.cfg["queue"].get("site", "unknown")}"
@@ -572,10 +814,44 @@ transfer_output_remaps = $(outremaps)
             else:
                 submitfile += f'+{k} = {v}\n'
 
+        for k,v in task_config['batchsys'].get('condor', {}).items():
+            if k.lower() == 'requirements':
+                reqs = f'({reqs}) && ({v})' if reqs else f'({v})'
+                break
+
+        self._submit_headers[key] = (task.dataset.config, submitfile, reqs)
+        return submitfile, reqs
+
+    @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_condor_submit', 'IceProd grid condor.submit calls', buckets=HistogramBuckets.MINUTE))
+    @AsyncPromWrapper(lambda self: self.prometheus.histogram('iceprod_grid_condor_schedd_submit', 'IceProd grid htcondor.schedd.submit calls', buckets=HistogramBuckets.MINUTE))
+    async def submit(self, prom_histogram, tasks: list[Task], jel: Path) -> dict[CondorJobId, CondorJob]:
+        """
+        Submit multiple jobs to Condor as a single batch.
+
+        Assumes that the resource requirements are identical.
+
+        Args:
+            tasks: IceProd Tasks to submit
+            jel: common job event log
+
+        Returns:
+            dict of new jobs
+        """
+        jel_dir = jel.parent
+
+        # the tasks all have the same basic config, so just get the first one
+        task_config = tasks[0].get_task_config()
+
+        oauth_file_transform, oauth_block, oauth_reqs = self.oauth_submit(tasks[0])
+
+        submitfile, reqs = self.get_submit_header(tasks[0], jel, oauth_block)
+        cfgparser = self.get_cfgparser(tasks[0].dataset)
+
         jobset = []
+        reqs_macros: dict[str, str] = {}
         for task in tasks:
             submit_dir = self.create_submit_dir(task, jel_dir)
-            script = WriteToScript(task=task, workdir=submit_dir)
+            script = WriteToScript(task=task, workdir=submit_dir, cfgparser=cfgparser)
             executable = await script.convert(transfer=True)
             logger.debug('running task with exe %r', executable)
 
@@ -596,20 +872,17 @@ transfer_output_remaps = $(outremaps)
             if container != 'Undefined':
                 container = f'"{container}"'
 
-            reqs2 = reqs
-            for k,v in task_config['batchsys'].get('condor', {}).items():
-                if k.lower() == 'requirements':
-                    reqs2 = f'({reqs}) && ({v})' if reqs else f'({v})'
-                    break
-
-            if reqs2:
-                ads['requirements'] = f'{ads["requirements"]} && {reqs2}' if ads.get('requirements', None) else reqs2
+            if reqs:
+                ads['requirements'] = f'{ads["requirements"]} && {reqs}' if ads.get('requirements', None) else reqs
             # ignore oauth_reqs for now
             # todo: when we actually start using condor file transfer, this needs to be re-enabled
             # if oauth_reqs:
             #     ads['requirements'] = f'{ads["requirements"]} && {oauth_reqs}' if ads.get('requirements', None) else oauth_reqs
-            if ads['requirements']:
-                submitfile += f'reqs{task.task_id} = {ads["requirements"]}\n'
+            # tasks in the same resource bin share a requirements macro
+            req_expr: str = ads['requirements']  # type: ignore
+            if req_expr and req_expr not in reqs_macros:
+                reqs_macros[req_expr] = f'reqs{len(reqs_macros)}'
+                submitfile += f'{reqs_macros[req_expr]} = {req_expr}\n'
             # stringify everything, quoting the real strings
             jobset.append({
                 'datasetid': f'"{task.dataset.dataset_id}"',
@@ -626,7 +899,7 @@ transfer_output_remaps = $(outremaps)
                 'memory': f'{ads["request_memory"]}',
                 'disk': f'{ads["request_disk"]}',
                 'time': f'{ads["+OriginalTime"]}',
-                'reqs': f'reqs{task.task_id}',
+                'reqs': reqs_macros.get(req_expr, 'reqsnone'),
                 'gpujoblength': f'"{ads["+GPUJobLength"]}"',
                 'isresumable': f'{ads.get("+is_resumable", False)}',
                 'jobduration': f'"{ads["+JobDurationCategory"]}"',
@@ -646,12 +919,7 @@ transfer_output_remaps = $(outremaps)
         logger.debug("submitfile:\n%s", submitfile)
 
         with prom_histogram.time():
-            s = htcondor.Submit(submitfile)
-            try:
-                submit_result = self.condor_schedd.submit(s, count=1, itemdata=s.itemdata())
-            except htcondor.HTCondorException:
-                self._restart_schedd()
-                submit_result = self.condor_schedd.submit(s, count=1, itemdata=s.itemdata())
+            submit_result = await self.call(self._schedd_submit, submitfile, latency=False)
 
         cluster_id = int(submit_result.cluster())
         ret = {}
@@ -664,14 +932,28 @@ transfer_output_remaps = $(outremaps)
             )
         return ret
 
+    def _schedd_submit(self, submitfile: str) -> Any:
+        s = htcondor.Submit(submitfile)
+        try:
+            return self.condor_schedd.submit(s, count=1, itemdata=s.itemdata())
+        except htcondor.HTCondorException:
+            self._restart_schedd()
+            return self.condor_schedd.submit(s, count=1, itemdata=s.itemdata())
+
     @PromTimer(lambda self: self.prometheus.histogram('iceprod_grid_condor_get_jobs', 'IceProd grid condor.get_jobs calls', buckets=HistogramBuckets.MINUTE))
-    def get_jobs(self) -> dict[CondorJobId, CondorJob]:
+    def get_jobs(self, cluster_ids: Iterable[int] | None = None) -> dict[CondorJobId, CondorJob]:
         """
         Get all jobs currently on the condor queue.
+
+        Args:
+            cluster_ids: only get jobs in these clusters
         """
+        constraint = f'IceProdSite =?= "{self.cfg["queue"].get("site", "unknown")}"'
+        if cluster_ids is not None:
+            constraint += ' && member(ClusterId, {' + ', '.join(str(c) for c in sorted(cluster_ids)) + '})'
         ret = {}
         for ad in self.condor_schedd.query(
-            constraint=f'IceProdSite =?= "{self.cfg["queue"].get("site", "unknown")}"',
+            constraint=constraint,
             projection=['ClusterId', 'ProcId'] + self.AD_PROJECTION_QUEUE,
         ):
             job_id = CondorJobId(cluster_id=ad['ClusterId'], proc_id=ad['ProcId'])
@@ -692,17 +974,52 @@ transfer_output_remaps = $(outremaps)
             ret[job_id] = job
         return ret
 
+    @PromTimer(lambda self: self.prometheus.histogram('iceprod_grid_condor_get_job_states', 'IceProd grid condor.get_job_states calls', buckets=HistogramBuckets.MINUTE))
+    def get_job_states(self) -> dict[CondorJobId, JobStatus]:
+        """
+        Get the status of all jobs currently on the condor queue.
+
+        This only projects the job status, so is much cheaper than `get_jobs`.
+        """
+        ret = {}
+        for ad in self.condor_schedd.query(
+            constraint=f'IceProdSite =?= "{self.cfg["queue"].get("site", "unknown")}"',
+            projection=self.AD_PROJECTION_STATE,
+        ):
+            job_id = CondorJobId(cluster_id=ad['ClusterId'], proc_id=ad['ProcId'])
+            status = JobStatus.IDLE
+            if s := ad.get('JobStatus'):
+                status = JobStatus.from_condor_status(s)
+            ret[job_id] = status
+        return ret
+
     @PromTimer(lambda self: self.prometheus.histogram('iceprod_grid_condor_get_history', 'IceProd grid condor.get_history calls', buckets=HistogramBuckets.MINUTE))
-    def get_history(self, since: int | None = None) -> Generator[tuple[CondorJobId, CondorJob], None, None]:
+    def get_history(
+        self,
+        since: int | None = None,
+        before: tuple[int, set[CondorJobId]] | None = None,
+        limit: int = -1,
+    ) -> Generator[tuple[CondorJobId, CondorJob], None, None]:
         """
         Get all jobs currently on the condor history.
 
         Args:
             since: how far back to look in the history (unix time)
+            before: page bound of (CompletionDate, job ids already read at that CompletionDate)
+            limit: max number of jobs to return, or -1 for all
         """
+        constraint = f'IceProdSite =?= "{self.cfg["queue"].get("site", "unknown")}"'
+        if before:
+            completion_date, job_ids = before
+            bound = f'CompletionDate <= {completion_date}'
+            if job_ids:
+                seen = ' || '.join(f'(ClusterId == {j.cluster_id} && ProcId == {j.proc_id})' for j in sorted(job_ids))
+                bound = f'CompletionDate < {completion_date} || (CompletionDate == {completion_date} && !({seen}))'
+            constraint += f' && ({bound})'
         for ad in self.condor_schedd.history(
-            constraint=f'IceProdSite =?= "{self.cfg["queue"].get("site", "unknown")}"',
+            constraint=constraint,
             projection=['ClusterId', 'ProcId'] + self.AD_PROJECTION_HISTORY,
+            match=limit,
             since=classad.ExprTree(f'CompletionDate<{since}') if since else None,  # type: ignore
         ):
             job_id = CondorJobId(cluster_id=ad['ClusterId'], proc_id=ad['ProcId'])
@@ -742,14 +1059,42 @@ class Grid(grid.BaseGrid):
     """HTCondor grid plugin"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.jobs = {}
-        self.jels = {str(filename): htcondor.JobEventLog(str(filename)).events(0) for filename in self.submit_dir.glob('*/*.jel')}
+        self.jobs = CondorJobs()
+        # JEL events iterators, opened on first read
+        self.jels: dict[str, Any] = {str(filename): None for filename in self.submit_dir.glob('*/*.jel')}
+        self.jel_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='condor-jel')
+        self.jel_watcher = FileWatcher(poll_interval=self.cfg['queue'].get('jel_poll_interval', .5))
+        for filename in self.jels:
+            self.jel_watcher.add(filename)
         self.submitter = CondorSubmit(self.cfg, submit_dir=self.submit_dir, credentials_dir=self.credentials_dir, prom_global=self.prometheus)
+        self.queue_controller = None
+        if self.cfg['queue'].get('adaptive_queue', False):
+            self.queue_controller = QueueController(
+                idle_time=self.cfg['queue'].get('adaptive_idle_time', 600),
+                min_idle=self.cfg['queue'].get('adaptive_min_idle', 10),
+                max_latency=self.cfg['queue'].get('adaptive_max_schedd_latency', 10),
+            )
+            self.submitter.latency_callback = self.queue_controller.observe_latency
+        self.cleaner = AsyncCleaner(
+            max_workers=self.cfg['queue'].get('cleanup_workers', 8),
+            time_budget=self.cfg['queue'].get('cleanup_time_budget', 300) or None,
+            prometheus=self.prometheus,
+        )
+
+        # full queue query interval, with cheaper job state queries in between
+        self.check_full_interval = self.cfg['queue'].get('check_full_interval', 3600)
+        self.check_full_time: float | None = None
 
         # save last event.timestamp, on restart only process >= timestamp
         self.last_event_timestamp = 0.
         self.load_timestamp()
 
+        # history high-water mark: latest CompletionDate processed, and the job ids completed at that time
+        self.history_batch_size = self.cfg['queue'].get('history_batch_size', 100)
+        self.history_completion_date = int(self.last_event_timestamp)
+        self.history_job_ids: set[str] = set()
+        self.load_history_hwm()
+
     def load_timestamp(self):
         timestamp_path = self.submit_dir / 'last_event_timestamp'
         if timestamp_path.exists():
@@ -761,6 +1106,22 @@ class Grid(grid.BaseGrid):
         with timestamp_path.open('w') as f:
             f.write(str(self.last_event_timestamp))
 
+    def load_history_hwm(self):
+        hwm_path = self.submit_dir / 'history_hwm.json'
+        if hwm_path.exists():
+            with hwm_path.open('r') as f:
+                data = json.load(f)
+            self.history_completion_date = data['completion_date']
+            self.history_job_ids = set(data['job_ids'])
+
+    def save_history_hwm(self):
+        hwm_path = self.submit_dir / 'history_hwm.json'
+        with hwm_path.open('w') as f:
+            json.dump({
+                'completion_date': self.history_completion_date,
+                'job_ids': sorted(self.history_job_ids),
+            }, f)
+
     async def run(self, forever=True):
         # initial job load
         try:
@@ -850,8 +1211,14 @@ class Grid(grid.BaseGrid):
             prom_counter.labels({'dataset': dataset_num, 'task': task_name, 'success': success}).inc(len(tasks))
 
     @PromWrapper(lambda self: self.prometheus.gauge('iceprod_grid_queue_num', 'IceProd grid queue status gauges', labels=['status'], finalize=False))
-    def get_queue_num(self, prom_counter) -> int:
-        """Determine how many tasks to queue."""
+    @PromWrapper(lambda self: self.prometheus.gauge('iceprod_grid_queue_controller', 'IceProd grid adaptive queue sizing decisions', labels=['value'], finalize=False))
+    def get_queue_num(self, prom_gauge, prom_counter) -> int:
+        """
+        Determine how many tasks to queue.
+
+        The static limits from the config are hard caps.  If adaptive
+        queue sizing is enabled, the `QueueController` decides within them.
+        """
         counts = {s: 0 for s in JobStatus}
         for job in self.jobs.values():
             counts[job.status] += 1
@@ -866,6 +1233,13 @@ class Grid(grid.BaseGrid):
         queue_idle_max = self.cfg['queue']['max_idle_tasks_on_queue'] - idle_jobs
         queue_interval_max = self.cfg['queue']['max_tasks_per_submit']
         queue_num = max(0, min(queue_tot_max, queue_idle_max, queue_interval_max))
+
+        if self.queue_controller:
+            decision = self.queue_controller.size(idle_jobs, queue_num)
+            logger.info('adaptive queue decision: %r', decision)
+            for name, value in decision._asdict().items():
+                prom_gauge.labels({'value': name}).set(value)
+            queue_num = decision.num
         return queue_num
 
     def get_current_JEL(self) -> Path:
@@ -885,16 +1259,21 @@ class Grid(grid.BaseGrid):
             cur_jel.touch(mode=0o600)
         cur_jel_str = str(cur_jel)
         if cur_jel_str not in self.jels:
-            self.jels[cur_jel_str] = htcondor.JobEventLog(cur_jel_str).events(0)
+            self.jels[cur_jel_str] = None
+            self.jel_watcher.add(cur_jel_str)
         return cur_jel
 
     # JEL processing #
 
     @AsyncPromWrapper(lambda self: self.prometheus.counter('iceprod_grid_wait', 'IceProd grid wait counter', labels=['job_status'], finalize=False))
-    async def wait(self, prom_counter, timeout):
+    @AsyncPromWrapper(lambda self: self.prometheus.histogram('iceprod_grid_jel_event_latency', 'IceProd grid time from JEL event to IceProd update', buckets=HistogramBuckets.MINUTE))
+    @AsyncPromWrapper(lambda self: self.prometheus.gauge('iceprod_grid_jel_events_per_second', 'IceProd grid JEL events processed per second'))
+    async def wait(self, prom_gauge, prom_histogram, prom_counter, timeout):
         """
         Wait for jobs to complete from the Job Event Logs.
 
+        Sleeps until a JEL changes, then processes all new events.
+
         Args:
             timeout: wait up to N seconds
         """
@@ -904,9 +1283,17 @@ class Grid(grid.BaseGrid):
         self.get_current_JEL()
 
         while True:
-            for filename, events in self.jels.items():  # ruff: ignore[PERF102]
+            # reset before reading, so writes during processing are not missed
+            self.jel_watcher.clear()
+            pass_start = time.monotonic()
+            num_events = 0
+            for filename in list(self.jels):
                 try:
-                    for event in events:
+                    events, new_events = await run_in_executor(self.jel_executor, read_jel, filename, self.jels[filename], timeout=self.submitter.timeout)
+                    if filename in self.jels:
+                        self.jels[filename] = events
+                    num_events += len(new_events)
+                    for event in new_events:
                         if float(event.timestamp) < self.last_event_timestamp:
                             continue
 
@@ -927,13 +1314,16 @@ class Grid(grid.BaseGrid):
                                 job.task_id = event['IceProdTaskId']
                                 job.instance_id = event['IceProdTaskInstanceId']
                                 job.submit_dir = Path(event['Iwd'])
+                                self.jobs.reindex(job_id)
 
                             type_ = event['TriggerEventTypeNumber']
                             if type_ == htcondor.JobEventType.JOB_TERMINATED:
                                 logger.info("job %s %s.%s exited on its own", job_id, job.dataset_id, job.task_id)
 
                                 success = event.get('ReturnValue', 1) == 0
-                                job.status = JobStatus.COMPLETED if success else JobStatus.FAILED
+                                new_status = JobStatus.COMPLETED if success else JobStatus.FAILED
+                                self.observe_job_status(job.status, new_status, float(event.timestamp))
+                                job.status = new_status
                                 prom_counter.labels({"job_status": str(job.status)}).inc()
 
                                 # there's a bug where not all the classads are updated before the event fires
@@ -989,6 +1379,7 @@ class Grid(grid.BaseGrid):
                                 """
 
                             elif type_ == htcondor.JobEventType.JOB_ABORTED:
+                                self.observe_job_status(job.status, JobStatus.FAILED, float(event.timestamp))
                                 job.status = JobStatus.FAILED
                                 prom_counter.labels({"job_status": str(job.status)}).inc()
                                 reason = event.get('Reason', None)
@@ -1006,18 +1397,38 @@ class Grid(grid.BaseGrid):
                                 # update status
                                 new_status = JOB_EVENT_STATUS_TRANSITIONS.get(type_, None)
                                 if new_status is not None and job.status != new_status:
+                                    self.observe_job_status(job.status, new_status, float(event.timestamp))
                                     job.status = new_status
                                     prom_counter.labels({"job_status": str(job.status)}).inc()
                                     if new_status == JobStatus.FAILED:
-                                        self.submitter.remove(job_id, reason=event.get('HoldReason', 'Job has failed'))
+                                        await self.submitter.call(self.submitter.remove, job_id, reason=event.get('HoldReason', 'Job has failed'))
                                     else:
                                         await self.job_update(job)
+                                    prom_histogram.observe(max(0., time.time() - float(event.timestamp)))
                 except Exception:
                     logger.warning('error processing condor log', exc_info=True)
 
-            if time.monotonic() - start >= timeout:
+            if num_events:
+                prom_gauge.set(num_events / max(time.monotonic() - pass_start, .001))
+
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
                 break
-            await asyncio.sleep(.1)
+            await self.jel_watcher.wait(timeout=remaining)
+
+    def observe_job_status(self, old_status: JobStatus, new_status: JobStatus, timestamp: float):
+        """
+        Record job starts and completions for adaptive queue sizing.
+
+        A job completes once, when it first enters a final status.
+        """
+        if not self.queue_controller:
+            return
+        final = (JobStatus.COMPLETED, JobStatus.FAILED)
+        if old_status == JobStatus.IDLE and new_status == JobStatus.RUNNING:
+            self.queue_controller.observe_start(timestamp)
+        elif new_status in final and old_status not in final:
+            self.queue_controller.observe_completion(timestamp)
 
     async def job_update(self, job: CondorJob):
         """
@@ -1104,103 +1515,209 @@ class Grid(grid.BaseGrid):
         logger.info('starting cross-check')
         self.cross_check_start = time.monotonic()
 
-        all_jobs = self.submitter.get_jobs()
-
-        # swap job dicts
-        for job_id in set(self.jobs) - set(all_jobs):
-            logger.info('removing job %s from cross-check', job_id)
-        old_jobs = self.jobs
-        self.jobs = all_jobs
+        if self.check_full_time is None or self.cross_check_start - self.check_full_time >= self.check_full_interval:
+            changed = await self.check_queue_full()
+            self.check_full_time = self.cross_check_start
+        else:
+            changed = await self.check_queue_states()
+        logger.info('cross-check: %d changed jobs', len(changed))
 
         # process any updates
         async with asyncio.TaskGroup() as tg:
-            for job_id, job in all_jobs.items():
-                if job_id not in old_jobs or job.status != old_jobs[job_id].status:
-                    if job.status == JobStatus.FAILED:
-                        reason = job.get('HoldReason', 'Job has failed')
-                        logger.info("job %s %s.%s removed from cross-check: %r", job_id, job.dataset_id, job.task_id, reason)
-                        self.submitter.remove(job_id, reason=reason)
-                    else:
-                        tg.create_task(self.job_update(job))
+            for job_id in changed:
+                job = self.jobs[job_id]
+                if job.status == JobStatus.FAILED:
+                    reason = job.get('HoldReason', 'Job has failed')
+                    logger.info("job %s %s.%s removed from cross-check: %r", job_id, job.dataset_id, job.task_id, reason)
+                    await self.submitter.call(self.submitter.remove, job_id, reason=reason)
+                else:
+                    tg.create_task(self.job_update(job))
 
         await self.check_history()
 
         await self.check_iceprod()
 
         # check for old jobs and dirs
-        async for path in self.check_submit_dir():
-            for job_id, job in self.jobs.items():
-                if job.submit_dir == path:
-                    self.submitter.remove(job_id, reason='exceeded max iceprod queue time')
+        async with self.cleaner.cycle():
+            old_job_dirs, delete_paths = await self.check_submit_dir()
+            for path in old_job_dirs:
+                for job_id in self.jobs.get_by_submit_dir(path):
+                    await self.submitter.call(self.submitter.remove, job_id, reason='exceeded max iceprod queue time')
+            async with asyncio.TaskGroup() as tg:
+                for path in delete_paths:
+                    tg.create_task(self.cleaner.rmtree(path))
 
         logger.info('finished cross-check')
 
+    async def check_queue_full(self) -> list[CondorJobId]:
+        """
+        Replace `self.jobs` with a full query of the condor queue.
+
+        Returns:
+            list: job ids that are new or changed status
+        """
+        all_jobs = await self.submitter.call(self.submitter.get_jobs, latency=False)
+
+        # swap job dicts
+        for job_id in set(self.jobs) - set(all_jobs):
+            logger.info('removing job %s from cross-check', job_id)
+        old_jobs = self.jobs
+        self.jobs = CondorJobs(all_jobs)
+
+        return [
+            job_id for job_id, job in all_jobs.items()
+            if job_id not in old_jobs or job.status != old_jobs[job_id].status
+        ]
+
+    async def check_queue_states(self) -> list[CondorJobId]:
+        """
+        Update `self.jobs` from a query of only the condor job states.
+
+        Most jobs are already up to date from the JEL, so only
+        fetch the full job ads for jobs we do not know about yet.
+
+        Returns:
+            list: job ids that are new or changed status
+        """
+        states = await self.submitter.call(self.submitter.get_job_states, latency=False)
+
+        for job_id in set(self.jobs) - set(states):
+            logger.info('removing job %s from cross-check', job_id)
+            del self.jobs[job_id]
+
+        changed = []
+        missing = set()
+        for job_id, status in states.items():
+            job = self.jobs.get(job_id)
+            if job is None or not job.dataset_id:
+                missing.add(job_id)
+            elif job.status != status:
+                job.status = status
+                changed.append(job_id)
+
+        if missing:
+            new_jobs = await self.submitter.call(self.submitter.get_jobs, cluster_ids={job_id.cluster_id for job_id in missing}, latency=False)
+            for job_id in missing:
+                if (job := new_jobs.get(job_id)) is None:
+                    continue
+                old_job = self.jobs.get(job_id)
+                self.jobs[job_id] = job
+                if old_job is None or job.status != old_job.status:
+                    changed.append(job_id)
+
+        return changed
+
     @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_check_history', 'IceProd grid check calls', buckets=HistogramBuckets.MINUTE))
     @AsyncPromWrapper(lambda self: self.prometheus.histogram('iceprod_grid_check_history_per_job', 'IceProd grid check history per job', buckets=HistogramBuckets.SECOND))
     async def check_history(self, prom_histogram):
-        """Check condor_history"""
-        now = time.time()
-        hist_jobs_iter = self.submitter.get_history(since=int(self.last_event_timestamp))
-        self.last_event_timestamp = now
-        async with asyncio.TaskGroup() as tg:
-            last_time = time.monotonic()
-            for job_id, job in hist_jobs_iter:
-                # always get the latest job info
-                self.jobs[job_id] = job
+        """
+        Check condor_history for newly completed jobs.
+
+        Only jobs completed since the history high-water mark are read.
+        They are read from the schedd in pages of `history_batch_size`,
+        and each page is finished concurrently before reading the next.
+        The high-water mark advances once all jobs are finished.
+        """
+        self.last_event_timestamp = time.time()
+        new_completion_date = self.history_completion_date
+        new_job_ids = set(self.history_job_ids)
+        before: tuple[int, set[CondorJobId]] | None = None
+        last_time = time.monotonic()
+        while True:
+            hist_jobs = await self.submitter.call(list, self.submitter.get_history(
+                since=self.history_completion_date,
+                before=before,
+                limit=self.history_batch_size,
+            ), latency=False)
+            if not hist_jobs:
+                break
+            async with asyncio.TaskGroup() as tg:
+                for job_id, job in hist_jobs:
+                    # skip jobs processed in a previous cycle
+                    completion_date = int(job.get('CompletionDate') or 0)
+                    if completion_date == self.history_completion_date and str(job_id) in self.history_job_ids:
+                        continue
+                    if completion_date > new_completion_date:
+                        new_completion_date = completion_date
+                        new_job_ids = set()
+                    if completion_date == new_completion_date:
+                        new_job_ids.add(str(job_id))
+
+                    # always get the latest job info
+                    self.jobs[job_id] = job
+
+                    logger.info("job %s %s.%s exited on its own from cross-check", job_id, job.dataset_id, job.task_id)
+                    tg.create_task(self.finish_history_job(job_id, job))
+
+            # do timing manually to get the time per job, including reading from the schedd
+            next_time = time.monotonic()
+            per_job_time = (next_time - last_time) / len(hist_jobs)
+            for _ in hist_jobs:
+                prom_histogram.observe(per_job_time)
+            last_time = next_time
+
+            if len(hist_jobs) < self.history_batch_size:
+                break
+
+            # next page starts after the oldest job read so far
+            page_date = min(int(job.get('CompletionDate') or 0) for _, job in hist_jobs)
+            page_ids = {job_id for job_id, job in hist_jobs if int(job.get('CompletionDate') or 0) == page_date}
+            if before and before[0] == page_date:
+                page_ids |= before[1]
+            before = (page_date, page_ids)
 
-                logger.info("job %s %s.%s exited on its own from cross-check", job_id, job.dataset_id, job.task_id)
-
-                # get stats
-                cpu = job.get('CpusUsage')
-                if not cpu and (wall := job.get('LastRemoteWallClockTime')):
-                    cpu = (job.get('RemoteSysCpu', 0) + job.get('RemoteUserCpu', 0)) * 1. / wall
-                gpu = job.get('GPUsAverageUsage')
-                gpumem = job.get('GPUsMemoryUsage')  # MB
-                if not gpu:
-                    gpu = job.get('GpusUsage')
-
-                memory = job.get('ResidentSetSize_RAW')  # KB
-                disk = job.get('DiskUsage_RAW')  # KB
-                time_ = job.get('LastRemoteWallClockTime')  # seconds
-
-                resources = {}
-                if cpu is not None:
-                    resources['cpu'] = cpu
-                if gpu is not None:
-                    resources['gpu'] = gpu
-                if gpumem is not None:
-                    resources['gpumem'] = gpumem/1000.
-                if memory is not None:
-                    resources['memory'] = memory/1000000.
-                if disk is not None:
-                    resources['disk'] = disk/1000000.
-                if time_ is not None:
-                    resources['time'] = time_/3600.
-
-                success = job.get('JobStatus') == 4 and job.get('ExitCode', 1) == 0
-                job.status = JobStatus.COMPLETED if success else JobStatus.FAILED
-
-                stats = {}
-                if site := job.get('MachineAttrGLIDEIN_Site0'):
-                    stats['site'] = site
-                elif site := job.get('MATCH_EXP_JOBGLIDEIN_ResourceName'):
-                    stats['site'] = site
-                elif 'chtc' in job.get('LastRemotePool', ''):
-                    stats['site'] = 'CHTC'
-
-                reason = None
-                if r := job.get('LastHoldReason'):
-                    reason = r
-                elif r := job.get('RemoveReason'):
-                    reason = r
-
-                # finish job
-                tg.create_task(self.finish(job_id, success=success, resources=resources, stats=stats, reason=reason))
-
-                # do timing manually to also count generator time per job
-                next_time = time.monotonic()
-                prom_histogram.observe(next_time - last_time)
-                last_time = next_time
+        self.history_completion_date = new_completion_date
+        self.history_job_ids = new_job_ids
+        self.save_history_hwm()
+
+    async def finish_history_job(self, job_id: CondorJobId, job: CondorJob):
+        """
+        Finish a job found in condor_history, using the stats from its classad.
+        """
+        cpu = job.get('CpusUsage')
+        if not cpu and (wall := job.get('LastRemoteWallClockTime')):
+            cpu = (job.get('RemoteSysCpu', 0) + job.get('RemoteUserCpu', 0)) * 1. / wall
+        gpu = job.get('GPUsAverageUsage')
+        gpumem = job.get('GPUsMemoryUsage')  # MB
+        if not gpu:
+            gpu = job.get('GpusUsage')
+
+        memory = job.get('ResidentSetSize_RAW')  # KB
+        disk = job.get('DiskUsage_RAW')  # KB
+        time_ = job.get('LastRemoteWallClockTime')  # seconds
+
+        resources = {}
+        if cpu is not None:
+            resources['cpu'] = cpu
+        if gpu is not None:
+            resources['gpu'] = gpu
+        if gpumem is not None:
+            resources['gpumem'] = gpumem/1000.
+        if memory is not None:
+            resources['memory'] = memory/1000000.
+        if disk is not None:
+            resources['disk'] = disk/1000000.
+        if time_ is not None:
+            resources['time'] = time_/3600.
+
+        success = job.get('JobStatus') == 4 and job.get('ExitCode', 1) == 0
+        job.status = JobStatus.COMPLETED if success else JobStatus.FAILED
+
+        stats = {}
+        if site := job.get('MachineAttrGLIDEIN_Site0'):
+            stats['site'] = site
+        elif site := job.get('MATCH_EXP_JOBGLIDEIN_ResourceName'):
+            stats['site'] = site
+        elif 'chtc' in job.get('LastRemotePool', ''):
+            stats['site'] = 'CHTC'
+
+        reason = None
+        if r := job.get('LastHoldReason'):
+            reason = r
+        elif r := job.get('RemoveReason'):
+            reason = r
+
+        await self.finish(job_id, success=success, resources=resources, stats=stats, reason=reason)
 
     @AsyncPromTimer(lambda self: self.prometheus.histogram('iceprod_grid_check_iceprod', 'IceProd grid check calls', buckets=HistogramBuckets.TENSECOND))
     async def check_iceprod(self):
@@ -1227,9 +1744,15 @@ class Grid(grid.BaseGrid):
                     tg.create_task(self.task_reset(job, reason='task missing from HTCondor queue'))
 
     @PromWrapper(lambda self: self.prometheus.histogram('iceprod_grid_check_submit_dir', 'IceProd grid check calls', buckets=HistogramBuckets.TENSECOND))
-    async def check_submit_dir(self, prom_histogram):
+    async def check_submit_dir(self, prom_histogram) -> tuple[list[Path], list[Path]]:
         """
-        Return directory paths that should be cleaned up.
+        Scan the submit dir for old jobs and directories.
+
+        Should be called inside a `self.cleaner.cycle()`, which sets
+        the time budget for the scan.
+
+        Returns:
+            tuple: (submit dirs of jobs to remove, paths to delete)
         """
         with prom_histogram.time():
             # get time limits
@@ -1243,34 +1766,42 @@ class Grid(grid.BaseGrid):
             dir_old_time = now - (queued_time + processing_time + suspend_time)
             logger.debug('now: %r, job_clean_logs_time: %r, job_old_time: %r, dir_old_time: %r', now, job_clean_logs_time, job_old_time, dir_old_time)
 
-            for daydir in self.submit_dir.glob('[0-9][0-9][0-9][0-9]*'):
-                logger.debug('looking at daydir %s', daydir)
-                if daydir.is_dir():
-                    empty = True
-                    for path in daydir.iterdir():
-                        job_active = path.name.split('_')[0] in queue_tasks
-                        logger.debug('looking at path %s, active: %r', path, job_active)
-                        st = path.lstat()
-                        logger.debug('stat: %r', st)
-                        if stat.S_ISDIR(st.st_mode):
-                            empty = False
-                            if not job_active:
-                                if st.st_mtime < job_clean_logs_time:
-                                    logger.info('cleaning up submit dir %s', path)
-                                    shutil.rmtree(path)
-                            elif st.st_mtime < job_old_time:
-                                yield path
-                                if st.st_mtime < dir_old_time:
-                                    logger.info('cleaning up submit dir %s', path)
-                                    shutil.rmtree(path)
-                    if empty:
-                        logger.info('cleaning up daydir %s', daydir)
-                        for path in self.jels.copy():
-                            if Path(path).parent == daydir:
-                                logger.info('removing JEL')
-                                self.jels[path].close()
-                                del self.jels[path]
-                        shutil.rmtree(daydir)
-                        continue
-                    # let other processing happen
-                    await asyncio.sleep(0)
+            old_job_dirs = []
+            delete_paths = []
+            for daydir in await self.cleaner.scandir(self.submit_dir) or []:
+                if not (daydir.is_dir and daydir.path.name[:4].isdigit()):
+                    continue
+                logger.debug('looking at daydir %s', daydir.path)
+                entries = await self.cleaner.scandir(daydir.path)
+                if entries is None:
+                    # out of time, so the daydir was not scanned
+                    break
+                empty = True
+                for entry in entries:
+                    path = entry.path
+                    job_active = path.name.split('_')[0] in queue_tasks
+                    logger.debug('looking at path %s, active: %r', path, job_active)
+                    st = entry.stat
+                    logger.debug('stat: %r', st)
+                    if entry.is_dir:
+                        empty = False
+                        if not job_active:
+                            if st.st_mtime < job_clean_logs_time:
+                                logger.info('cleaning up submit dir %s', path)
+                                delete_paths.append(path)
+                        elif st.st_mtime < job_old_time:
+                            old_job_dirs.append(path)
+                            if st.st_mtime < dir_old_time:
+                                logger.info('cleaning up submit dir %s', path)
+                                delete_paths.append(path)
+                if empty and not self.cleaner.expired:
+                    logger.info('cleaning up daydir %s', daydir.path)
+                    for jel_path in self.jels.copy():
+                        if Path(jel_path).parent == daydir.path:
+                            logger.info('removing JEL')
+                            if self.jels[jel_path]:
+                                self.jels[jel_path].close()
+                            del self.jels[jel_path]
+                            self.jel_watcher.remove(jel_path)
+                    delete_paths.append(daydir.path)
+            return old_job_dirs, delete_paths
@@ -4,63 +4,169 @@ Functions used to calculate dataset and task priority.
 import argparse
 import asyncio
 import logging
-from datetime import UTC, datetime
+from collections.abc import Iterable
+from datetime import UTC, datetime, timedelta
 
 import wipac_dev_tools
 
 from iceprod.client_auth import add_auth_to_argparse, create_rest_client
 from iceprod.roles_groups import GROUP_PRIORITIES
-from iceprod.server.util import str2datetime
+from iceprod.server.util import datetime2str, str2datetime
 
 logger = logging.getLogger('priority')
 
+#: max tasks per bulk priority update request
+BULK_PRIORITY_SIZE = 10000
+
+
+async def update_task_prios(rest_client, priorities: dict[str, float]) -> int:
+    """
+    Set task priorities in the IceProd API, in bulk requests.
+
+    Args:
+        rest_client: rest client
+        priorities: {task_id: priority}
+
+    Returns:
+        int: number of tasks updated
+    """
+    num = 0
+    task_ids = list(priorities)
+    for i in range(0, len(task_ids), BULK_PRIORITY_SIZE):
+        batch = {task_id: priorities[task_id] for task_id in task_ids[i:i+BULK_PRIORITY_SIZE]}
+        ret = await rest_client.request('POST', '/task_actions/bulk_priority', {'priorities': batch})
+        for task_id, r in ret['results'].items():
+            if r['code'] == 200:
+                num += 1
+            else:
+                logger.warning('cannot update priority for task %s: %s', task_id, r['reason'])
+    return num
+
+
+class PriorityCache:
+    """
+    Dataset and task info for priority calculations.
+
+    This is long-lived, and can be shared by many `Priority` objects.
+    The first refresh loads all processing datasets and their active
+    tasks.  Later refreshes only get the datasets and tasks that changed
+    since the last refresh, so the load scales with churn instead of
+    the total number of datasets.
+
+    Args:
+        rest_client: rest client
+    """
+    DATASET_KEYS = 'dataset_id|priority|jobs_submitted|tasks_submitted|group|username|start_date|status'
+    TASK_STATUSES = ['idle', 'waiting', 'queued', 'processing']
+    #: seconds that refreshes overlap, to allow for clock skew with the server
+    REFRESH_OVERLAP = 60
+    #: max concurrent requests
+    MAX_REQUESTS = 20
 
-class Priority:
     def __init__(self, rest_client):
         self.rest_client = rest_client
-        self.dataset_cache = {}
-        self.user_cache = {}
+        self.datasets: dict[str, dict] = {}
+        self.last_refresh: datetime | None = None
+
+    async def refresh(self):
+        """Bring the cache up to date"""
+        now = datetime.now(UTC)
+        if self.last_refresh is None:
+            await self._load_all()
+        else:
+            await self._load_changes(datetime2str(self.last_refresh - timedelta(seconds=self.REFRESH_OVERLAP)))
+        self.last_refresh = now
 
-    async def _populate_dataset_cache(self):
+    async def _load_all(self):
         args = {
-            'keys': 'dataset_id|priority|jobs_submitted|tasks_submitted|group|username|start_date',
+            'keys': self.DATASET_KEYS,
             'status': 'processing',
         }
-        self.dataset_cache = await self.rest_client.request('GET', '/datasets', args)
-        dataset_ids = list(self.dataset_cache)
-        logger.info('populating %d datasets', len(dataset_ids))
+        datasets = await self.rest_client.request('GET', '/datasets', args)
+        logger.info('populating %d datasets', len(datasets))
+        for dataset in datasets.values():
+            dataset['tasks'] = {}
+        await self._load_tasks(datasets)
+        self.datasets = datasets
+
+    async def _load_tasks(self, datasets: dict[str, dict]):
         args = {
-            'keys': 'task_id|dataset_id|job_index|task_index',
-            'status': 'idle|waiting|queued|processing',
+            'keys': 'task_id|job_index|task_index',
+            'status': '|'.join(self.TASK_STATUSES),
         }
-        futures = set()
-        while dataset_ids:
-            if len(futures) >= 20:
-                done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
-                futures = pending
-                for f in done:
-                    ret = await f
-                    if ret:
-                        d = list(ret.values())[0]['dataset_id']
-                        self.dataset_cache[d]['tasks'] = {
-                            k: {'task_index': ret[k]['task_index'], 'job_index': ret[k]['job_index']}
-                            for k in ret
-                        }
-
-            dataset_id = dataset_ids.pop()
-            self.dataset_cache[dataset_id]['tasks'] = {}
-            t = asyncio.create_task(self.rest_client.request('GET', f'/datasets/{dataset_id}/tasks', args))
-            futures.add(t)
-        while futures:
-            done, pending = await asyncio.wait(futures)
-            futures = pending
-            for f in done:
-                ret = await f
-                try:
-                    d = ret.pop('dataset_id')
-                except KeyError:
-                    continue
-                self.dataset_cache[d]['tasks'] = ret
+        sem = asyncio.Semaphore(self.MAX_REQUESTS)
+
+        async def load(dataset_id):
+            async with sem:
+                ret = await self.rest_client.request('GET', f'/datasets/{dataset_id}/tasks', args)
+            datasets[dataset_id]['tasks'] = {
+                k: {'task_index': v['task_index'], 'job_index': v['job_index']}
+                for k, v in ret.items()
+            }
+
+        async with asyncio.TaskGroup() as tg:
+            for dataset_id in datasets:
+                tg.create_task(load(dataset_id))
+
+    async def _load_changes(self, since: str):
+        args = {
+            'keys': self.DATASET_KEYS,
+            'updated_since': since,
+        }
+        ret = await self.rest_client.request('GET', '/datasets', args)
+        new_datasets = {}
+        for dataset_id, dataset in ret.items():
+            if dataset.get('status') != 'processing':
+                self.datasets.pop(dataset_id, None)
+            elif dataset_id in self.datasets:
+                self.datasets[dataset_id].update(dataset)
+            else:
+                dataset['tasks'] = {}
+                new_datasets[dataset_id] = dataset
+        await self._load_tasks(new_datasets)
+
+        args = {
+            'keys': 'task_id|dataset_id|job_index|task_index|status',
+            'status_changed_since': since,
+        }
+        ret = await self.rest_client.request('GET', '/tasks', args)
+        for task in ret['tasks']:
+            dataset = self.datasets.get(task['dataset_id'])
+            if dataset is None:
+                continue
+            if task['status'] in self.TASK_STATUSES:
+                dataset['tasks'][task['task_id']] = {'task_index': task['task_index'], 'job_index': task['job_index']}
+            else:
+                dataset['tasks'].pop(task['task_id'], None)
+
+        self.datasets.update(new_datasets)
+        logger.info('refreshed %d changed datasets and %d changed tasks', len(new_datasets), len(ret['tasks']))
+
+
+class Priority:
+    """
+    Calculate dataset and task priorities.
+
+    Dataset info is loaded once per `Priority` object.  Pass a shared
+    `PriorityCache` to refresh it incrementally instead of reloading
+    everything.
+
+    Args:
+        rest_client: rest client
+        cache: shared dataset cache
+    """
+    def __init__(self, rest_client, cache: PriorityCache | None = None):
+        self.rest_client = rest_client
+        self.cache = cache
+        self.dataset_cache: dict[str, dict] = {}
+        self.user_cache: dict[str, dict] = {}
+
+    async def refresh(self):
+        """Load the dataset info, or bring it up to date"""
+        if not self.cache:
+            self.cache = PriorityCache(self.rest_client)
+        await self.cache.refresh()
+        self.dataset_cache = self.cache.datasets
 
     async def _populate_dataset_task_cache(self, dataset_id, task_id):
         if dataset_id not in self.dataset_cache:
@@ -81,12 +187,12 @@ class Priority:
 
     async def _get_dataset(self, dataset_id):
         if not self.dataset_cache:
-            await self._populate_dataset_cache()
+            await self.refresh()
         return self.dataset_cache[dataset_id]
 
     async def _get_max_dataset_prio_user(self, user):
         if not self.dataset_cache:
-            await self._populate_dataset_cache()
+            await self.refresh()
         try:
             return max(d['priority'] for d in self.dataset_cache.values() if 'priority' in d and d['username'] == user)
         except ValueError:
@@ -95,7 +201,7 @@ class Priority:
 
     async def _get_max_dataset_prio_group(self, group):
         if not self.dataset_cache:
-            await self._populate_dataset_cache()
+            await self.refresh()
         try:
             return max(d['priority'] for d in self.dataset_cache.values() if 'priority' in d and d['group'] == group)
         except ValueError:
@@ -113,7 +219,7 @@ class Priority:
 
     async def _get_num_tasks(self, dataset_id=None):
         if not self.dataset_cache:
-            await self._populate_dataset_cache()
+            await self.refresh()
         num = 0
         for d in self.dataset_cache:
             if dataset_id is None or dataset_id == d:
@@ -139,34 +245,104 @@ class Priority:
             logger.warning(f'cannot find dataset {dataset_id}', exc_info=True)
             return 0.
 
-        dataset_prio = dataset['priority']
-        dataset_age = (datetime.now(UTC) - str2datetime(dataset['start_date'])).total_seconds() / 86400.
         user = dataset['username']
         group = dataset['group']
-        logger.debug(f'{dataset_id} dataset_prio: {dataset_prio}')
         max_dataset_prio = await self._get_max_dataset_prio_user(user)
-        logger.debug(f'{dataset_id} max_dataset_prio: {max_dataset_prio}')
         max_dataset_prio_group = await self._get_max_dataset_prio_group(group)
-        logger.debug(f'{dataset_id} max_dataset_prio_group: {max_dataset_prio_group}')
-
         if group == 'users':
             user_prio = await self._get_user_prio(user)
-            logger.debug(f'{dataset_id} user_prio: {user_prio}')
-            group_prio = await self._get_group_prio(group)
-            logger.debug(f'{dataset_id} group_prio: {group_prio}')
         else:
             user_prio = 1.0
-            group_prio = await self._get_group_prio(group)
-            logger.debug(f'{dataset_id} group_prio: {group_prio}')
+        group_prio = await self._get_group_prio(group)
+        num_all_tasks = await self._get_num_tasks()
+
+        return self._calc_dataset_prio(
+            dataset_id,
+            dataset,
+            now=datetime.now(UTC),
+            max_dataset_prio=max_dataset_prio,
+            max_dataset_prio_group=max_dataset_prio_group,
+            user_prio=user_prio,
+            group_prio=group_prio,
+            num_all_tasks=num_all_tasks,
+        )
+
+    async def get_dataset_prios(self, dataset_ids: Iterable[str] | None = None) -> dict[str, float]:
+        """
+        Calculate priority for many datasets at once.
+
+        The max priorities by user and group and the total number of
+        tasks are computed once, instead of once per dataset.
+
+        Args:
+            dataset_ids: dataset ids (default: all cached datasets)
 
+        Returns:
+            dict: {dataset_id: priority between 0 and 1}
+        """
+        if not self.dataset_cache:
+            await self.refresh()
+        if dataset_ids is None:
+            dataset_ids = list(self.dataset_cache)
+
+        max_dataset_prio: dict[str, float] = {}
+        max_dataset_prio_group: dict[str, float] = {}
+        num_all_tasks = 0
+        for d in self.dataset_cache.values():
+            if 'priority' in d:
+                if d['username'] not in max_dataset_prio or d['priority'] > max_dataset_prio[d['username']]:
+                    max_dataset_prio[d['username']] = d['priority']
+                if d['group'] not in max_dataset_prio_group or d['priority'] > max_dataset_prio_group[d['group']]:
+                    max_dataset_prio_group[d['group']] = d['priority']
+            num_all_tasks += len(d.get('tasks', {}))
+
+        now = datetime.now(UTC)
+        ret = {}
+        for dataset_id in dataset_ids:
+            if dataset_id not in self.dataset_cache:
+                logger.warning(f'cannot find dataset {dataset_id}')
+                ret[dataset_id] = 0.
+                continue
+            dataset = self.dataset_cache[dataset_id]
+            user = dataset['username']
+            group = dataset['group']
+            ret[dataset_id] = self._calc_dataset_prio(
+                dataset_id,
+                dataset,
+                now=now,
+                max_dataset_prio=max_dataset_prio.get(user, 1.),
+                max_dataset_prio_group=max_dataset_prio_group.get(group, 1.),
+                user_prio=await self._get_user_prio(user) if group == 'users' else 1.0,
+                group_prio=await self._get_group_prio(group),
+                num_all_tasks=num_all_tasks,
+            )
+        return ret
+
+    @staticmethod
+    def _calc_dataset_prio(
+        dataset_id: str,
+        dataset: dict,
+        *,
+        now: datetime,
+        max_dataset_prio: float,
+        max_dataset_prio_group: float,
+        user_prio: float,
+        group_prio: float,
+        num_all_tasks: int,
+    ) -> float:
+        """Calculate dataset priority from the dataset-level factors"""
+        dataset_prio = dataset['priority']
+        dataset_age = (now - str2datetime(dataset['start_date'])).total_seconds() / 86400.
+        group = dataset['group']
         num_dataset_jobs = dataset['jobs_submitted']
+        num_dataset_tasks_avail = len(dataset.get('tasks', {}))
+        logger.debug(f'{dataset_id} dataset_prio: {dataset_prio}')
+        logger.debug(f'{dataset_id} max_dataset_prio: {max_dataset_prio}')
+        logger.debug(f'{dataset_id} max_dataset_prio_group: {max_dataset_prio_group}')
+        logger.debug(f'{dataset_id} user_prio: {user_prio}')
+        logger.debug(f'{dataset_id} group_prio: {group_prio}')
         logger.debug(f'{dataset_id} num_dataset_jobs: {num_dataset_jobs}')
-
-        num_all_tasks = await self._get_num_tasks()
         logger.debug(f'{dataset_id} num_all_tasks: {num_all_tasks}')
-        num_dataset_tasks = dataset['tasks_submitted']
-        logger.debug(f'{dataset_id} num_dataset_tasks: {num_dataset_tasks}')
-        num_dataset_tasks_avail = await self._get_num_tasks(dataset_id)
         logger.debug(f'{dataset_id} num_dataset_tasks_avail: {num_dataset_tasks_avail}')
 
         # general priority
@@ -197,7 +373,8 @@ class Priority:
         priority *= factor
         logger.info(f'{dataset_id} after large dataset adjustment: {priority}')
 
-        priority -= (1. * num_dataset_tasks_avail / num_all_tasks) / 4.
+        if num_all_tasks > 0:
+            priority -= (1. * num_dataset_tasks_avail / num_all_tasks) / 4.
         logger.info(f'{dataset_id} after avail tasks adjustment: {priority}')
 
         if priority < 0.:
@@ -231,27 +408,99 @@ class Priority:
 
         priority = await self.get_dataset_prio(dataset_id)
 
-        task = dataset['tasks'][task_id]
+        priority = self._calc_task_prio(dataset_id, task_id, dataset['tasks'][task_id], dataset, priority)
+        logger.info(f'{dataset_id}.{task_id} final priority: {priority}')
+        return priority
+
+    async def get_task_prios(self, tasks: Iterable[tuple[str, str]]) -> list[float]:
+        """
+        Calculate priority for many tasks at once.
+
+        Dataset priorities are calculated once for all tasks,
+        then each task is scored in a single pass.
+
+        Args:
+            tasks: (dataset_id, task_id) pairs
+
+        Returns:
+            list: priorities between 0 and 1, in the same order as `tasks`
+        """
+        if not self.dataset_cache:
+            await self.refresh()
+        tasks = list(tasks)
+
+        # load any tasks missing from the cache first, as they count towards dataset priority
+        for dataset_id, task_id in tasks:
+            await self._populate_dataset_task_cache(dataset_id, task_id)
+
+        dataset_ids = {dataset_id for dataset_id, _ in tasks if dataset_id in self.dataset_cache}
+        dataset_prios = await self.get_dataset_prios(dataset_ids)
+
+        ret = []
+        for dataset_id, task_id in tasks:
+            dataset = self.dataset_cache.get(dataset_id)
+            if dataset is None:
+                logger.warning(f'cannot find dataset {dataset_id}')
+                ret.append(0.)
+            elif dataset['tasks_submitted'] < 1:
+                ret.append(0.)
+            else:
+                ret.append(self._calc_task_prio(dataset_id, task_id, dataset['tasks'][task_id], dataset, dataset_prios[dataset_id]))
+        return ret
+
+    async def get_new_task_prios(self, dataset_id: str, tasks: Iterable[tuple[int, int]]) -> list[float]:
+        """
+        Calculate priority for tasks that have not been created yet.
+
+        Args:
+            dataset_id: dataset id
+            tasks: (job_index, task_index) pairs
+
+        Returns:
+            list: priorities between 0 and 1, in the same order as `tasks`
+        """
+        if not self.dataset_cache:
+            await self.refresh()
+        tasks = list(tasks)
+
+        dataset = self.dataset_cache.get(dataset_id)
+        if dataset is None:
+            logger.warning(f'cannot find dataset {dataset_id}')
+            return [0. for _ in tasks]
+        if dataset['tasks_submitted'] < 1:
+            return [0. for _ in tasks]
+
+        dataset_prio = (await self.get_dataset_prios([dataset_id]))[dataset_id]
+        return [
+            self._calc_task_prio(dataset_id, f'{job_index}.{task_index}', {'job_index': job_index, 'task_index': task_index}, dataset, dataset_prio)
+            for job_index, task_index in tasks
+        ]
+
+    @staticmethod
+    def _calc_task_prio(dataset_id: str, task_id: str, task: dict, dataset: dict, priority: float) -> float:
+        """Calculate task priority from the dataset priority"""
         tasks_per_job = dataset['tasks_submitted'] / dataset['jobs_submitted']
 
+        # this runs for every task, so only log lazily at debug level
+
         # bias towards finishing jobs
         priority += (1. * task['task_index'] / tasks_per_job) / 5.
-        logger.info(f'{dataset_id}.{task_id} after finishing jobs adjustment: {priority}')
+        logger.debug('%s.%s after finishing jobs adjustment: %s', dataset_id, task_id, priority)
 
         # spread out job priorities to allow dataset balancing
         priority -= (1. - (dataset['jobs_submitted'] - task['job_index']) / dataset['jobs_submitted']) / 5.
-        logger.info(f'{dataset_id}.{task_id} after job index adjustment: {priority}')
+        logger.debug('%s.%s after job index adjustment: %s', dataset_id, task_id, priority)
 
         # boost towards first 100 jobs (or small datasets)
         if task['job_index'] < 100:
             priority += (100. - task['job_index']) / 100.
-            logger.info(f'{dataset_id}.{task_id} after initial 100 jobs adjustment: {priority}')
+            logger.debug('%s.%s after initial 100 jobs adjustment: %s', dataset_id, task_id, priority)
 
         if priority < 0.:
             priority = 0.
         elif priority > 1.:
             priority = 1.
-        logger.info(f'{dataset_id}.{task_id} final priority: {priority}')
+        logger.debug('%s.%s final priority: %s', dataset_id, task_id, priority)
 
         return priority
 
@@ -14,6 +14,7 @@ from datetime import UTC, datetime, timedelta
 
 from prometheus_client import start_http_server
 
+from iceprod.common.prom_utils import AsyncMonitor
 from iceprod.core.logger import set_log_level
 from iceprod.server.config import IceProdConfig
 from iceprod.server.queue import Queue
@@ -34,6 +35,7 @@ class Server(object):
         self.errfile = errfile
 
         self.rotate_logs_task = None
+        self.async_monitor = None
         self.queue = Queue(self.cfg)
 
         set_log_level(self.cfg['logging']['level'])
@@ -54,10 +56,15 @@ class Server(object):
     async def run(self):
         if self.cfg.get('prometheus', {}).get('enable', False):
             start_http_server(self.cfg['prometheus']['port'])
+            self.async_monitor = AsyncMonitor(labels={'type': 'grid'})
+            await self.async_monitor.start()
         self.rotate_logs_task = asyncio.create_task(self.rotate_logs())
         try:
             await self.queue.run()
         finally:
+            if self.async_monitor:
+                await self.async_monitor.stop()
+                self.async_monitor = None
             if self.rotate_logs_task:
                 self.rotate_logs_task.cancel()
                 self.rotate_logs_task = None
@@ -13,6 +13,7 @@ from iceprod.services.base import (
     HandlerTypes,
     TimeoutException,
 )
+from iceprod.services.config import get_config
 
 from .materialize import Materialize
 
@@ -55,7 +56,7 @@ class DatasetHandler(BaseHandler):
 
 @dataclass
 class Fields:
-    dataset_id: str
+    dataset_id: str | None = None
     set_status: str = 'idle'
     num: int = 1000
 
@@ -65,7 +66,9 @@ class Action(BaseAction):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._materialize = Materialize(rest_client=self._api_client)
+        config = get_config()
+        self._materialize = Materialize(rest_client=self._api_client, parallelism=config.SERVICE_MATERIALIZE_PARALLELISM)
+        self._cycle_jobs = config.SERVICE_MATERIALIZE_CYCLE_JOBS or None
 
     def extra_handlers(self) -> HandlerTypes:
         """Return handlers"""
@@ -77,6 +80,10 @@ class Action(BaseAction):
         """
         Validates a new materialization request.
 
+        Without a dataset_id, all processing datasets are materialized,
+        sharing the `SERVICE_MATERIALIZE_CYCLE_JOBS` budget.  This is only
+        allowed for admin and system roles.
+
         Deduplicates with existing requests with the same dataset_id.
 
         Arguments:
@@ -93,6 +100,9 @@ class Action(BaseAction):
         except Exception as e:
             raise HTTPError(400, reason=str(e))
 
+        if not data.dataset_id and not set(auth_data.roles).intersection(('admin', 'system')):
+            raise HTTPError(403, reason='only admin or system can materialize all datasets')
+
         # deduplicate on dataset_id
         return await self._push(payload=asdict(data), filter_payload={'dataset_id': data.dataset_id}, priority=self.PRIORITY)
 
@@ -105,6 +115,8 @@ class Action(BaseAction):
         kwargs = {}
         if 'dataset_id' in data and data['dataset_id']:
             kwargs['only_dataset'] = data['dataset_id']
+        else:
+            kwargs['cycle_jobs'] = self._cycle_jobs
         if 'num' in data and data['num']:
             kwargs['num'] = data['num']
         if 'set_status' in data and data['set_status']:
@@ -2,32 +2,67 @@ import argparse
 import asyncio
 import logging
 import time
+from dataclasses import dataclass, field
+
+from wipac_dev_tools.prometheus_tools import GlobalLabels, PromWrapper
 
 from iceprod.client_auth import add_auth_to_argparse, create_rest_client
+from iceprod.common.prom_utils import HistogramBuckets
 from iceprod.core.parser import ExpParser
 from iceprod.core.resources import Resources
-from iceprod.server.priority import Priority
+from iceprod.server.priority import Priority, PriorityCache, update_task_prios
 from iceprod.server.states import TASK_STATUS
 
 logger = logging.getLogger('materialize')
 
 DATASET_CYCLE_TIMEOUT = 120
 
+#: max jobs per bulk materialization request
+JOB_BATCH_SIZE = 100
+
+
+@dataclass
+class MaterializeRun:
+    """
+    State for a single materialization run.
+
+    Runs can overlap on the same `Materialize` object, so each run keeps
+    its own priorities and config cache.
+    """
+    prio: Priority
+    config_cache: dict[str, dict] = field(default_factory=dict)
+
 
 class Materialize:
-    def __init__(self, rest_client):
+    """
+    Materialize jobs and tasks for datasets.
+
+    Datasets are materialized concurrently, up to `parallelism` at a time.
+
+    Args:
+        rest_client: rest client
+        parallelism: max datasets to materialize at once
+        prometheus: global labels for metrics
+    """
+    def __init__(self, rest_client, parallelism: int = 4, prometheus: GlobalLabels | None = None):
         self.rest_client = rest_client
-        self.config_cache = {}
-        self.prio = None
+        self.parallelism = parallelism
+        self.prometheus = prometheus if prometheus else GlobalLabels({'type': 'materialization'})
+        self.prio_cache = PriorityCache(rest_client)
 
-    async def run_once(self, only_dataset: str | None = None, set_status: str | None = None, num: int = 10000, dryrun: bool = False) -> bool:
+    async def run_once(self, only_dataset: str | None = None, set_status: str | None = None, num: int = 10000, cycle_jobs: int | None = None, dryrun: bool = False) -> bool:
         """
         Actual materialization work.
 
+        The per-cycle job budget is shared fairly: each dataset gets an
+        equal share of what is left when it starts, and any unused share
+        goes back to the budget for the datasets after it.
+
         Args:
             only_dataset (str): dataset_id if we should only buffer a single dataset
             set_status (str): status of new tasks
-            num (int): max number of jobs to buffer
+            num (int): max number of jobs to buffer per dataset
+            cycle_jobs (int): max number of jobs to buffer across all datasets (default: unlimited)
             dryrun (bool): if true, do not modify DB, just log changes
 
         Returns:
@@ -35,78 +70,118 @@ class Materialize:
         """
         if set_status and set_status not in TASK_STATUS:
             raise Exception('set_status is not a valid task status')
-        self.config_cache = {}  # clear config cache
-        self.prio = Priority(self.rest_client)  # clear priority cache
-
-        ret = True
+        run = MaterializeRun(prio=Priority(self.rest_client, cache=self.prio_cache))
 
         if only_dataset:
             datasets = [only_dataset]
         else:
             ret2 = await self.rest_client.request('GET', '/dataset_summaries/status')
             datasets = ret2.get('processing', [])
-
-        for dataset_id in datasets:
-            try:
+            if datasets:
+                # load once up front, instead of racing in each dataset
+                await run.prio.refresh()
+
+        budget = cycle_jobs if cycle_jobs is not None else num * len(datasets)
+        datasets_left = len(datasets)
+        sem = asyncio.Semaphore(self.parallelism)
+
+        async def run_dataset(dataset_id):
+            nonlocal budget, datasets_left
+            async with sem:
+                quota = min(num, budget // datasets_left)
+                budget -= quota
+                datasets_left -= 1
                 start_time = time.monotonic()
-                dataset = await self.rest_client.request('GET', f'/datasets/{dataset_id}')
-                if dataset.get('truncated', False) and not only_dataset:
-                    logger.info('ignoring truncated dataset %s', dataset_id)
-                    continue
-                job_counts = await self.rest_client.request('GET', f'/datasets/{dataset_id}/job_counts/status')
-                tasks = await self.rest_client.request('GET', f'/datasets/{dataset_id}/task_counts/status')
-                if 'waiting' not in tasks or job_counts.get('processing', 0) < num or only_dataset:
-                    # buffer for this dataset
-                    logger.warning('checking dataset %s', dataset_id)
-                    jobs = await self.rest_client.request('GET', f'/datasets/{dataset_id}/jobs', {'keys': 'job_id|job_index'})
-                    job_index_id = {j['job_index']: j['job_id'] for j in jobs.values()}
-
-                    # check that last job was buffered correctly
-                    job_index = max(jobs[i]['job_index'] for i in jobs)+1 if jobs else 0
-                    num_tasks = sum(tasks.values())
-                    logger.info('job_index: %d', job_index)
-                    logger.info('num_tasks: %d', num_tasks)
-                    logger.info('tasks_per_job: %d', dataset['tasks_per_job'])
-                    for job_tmp_index in range(job_index-1, -1, -1):
-                        if job_index * dataset['tasks_per_job'] <= num_tasks:
+                try:
+                    ok, jobs_buffered = await self._run_dataset(run, dataset_id, only_dataset=only_dataset, set_status=set_status,
+                                                                num=num, quota=quota, dryrun=dryrun)
+                finally:
+                    self._observe_dataset(dataset_id, time.monotonic() - start_time)
+                budget += quota - jobs_buffered
+                return ok
+
+        # errors are only raised for a single dataset, so propagate them as-is
+        ret = await asyncio.gather(*(run_dataset(dataset_id) for dataset_id in datasets))
+        return all(ret)
+
+    @PromWrapper(lambda self: self.prometheus.histogram('iceprod_materialization_dataset_seconds', 'Materialization time per dataset',
+                                                        labels=['dataset_id'], buckets=HistogramBuckets.TENMINUTE, finalize=False))
+    def _observe_dataset(self, prom_histogram, dataset_id: str, duration: float):
+        prom_histogram.labels({'dataset_id': dataset_id}).observe(duration)
+
+    async def _run_dataset(self, run: MaterializeRun, dataset_id: str, *, only_dataset: str | None, set_status: str | None, num: int, quota: int, dryrun: bool) -> tuple[bool, int]:
+        """
+        Materialize a single dataset.
+
+        Returns:
+            tuple: (whether it completed or timed out, number of new jobs buffered)
+        """
+        ret = True
+        jobs_buffered = 0
+        try:
+            start_time = time.monotonic()
+            dataset = await self.rest_client.request('GET', f'/datasets/{dataset_id}')
+            if dataset.get('truncated', False) and not only_dataset:
+                logger.info('ignoring truncated dataset %s', dataset_id)
+                return ret, jobs_buffered
+            job_counts = await self.rest_client.request('GET', f'/datasets/{dataset_id}/job_counts/status')
+            tasks = await self.rest_client.request('GET', f'/datasets/{dataset_id}/task_counts/status')
+            if 'waiting' not in tasks or job_counts.get('processing', 0) < num or only_dataset:
+                # buffer for this dataset
+                logger.warning('checking dataset %s', dataset_id)
+                jobs = await self.rest_client.request('GET', f'/datasets/{dataset_id}/jobs', {'keys': 'job_id|job_index'})
+                job_index_id = {j['job_index']: j['job_id'] for j in jobs.values()}
+
+                # check that last job was buffered correctly
+                job_index = max(jobs[i]['job_index'] for i in jobs)+1 if jobs else 0
+                num_tasks = sum(tasks.values())
+                logger.info('job_index: %d', job_index)
+                logger.info('num_tasks: %d', num_tasks)
+                logger.info('tasks_per_job: %d', dataset['tasks_per_job'])
+                for job_tmp_index in range(job_index-1, -1, -1):
+                    if job_index * dataset['tasks_per_job'] <= num_tasks:
+                        break
+                    logger.info('a job must have failed to buffer, so check in reverse order. job_index=%d, num_tasks=%d', job_tmp_index, num_tasks)
+                    job_tasks = await self.rest_client.request('GET', f'/datasets/{dataset_id}/tasks',
+                                                               {'job_index': job_tmp_index, 'keys': 'task_id|job_id|task_index'})
+                    if len(job_tasks) != dataset['tasks_per_job']:
+                        logger.info('fixing buffer of job %d for dataset %s', job_tmp_index, dataset_id)
+                        job_id = job_index_id[job_tmp_index]
+                        logger.info('  fixing job_id %s, num existing tasks: %d', job_id, len(job_tasks))
+                        tasks_buffered = await self.buffer_job(run, dataset, job_tmp_index, job_id=job_id,
+                                                               tasks=list(job_tasks.values()),
+                                                               set_status=set_status, dryrun=dryrun)
+                        num_tasks += tasks_buffered
+                        logger.info('buffered %d tasks. num_tasks increased to: %d', tasks_buffered, num_tasks)
+
+                # now try buffering new tasks
+                jobs_to_buffer = min(quota, dataset['jobs_submitted'] - job_index)
+                if jobs_to_buffer > 0:
+                    logger.info('buffering %d jobs for dataset %s', jobs_to_buffer, dataset_id)
+                    end_index = job_index + jobs_to_buffer
+                    while job_index < end_index:
+                        job_indexes = list(range(job_index, min(job_index + JOB_BATCH_SIZE, end_index)))
+                        await self.buffer_jobs(run, dataset, job_indexes, set_status=set_status, dryrun=dryrun)
+                        job_index = job_indexes[-1] + 1
+                        jobs_buffered += len(job_indexes)
+
+                        if only_dataset is None and time.monotonic() - start_time > DATASET_CYCLE_TIMEOUT:
+                            logger.warning('dataset cycle timeout for dataset %s', dataset_id)
+                            ret = False
                             break
-                        logger.info('a job must have failed to buffer, so check in reverse order. job_index=%d, num_tasks=%d', job_tmp_index, num_tasks)
-                        job_tasks = await self.rest_client.request('GET', f'/datasets/{dataset_id}/tasks',
-                                                                   {'job_index': job_tmp_index, 'keys': 'task_id|job_id|task_index'})
-                        if len(job_tasks) != dataset['tasks_per_job']:
-                            logger.info('fixing buffer of job %d for dataset %s', job_tmp_index, dataset_id)
-                            job_id = job_index_id[job_tmp_index]
-                            logger.info('  fixing job_id %s, num existing tasks: %d', job_id, len(job_tasks))
-                            tasks_buffered = await self.buffer_job(dataset, job_tmp_index, job_id=job_id,
-                                                                   tasks=list(job_tasks.values()),
-                                                                   set_status=set_status, dryrun=dryrun)
-                            num_tasks += tasks_buffered
-                            logger.info('buffered %d tasks. num_tasks increased to: %d', tasks_buffered, num_tasks)
-
-                    # now try buffering new tasks
-                    jobs_to_buffer = min(num, dataset['jobs_submitted'] - job_index)
-                    if jobs_to_buffer > 0:
-                        logger.info('buffering %d jobs for dataset %s', jobs_to_buffer, dataset_id)
-                        for i in range(jobs_to_buffer):
-                            await self.buffer_job(dataset, job_index, set_status=set_status, dryrun=dryrun)
-                            job_index += 1
-
-                            if only_dataset is None and time.monotonic() - start_time > DATASET_CYCLE_TIMEOUT:
-                                logger.warning('dataset cycle timeout for dataset %s', dataset_id)
-                                ret = False
-                                break
-            except Exception:
-                logger.error('error buffering dataset %s', dataset_id, exc_info=True)
-                if only_dataset:
-                    raise
+        except Exception:
+            logger.error('error buffering dataset %s', dataset_id, exc_info=True)
+            if only_dataset:
+                raise
 
-        return ret
+        return ret, jobs_buffered
 
-    async def buffer_job(self, dataset, job_index, job_id=None, tasks=None, set_status=None, dryrun=False):
+    async def buffer_job(self, run, dataset, job_index, job_id=None, tasks=None, set_status=None, dryrun=False):
         """
         Buffer a single job for a dataset
 
         Args:
+            run (MaterializeRun): materialization run state
             dataset (dict): dataset info
             job_index (int): job index
             job_id (str): job id (if filling in remaining)
@@ -117,11 +192,10 @@ class Materialize:
         Returns:
             int: number of tasks buffered
         """
-        assert self.prio
         dataset_id = dataset['dataset_id']
         logger.info('buffering dataset %s job %d', dataset_id, job_index)
 
-        config = await self.get_config(dataset_id)
+        config = await self.get_config(run, dataset_id)
         parser = ExpParser()
         task_names = [task['name'] if task['name'] else str(i) for i,task in enumerate(config['tasks'])]
         if len(task_names) != dataset['tasks_per_job']:
@@ -145,16 +219,12 @@ class Materialize:
             task_iter = list(enumerate(task_names))
 
         # buffer tasks
+        new_task_ids = []
         for task_index,name in task_iter:
             logger.info('  buffering task_index %d, name %s', task_index, name)
             depends = await self.get_depends(config, job_index,
                                              task_index, task_ids)
-            config['options']['job'] = job_index
-            config['options']['task'] = task_index
-            config['options']['dataset'] = dataset['dataset']
-            config['options']['jobs_submitted'] = dataset['jobs_submitted']
-            config['options']['tasks_submitted'] = dataset['tasks_submitted']
-            config['options']['debug'] = dataset['debug']
+            self.set_options(config, dataset, job_index, task_index)
             args = {
                 'dataset_id': dataset_id,
                 'job_id': job_id,
@@ -173,20 +243,95 @@ class Materialize:
                 ret = await self.rest_client.request('POST', '/tasks', args)
                 task_id = ret['result']
                 task_ids.append(task_id)
-                p = await self.prio.get_task_prio(dataset_id, task_id)
-                await self.rest_client.request('PATCH', f'/tasks/{task_id}', {'priority': p})
+                new_task_ids.append(task_id)
+
+        # set priorities for all new tasks at once
+        if new_task_ids:
+            prios = await run.prio.get_task_prios((dataset_id, task_id) for task_id in new_task_ids)
+            await update_task_prios(self.rest_client, dict(zip(new_task_ids, prios)))
 
         return len(task_iter)
 
-    async def get_config(self, dataset_id):
-        """Get dataset config"""
-        if dataset_id in self.config_cache:
-            return self.config_cache[dataset_id]
+    async def buffer_jobs(self, run, dataset, job_indexes, set_status=None, dryrun=False):
+        """
+        Buffer many new jobs for a dataset with a single bulk request.
+
+        Jobs that already exist are skipped by the server, so this is
+        safe to retry.
+
+        Args:
+            run (MaterializeRun): materialization run state
+            dataset (dict): dataset info
+            job_indexes (list): job indexes
+            set_status (str): status of new tasks
+            dryrun (bool): set to True if this is a dry run
+
+        Returns:
+            int: number of tasks buffered
+        """
+        dataset_id = dataset['dataset_id']
+        logger.info('buffering dataset %s jobs %d-%d', dataset_id, job_indexes[0], job_indexes[-1])
+
+        config = await self.get_config(run, dataset_id)
+        parser = ExpParser()
+        task_names = [task['name'] if task['name'] else str(i) for i,task in enumerate(config['tasks'])]
+        if len(task_names) != dataset['tasks_per_job']:
+            raise Exception('config num tasks does not match dataset tasks_per_job')
+
+        # dependencies within a job are sent as task indexes
+        local_task_ids = list(range(len(task_names)))
+        prios = await run.prio.get_new_task_prios(dataset_id, ((j, t) for j in job_indexes for t in local_task_ids))
+        prios.reverse()
+
+        jobs = []
+        for job_index in job_indexes:
+            tasks = []
+            for task_index,name in enumerate(task_names):
+                depends = await self.get_depends(config, job_index, task_index, local_task_ids)
+                self.set_options(config, dataset, job_index, task_index)
+                tasks.append({
+                    'task_index': task_index,
+                    'name': name,
+                    'depends': depends,
+                    'requirements': self.get_reqs(config, task_index, parser),
+                    'priority': prios.pop(),
+                })
+            jobs.append({'job_index': job_index, 'tasks': tasks})
+
+        args = {'jobs': jobs}
+        if set_status:
+            args['status'] = set_status
+        if dryrun:
+            logger.info(f'DRYRUN: POST /datasets/{dataset_id}/job_actions/bulk_materialize {args}')
+            return len(job_indexes) * len(task_names)
+
+        ret = await self.rest_client.request('POST', f'/datasets/{dataset_id}/job_actions/bulk_materialize', args)
+        num_tasks = 0
+        for job in ret['results']:
+            if job['created']:
+                num_tasks += len(job['task_ids'])
+            else:
+                logger.info('job %d for dataset %s already exists', job['job_index'], dataset_id)
+        return num_tasks
+
+    def set_options(self, config, dataset, job_index, task_index):
+        """Set config options for a task, for parsing"""
+        config['options']['job'] = job_index
+        config['options']['task'] = task_index
+        config['options']['dataset'] = dataset['dataset']
+        config['options']['jobs_submitted'] = dataset['jobs_submitted']
+        config['options']['tasks_submitted'] = dataset['tasks_submitted']
+        config['options']['debug'] = dataset['debug']
+
+    async def get_config(self, run, dataset_id):
+        """Get dataset config, cached for the run"""
+        if dataset_id in run.config_cache:
+            return run.config_cache[dataset_id]
 
         config = await self.rest_client.request('GET', f'/config/{dataset_id}')
         if 'options' not in config:
             config['options'] = {}
-        self.config_cache[dataset_id] = config
+        run.config_cache[dataset_id] = config
         return config
 
     def get_reqs(self, config, task_index, parser):
@@ -272,10 +417,12 @@ class Materialize:
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Materialize a dataset')
-    parser.add_argument('dataset_id')
+    parser.add_argument('dataset_id', nargs='?', default=None, help='dataset id (default: all processing datasets)')
     add_auth_to_argparse(parser)
     parser.add_argument('--set_status', default=None, help='initial task status')
-    parser.add_argument('-n', '--num', default=100, type=int, help='number of jobs to materialize')
+    parser.add_argument('-n', '--num', default=100, type=int, help='number of jobs to materialize per dataset')
+    parser.add_argument('--cycle_jobs', default=None, type=int, help='number of jobs to materialize across all datasets')
+    parser.add_argument('--parallelism', default=4, type=int, help='number of datasets to materialize at once')
     parser.add_argument('--job_index', type=int, help='specific job index to buffer')
     parser.add_argument('--job_id', default=None, help='specific job id to buffer tasks into')
     parser.add_argument('--debug', action='store_true')
@@ -284,15 +431,18 @@ if __name__ == '__main__':
     logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
 
     rest_client = create_rest_client(args)
-    materialize = Materialize(rest_client)
+    materialize = Materialize(rest_client, parallelism=args.parallelism)
     if args.job_index is not None:
+        if not args.dataset_id:
+            parser.error('dataset_id is required with --job_index')
         logging.warning('manually buffering a job for dataset %s job %d', args.dataset_id, args.job_index)
 
         async def run():
             dataset = await rest_client.request('GET', f'/datasets/{args.dataset_id}')
-            materialize.prio = Priority(rest_client)
-            await materialize.buffer_job(dataset, args.job_index, job_id=args.job_id)
+            run = MaterializeRun(prio=Priority(rest_client))
+            await materialize.buffer_job(run, dataset, args.job_index, job_id=args.job_id)
 
         asyncio.run(run())
     else:
-        asyncio.run(materialize.run_once(only_dataset=args.dataset_id, set_status=args.set_status, num=args.num, dryrun=args.dryrun))
+        asyncio.run(materialize.run_once(only_dataset=args.dataset_id, set_status=args.set_status, num=args.num,
+                                         cycle_jobs=args.cycle_jobs, dryrun=args.dryrun))
@@ -17,7 +17,13 @@ class DefaultConfig:
     ICEPROD_CRED_CLIENT_ID: str = ''
     ICEPROD_CRED_CLIENT_SECRET: str = ''
     SERVICE_TIMEOUT: float = 900.
+    SERVICE_SHUTDOWN_TIMEOUT: float = 60.
+    SERVICE_CONCURRENCY: int = 1
+    SERVICE_ACTION_LIMITS: dict[str, int] = dataclasses.field(default_factory=dict)
     SERVICE_SLEEP_SECS: float = 5.
+    SERVICE_QUEUE_NOTIFY: bool = False
+    SERVICE_MATERIALIZE_PARALLELISM: int = 4
+    SERVICE_MATERIALIZE_CYCLE_JOBS: int = 0
     DB_URL: str = 'mongodb://localhost/iceprod'
     DB_TIMEOUT: int = 60
     DB_WRITE_CONCERN: int = 1
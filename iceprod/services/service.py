@@ -1,12 +1,15 @@
 import asyncio
 import logging
 import pkgutil
+import signal
 import time
+from collections import Counter
 from pathlib import Path
 
+from prometheus_client import start_http_server
 from rest_tools.client import ClientCredentialsAuth, RestClient
 
-from iceprod.common.mongo_queue import AsyncMongoQueue
+from iceprod.common.mongo_queue import AsyncMongoQueue, Message
 from iceprod.services.base import BaseAction, TimeoutException
 
 from ..core.logger import stderr_logger
@@ -15,15 +18,161 @@ from .config import get_config
 logger = logging.getLogger('service')
 
 
+class WorkerPool:
+    """
+    Process queue messages concurrently.
+
+    Args:
+        message_queue: queue to pop messages from
+        actions: dict of action type: action
+        concurrency: max number of messages to process at once
+        action_limits: max number of messages to process at once, per action type
+        timeout: max time to process a single message, in seconds
+    """
+    def __init__(
+        self,
+        *,
+        message_queue: AsyncMongoQueue,
+        actions: dict[str, BaseAction],
+        concurrency: int = 1,
+        action_limits: dict[str, int] | None = None,
+        timeout: float = 900.,
+    ):
+        self.message_queue = message_queue
+        self.actions = actions
+        self.concurrency = max(concurrency, 1)
+        self.action_limits = action_limits if action_limits else {}
+        self.timeout = timeout
+        self._running: dict[asyncio.Task, str] = {}
+        self._stop_event = asyncio.Event()
+
+    @property
+    def running(self) -> int:
+        """Number of messages currently being processed."""
+        return len(self._running)
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop_event.is_set()
+
+    def stop(self):
+        """Stop taking new messages."""
+        logger.info('service pool stopping')
+        self._stop_event.set()
+
+    def _full_types(self) -> list[str]:
+        """Get action types that are at their concurrency limit."""
+        counts = Counter(self._running.values())
+        return [t for t, limit in self.action_limits.items() if counts[t] >= limit]
+
+    def _batch_size(self) -> int:
+        """Get the max number of messages to pop without exceeding any limit."""
+        counts = Counter(self._running.values())
+        num = self.concurrency - len(self._running)
+        for t, limit in self.action_limits.items():
+            if counts[t] < limit:
+                num = min(num, limit - counts[t])
+        return num
+
+    async def _process(self, message: Message, type_: str):
+        try:
+            logger.info('running service for type %s', type_)
+            fut = self.actions[type_].run(message)
+            await asyncio.wait_for(fut, timeout=self.timeout)
+        except TimeoutException:
+            await self.message_queue.release(message.uuid)
+        except asyncio.CancelledError:
+            logger.info('service for type %s cancelled, releasing message %s', type_, message.uuid)
+            await self.message_queue.release(message.uuid)
+            raise
+        except Exception as e:
+            logger.error('error running service for type %s', type_, exc_info=True)
+            await self.message_queue.fail(message.uuid, error_message=str(e))
+        else:
+            await self.message_queue.complete(message.uuid)
+
+    async def fill(self) -> int:
+        """
+        Pop messages until all workers are busy or the queue is empty.
+
+        Messages are claimed in batches, sized so that no action type can
+        go over its limit.
+
+        Returns:
+            number of messages started
+        """
+        started = 0
+        while len(self._running) < self.concurrency and not self.stopping:
+            full_types = self._full_types()
+            query = {'payload.type': {'$nin': full_types}} if full_types else None
+            messages = await self.message_queue.pop_many(self._batch_size(), timeout_seconds=self.timeout+10, query=query)
+            if not messages:
+                break
+            for message in messages:
+                type_ = message.payload.pop('type', '')
+                task = asyncio.create_task(self._process(message, type_))
+                self._running[task] = type_
+                task.add_done_callback(lambda t: self._running.pop(t, None))
+                started += 1
+        return started
+
+    async def wait(self, timeout: float):
+        """
+        Wait until there may be more work to do.
+
+        Returns early when a worker finishes, or if a worker is free and
+        a new message is pushed, or the pool is stopped.
+
+        Args:
+            timeout: max time to wait when a worker is free, in seconds
+        """
+        waiters: set[asyncio.Future] = set(self._running)
+        waiters.add(asyncio.create_task(self._stop_event.wait()))
+        if len(self._running) < self.concurrency:
+            waiters.add(asyncio.create_task(self.message_queue.wait_for_message(timeout)))
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for w in waiters:
+            if w not in self._running:
+                w.cancel()
+
+    async def drain(self, timeout: float):
+        """
+        Wait for running messages to finish.
+
+        Any messages still running after the timeout are cancelled and
+        released back to the queue.
+
+        Args:
+            timeout: max time to wait, in seconds
+        """
+        if not self._running:
+            return
+        logger.info('waiting for %d running services', len(self._running))
+        _, pending = await asyncio.wait(list(self._running), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
 async def main() -> None:
     config = get_config()
 
+    # queue wait and processing metrics are recorded in this process
+    if config.PROMETHEUS_PORT > 0:
+        logging.info("starting prometheus on %r", config.PROMETHEUS_PORT)
+        start_http_server(config.PROMETHEUS_PORT)
+
     message_queue = AsyncMongoQueue(
         url=config.DB_URL,
         collection_name='services_queue',
+        notify=config.SERVICE_QUEUE_NOTIFY,
         timeout=config.DB_TIMEOUT,
         write_concern=config.DB_WRITE_CONCERN
     )
+    await message_queue.start_notifications()
 
     rest_client: RestClient
     if config.ICEPROD_API_CLIENT_ID and config.ICEPROD_API_CLIENT_SECRET:
@@ -62,37 +211,38 @@ async def main() -> None:
         actions[name] = action
 
     # process messages
-    while True:
-        sleep_time = 0.
-        try:
-            start_time = time.time()
+    pool = WorkerPool(
+        message_queue=message_queue,
+        actions=actions,
+        concurrency=config.SERVICE_CONCURRENCY,
+        action_limits=config.SERVICE_ACTION_LIMITS,
+        timeout=config.SERVICE_TIMEOUT,
+    )
 
-            data = await message_queue.pop(timeout_seconds=config.SERVICE_TIMEOUT+10)
-
-            if data:
-                try:
-                    type_ = data.payload.pop('type')
-                    logging.info('running service for type %s', type_)
-                    fut = actions[type_].run(data)
-                    await asyncio.wait_for(fut, timeout=config.SERVICE_TIMEOUT)
-                except TimeoutException:
-                    await message_queue.release(data.uuid)
-                except Exception as e:
-                    await message_queue.fail(data.uuid, error_message=str(e))
-                    raise
-                else:
-                    await message_queue.complete(data.uuid)
-            else:
-                logging.info('service has nothing to do. sleeping')
-                sleep_time = config.SERVICE_SLEEP_SECS - (time.time() - start_time)
-        except Exception:
-            logging.error('error running services', exc_info=True)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, pool.stop)
 
-        if config.CI_TESTING:
-            break  # only process one message during testing
+    try:
+        while not pool.stopping:
+            start_time = time.time()
+            try:
+                await pool.fill()
+            except Exception:
+                logging.error('error running services', exc_info=True)
 
-        if sleep_time > 0:
-            await asyncio.sleep(sleep_time)
+            if config.CI_TESTING:
+                break  # only process one batch of messages during testing
+
+            if not pool.running:
+                logging.info('service has nothing to do. sleeping')
+            sleep_time = config.SERVICE_SLEEP_SECS - (time.time() - start_time)
+            await pool.wait(max(sleep_time, 0.))
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        # let in-flight messages finish, or release them back to the queue
+        await pool.drain(config.SERVICE_SHUTDOWN_TIMEOUT)
 
     await message_queue.close()
 
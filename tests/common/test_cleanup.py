@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from iceprod.common.cleanup import AsyncCleaner, rmtree, scandir
+
+
+def test_scandir(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').write_text('foo')
+    (tmp_path / 'c').symlink_to(tmp_path / 'a')
+
+    ret = {e.path.name: e for e in scandir(tmp_path)}
+    assert set(ret) == {'a', 'b', 'c'}
+    assert ret['a'].is_dir
+    assert not ret['b'].is_dir
+    assert ret['b'].stat.st_size == 3
+    assert not ret['c'].is_dir
+
+
+def test_rmtree(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'keep').write_text('keep')
+
+    p = tmp_path / 'a'
+    (p / 'b' / 'c').mkdir(parents=True)
+    (p / 'b' / 'c' / 'file').write_bytes(b'0' * 100)
+    (p / 'file').write_bytes(b'0' * 10)
+    (p / 'link').symlink_to(outside)
+
+    entries, size = rmtree(p)
+    assert not p.exists()
+    assert (outside / 'keep').exists()
+    assert entries == 6
+    assert size >= 110
+
+    assert rmtree(p) == (0, 0)
+
+
+async def test_async_cleaner(tmp_path):
+    for i in range(10):
+        (tmp_path / str(i)).mkdir()
+        (tmp_path / str(i) / 'file').write_bytes(b'0' * 1000)
+
+    cleaner = AsyncCleaner(max_workers=4)
+    async with cleaner.cycle() as stats, asyncio.TaskGroup() as tg:
+        for entry in await cleaner.scandir(tmp_path):
+            if entry.is_dir and int(entry.path.name) % 2 == 0:
+                tg.create_task(cleaner.rmtree(entry.path))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['1', '3', '5', '7', '9']
+    assert stats.scanned == 20
+    assert stats.removed == 10
+    assert stats.bytes_freed == 5000
+    assert stats.errors == 0
+    assert stats.complete
+    assert stats.duration > 0
+
+
+async def test_async_cleaner_time_budget(tmp_path):
+    (tmp_path / 'a').mkdir()
+
+    cleaner = AsyncCleaner(time_budget=.01)
+    async with cleaner.cycle() as stats:
+        time.sleep(.02)
+        assert await cleaner.scandir(tmp_path) is None
+        assert not await cleaner.rmtree(tmp_path / 'a')
+    assert (tmp_path / 'a').exists()
+    assert not stats.complete
+
+    # a new cycle gets a new budget
+    async with cleaner.cycle() as stats:
+        assert await cleaner.rmtree(tmp_path / 'a')
+    assert not (tmp_path / 'a').exists()
+    assert stats.complete
@@ -2,7 +2,11 @@ import asyncio
 from dataclasses import asdict
 from datetime import datetime, timedelta, timezone
 import os
+import time
 import uuid
+from unittest.mock import AsyncMock, MagicMock
+
+from prometheus_client import REGISTRY
 
 from iceprod.common.mongo_queue import AsyncMongoQueue, Message
 
@@ -270,4 +274,223 @@ async def test_queue_sort(mongo_url, mongo_clear):
     assert ret
     assert ret.uuid == u2
 
-    await queue.close()
\ No newline at end of file
+    await queue.close()
+
+
+async def test_queue_pop_many(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar')
+    await queue.setup()
+
+    ret = await queue.pop_many(10)
+    assert ret == []
+
+    u1 = await queue.push({'1': 1})
+    u2 = await queue.push({'2': 1})
+    u3 = await queue.push({'3': 1}, priority=1)
+    u4 = await queue.push({'4': 1})
+
+    ret = await queue.pop_many(3)
+    assert [m.uuid for m in ret] == [u3, u1, u2]
+    assert all(m.status == 'processing' for m in ret)
+    assert all(m.attempts == 1 for m in ret)
+
+    ret = await queue.pop_many(3)
+    assert [m.uuid for m in ret] == [u4]
+
+    ret = await queue.pop_many(3)
+    assert ret == []
+
+    await queue.close()
+
+
+async def test_queue_pop_many_retries(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar')
+    await queue.setup()
+
+    u1 = await queue.push({'1': 1})
+    u2 = await queue.push({'2': 1})
+
+    ret = await queue.pop(timeout_seconds=.01)
+    assert ret
+    assert ret.uuid == u1
+
+    await asyncio.sleep(.01)
+
+    ret = await queue.pop_many(5, timeout_seconds=.01)
+    assert [m.uuid for m in ret] == [u2, u1]
+    assert ret[1].attempts == 2
+
+    await queue.close()
+
+
+async def test_queue_notify(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar', notify=True)
+    await queue.setup()
+    await queue.start_notifications()
+
+    ret = await queue.wait_for_message(.01)
+    assert ret is False
+
+    async def consumer():
+        while True:
+            msg = await queue.pop()
+            if msg:
+                return msg, time.monotonic()
+            await queue.wait_for_message(10)
+
+    task = asyncio.create_task(consumer())
+    await asyncio.sleep(.1)
+
+    start = time.monotonic()
+    id_ = await queue.push({'1': 1})
+    msg, end = await asyncio.wait_for(task, timeout=5)
+    assert msg.uuid == id_
+
+    latency = end - start
+    assert latency < 1
+
+    await queue.close()
+
+
+async def test_queue_notify_change_stream():
+    class Stream:
+        def __init__(self):
+            self.events = asyncio.Queue()
+        async def __aenter__(self):
+            return self
+        async def __aexit__(self, *args):
+            pass
+        def __aiter__(self):
+            return self
+        async def __anext__(self):
+            return await self.events.get()
+
+    stream = Stream()
+    queue = AsyncMongoQueue(url='mongodb://localhost/foo', collection_name='bar', notify=True)
+    queue.collection = MagicMock()
+    queue.collection.watch = AsyncMock(return_value=stream)
+    await queue.start_notifications()
+    await asyncio.sleep(0)
+    assert queue.change_streams_enabled
+
+    # a consumer blocked well past the test is woken by a push from another process
+    task = asyncio.create_task(queue.wait_for_message(10))
+    await asyncio.sleep(.01)
+    assert not task.done()
+
+    start = time.monotonic()
+    stream.events.put_nowait({'operationType': 'insert'})
+    ret = await asyncio.wait_for(task, timeout=1)
+    assert ret is True
+    assert time.monotonic() - start < 1
+
+    await queue.close()
+
+
+async def test_queue_notify_disabled(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar')
+    await queue.setup()
+    await queue.start_notifications()
+
+    await queue.push({'1': 1})
+    ret = await queue.wait_for_message(.01)
+    assert ret is False
+
+    await queue.close()
+
+
+async def test_queue_metrics(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='metrics')
+    await queue.setup()
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, {'queue': 'metrics', **labels}) or 0
+
+    wait_before = sample('iceprod_mongo_queue_wait_count')
+    proc_before = sample('iceprod_mongo_queue_processing_count', outcome='complete')
+    retries_before = sample('iceprod_mongo_queue_retries_total')
+
+    id_ = await queue.push({'1': 1})
+    await queue.push({'2': 1})
+
+    await queue.update_metrics()
+    assert sample('iceprod_mongo_queue_depth', status='queued') == 2
+    assert sample('iceprod_mongo_queue_depth', status='processing') == 0
+    assert sample('iceprod_mongo_queue_oldest_queued') >= 0
+
+    ret = await queue.pop()
+    assert ret and ret.uuid == id_
+    assert sample('iceprod_mongo_queue_wait_count') == wait_before + 1
+    await queue.complete(id_)
+    assert sample('iceprod_mongo_queue_processing_count', outcome='complete') == proc_before + 1
+
+    ret = await queue.pop(timeout_seconds=.01)
+    assert ret
+    await asyncio.sleep(.01)
+    ret = await queue.pop(timeout_seconds=.01)
+    assert ret and ret.attempts == 2
+    assert sample('iceprod_mongo_queue_retries_total') == retries_before + 1
+
+    await queue.update_metrics()
+    assert sample('iceprod_mongo_queue_depth', status='queued') == 0
+    assert sample('iceprod_mongo_queue_depth', status='processing') == 1
+    assert sample('iceprod_mongo_queue_depth', status='complete') == 1
+    assert sample('iceprod_mongo_queue_oldest_queued') == 0
+
+    await queue.close()
+
+
+async def test_queue_push_many(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar')
+    await queue.setup()
+
+    ret = await queue.push_many([])
+    assert ret == []
+
+    ids = await queue.push_many([{'1': 1}, {'1': 1}, {'2': 2}])
+    assert len(ids) == 3
+    assert all(ids)
+    assert await queue.count() == 3
+
+    ret = await queue.pop_many(5)
+    assert {m.uuid for m in ret} == set(ids)
+
+    await queue.close()
+
+
+async def test_queue_push_many_dedup(mongo_url, mongo_clear):
+    url = os.environ['DB_URL']
+    queue = AsyncMongoQueue(url=url, collection_name='bar')
+    await queue.setup()
+
+    id_ = await queue.push_if_not_exists({'d': 1, 'n': 0})
+
+    ids = await queue.push_many([
+        {'d': 1, 'n': 1},
+        {'d': 2, 'n': 2},
+        {'d': 2, 'n': 3},
+        {'d': 3, 'n': 4},
+    ], filter_keys=['d'])
+    assert ids[0] is None
+    assert ids[1]
+    assert ids[2] is None
+    assert ids[3]
+    assert await queue.count() == 3
+
+    ret = await queue.lookup_by_payload({'d': 2})
+    assert ret
+    assert ret.uuid == ids[1]
+    assert ret.payload == {'d': 2, 'n': 2}
+
+    # completed messages don't block new ones
+    await queue.complete(id_)
+    ids = await queue.push_many([{'d': 1, 'n': 5}], filter_keys=['d'])
+    assert ids[0]
+
+    await queue.close()
@@ -0,0 +1,21 @@
+import asyncio
+import time
+
+from prometheus_client import REGISTRY
+
+from iceprod.common.prom_utils import AsyncMonitor
+
+
+async def test_async_monitor_loop_lag(monkeypatch):
+    monkeypatch.setattr(AsyncMonitor, 'SLEEP_TIME', .05)
+    m = AsyncMonitor(labels={'type': 'test_lag'})
+    await m.start()
+    await asyncio.sleep(.01)
+
+    # block the event loop
+    time.sleep(.2)
+    await asyncio.sleep(.1)
+    await m.stop()
+
+    assert REGISTRY.get_sample_value('asyncio_tasks_running', {'type': 'test_lag'}) >= 1
+    assert REGISTRY.get_sample_value('asyncio_loop_lag_seconds_sum', {'type': 'test_lag'}) >= .1
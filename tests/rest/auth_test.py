@@ -1,5 +1,6 @@
 import pytest
 import requests.exceptions
+from prometheus_client import REGISTRY
 
 from iceprod.roles_groups import ROLES, GROUP_PRIORITIES
 
@@ -231,3 +232,39 @@ async def test_rest_auth_auths(server):
     with pytest.raises(requests.exceptions.HTTPError) as exc_info:
         await client.request('POST', '/auths', args)
     assert exc_info.value.response.status_code == 403
+
+
+async def test_rest_auth_cache(server):
+    client = server(username='me', roles=['user'], groups=['users'])
+
+    data = {
+        'description': 'blah',
+        'tasks_per_job': 4,
+        'jobs_submitted': 1,
+        'tasks_submitted': 4,
+        'group': 'users',
+    }
+    ret = await client.request('POST', '/datasets', data)
+    dataset_id = ret['result']
+
+    def sample(result):
+        return REGISTRY.get_sample_value('iceprod_rest_attr_auth_cache_total', {'result': result}) or 0
+
+    hits = sample('hit')
+    misses = sample('miss')
+
+    await client.request('GET', f'/datasets/{dataset_id}')
+    assert sample('miss') == misses + 1
+    assert sample('hit') == hits
+
+    await client.request('GET', f'/datasets/{dataset_id}')
+    await client.request('GET', f'/datasets/{dataset_id}')
+    assert sample('miss') == misses + 1
+    assert sample('hit') == hits + 2
+
+    # a different user is checked against the cached auths
+    client2 = server(username='you', roles=['user'], groups=['foo'])
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client2.request('GET', f'/datasets/{dataset_id}')
+    assert exc_info.value.response.status_code == 403
+    assert sample('hit') == hits + 3
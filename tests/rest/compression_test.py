@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import zlib
+
+from prometheus_client import REGISTRY
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+from iceprod.rest.compression import CompressionTransform, negotiate_encoding
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding('') is None
+    assert negotiate_encoding('identity') is None
+    assert negotiate_encoding('gzip') == 'gzip'
+    assert negotiate_encoding('deflate, gzip;q=0.5') == 'gzip'
+    assert negotiate_encoding('gzip;q=0') is None
+    assert negotiate_encoding('*') is not None
+    assert negotiate_encoding('gzip', encodings=['zstd']) is None
+
+
+def _transform(accept_encoding, **kwargs):
+    request = HTTPServerRequest(method='GET', uri='/', headers=HTTPHeaders({'Accept-Encoding': accept_encoding}))
+    return CompressionTransform(request, **kwargs)
+
+
+def test_compression_transform():
+    t = _transform('gzip', encodings=['gzip'])
+    body = b'{"foo": "bar"}' * 1000
+    headers = HTTPHeaders({'Content-Type': 'application/json; charset=UTF-8', 'Content-Length': str(len(body))})
+    _, headers, chunk = t.transform_first_chunk(200, headers, body, True)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Content-Length'] == str(len(chunk))
+    assert gzip.decompress(chunk) == body
+    assert t.raw_size == len(body)
+    assert t.compressed_size == len(chunk)
+    assert t.compressed_size < t.raw_size
+
+
+def test_compression_transform_small():
+    t = _transform('gzip', encodings=['gzip'], min_size=1024)
+    body = b'{"foo": "bar"}'
+    headers = HTTPHeaders({'Content-Type': 'application/json; charset=UTF-8'})
+    _, headers, chunk = t.transform_first_chunk(200, headers, body, True)
+    assert 'Content-Encoding' not in headers
+    assert chunk == body
+    assert t.encoding is None
+
+
+def test_compression_transform_content_type():
+    t = _transform('gzip', encodings=['gzip'], min_size=0)
+    body = b'\x00' * 2000
+    headers = HTTPHeaders({'Content-Type': 'application/octet-stream'})
+    _, headers, chunk = t.transform_first_chunk(200, headers, body, True)
+    assert 'Content-Encoding' not in headers
+    assert chunk == body
+
+
+def test_compression_transform_stream():
+    t = _transform('gzip', encodings=['gzip'], min_size=1024)
+    headers = HTTPHeaders({'Content-Type': 'application/x-ndjson', 'Content-Length': '10'})
+    _, headers, chunk = t.transform_first_chunk(200, headers, b'{"a": 1}\n', False)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in headers
+
+    # each streamed chunk is decodable as it arrives
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(chunk) == b'{"a": 1}\n'
+    chunk = t.transform_chunk(b'{"b": 2}\n', False)
+    assert d.decompress(chunk) == b'{"b": 2}\n'
+    chunk = t.transform_chunk(b'', True)
+    assert d.decompress(chunk) == b''
+    assert d.eof
+
+
+async def test_rest_compression(server):
+    client = server(roles=['system'])
+
+    data = {
+        'dataset_id': 'foo',
+        'job_id': 'foo1',
+        'task_index': 0,
+        'job_index': 0,
+        'name': 'bar',
+        'depends': [],
+        'requirements': {},
+    }
+    for i in range(20):
+        await client.request('POST', '/tasks', dict(data, task_index=i))
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {'handler': 'tasks.MultiTasksHandler', 'encoding': 'gzip'}) or 0
+
+    count = sample('http_response_compression_ratio_count')
+
+    url, kwargs = client._prepare('GET', '/tasks', None)
+    kwargs.setdefault('headers', {})['Accept-Encoding'] = 'gzip'
+    ret = await asyncio.wrap_future(client.session.request('GET', url, **kwargs))
+    ret.raise_for_status()
+    assert ret.headers['Content-Encoding'] == 'gzip'
+    assert len(ret.json()['tasks']) == 20
+    assert sample('http_response_compression_ratio_count') == count + 1
+
+    kwargs['headers']['Accept-Encoding'] = 'identity'
+    ret = await asyncio.wrap_future(client.session.request('GET', url, **kwargs))
+    ret.raise_for_status()
+    assert 'Content-Encoding' not in ret.headers
+    assert len(ret.json()['tasks']) == 20
@@ -171,6 +171,33 @@ async def test_rest_datasets_update_status(server):
     assert data['status'] == ret['status']
 
 
+async def test_rest_datasets_updated_since(server):
+    client = server(roles=['user'], groups=['users'])
+
+    data = {
+        'description': 'blah',
+        'tasks_per_job': 4,
+        'jobs_submitted': 1,
+        'tasks_submitted': 4,
+        'group': 'users',
+    }
+    ret = await client.request('POST', '/datasets', data)
+    dataset_id = ret['result']
+
+    ret = await client.request('GET', f'/datasets/{dataset_id}')
+    last_update = ret['last_update']
+
+    ret = await client.request('GET', '/datasets', {'updated_since': last_update})
+    assert dataset_id in ret
+
+    await client.request('PUT', f'/datasets/{dataset_id}/status', {'status': 'suspended'})
+    ret = await client.request('GET', f'/datasets/{dataset_id}')
+    assert ret['last_update'] >= last_update
+
+    ret = await client.request('GET', '/datasets', {'updated_since': '2100-01-01T00:00:00'})
+    assert dataset_id not in ret
+
+
 async def test_rest_datasets_update_priority(server):
     client = server(roles=['user'], groups=['users'])
 
@@ -328,3 +355,34 @@ async def test_rest_datasets_summaries_status_with_groups(server):
     client2 = server(roles=['user'], groups=['filtering'], username='user2')
     ret = await client2.request('GET', '/dataset_summaries/status')
     assert ret == {}
+
+
+async def test_rest_datasets_get_filtered(server):
+    client = server(roles=['user'], groups=['simprod'])
+
+    data = {
+        'description': 'blah',
+        'tasks_per_job': 4,
+        'jobs_submitted': 1,
+        'tasks_submitted': 4,
+        'group': 'simprod',
+        'auth_groups_read': [],
+    }
+    ret = await client.request('POST', '/datasets', data)
+    dataset_id = ret['result']
+
+    data['group'] = 'users'
+    data['auth_groups_read'] = ['users']
+    ret = await client.request('POST', '/datasets', data)
+    dataset_id2 = ret['result']
+
+    ret = await client.request('GET', '/datasets')
+    assert set(ret) == {dataset_id, dataset_id2}
+
+    client2 = server(roles=['user'], groups=['users'], username='user2')
+    ret = await client2.request('GET', '/datasets')
+    assert set(ret) == {dataset_id2}
+
+    client3 = server(roles=['system'])
+    ret = await client3.request('GET', '/datasets')
+    assert set(ret) == {dataset_id, dataset_id2}
@@ -1,5 +1,8 @@
+import asyncio
+
 import pytest
 import requests.exceptions
+from rest_tools.utils.json_util import json_decode
 
 import iceprod.server.states
 
@@ -71,6 +74,27 @@ async def test_rest_jobs_dataset_get(server):
         assert data[k] == ret[job_id][k]
 
 
+async def test_rest_jobs_dataset_get_stream(server):
+    client = server(roles=['system'])
+
+    job_ids = []
+    for i in range(5):
+        ret = await client.request('POST', '/jobs', {'dataset_id': 'foo', 'job_index': i})
+        job_ids.append(ret['result'])
+
+    url, kwargs = client._prepare('GET', '/datasets/foo/jobs', {'stream': 'true', 'buffer_size': 2, 'keys': 'job_index'})
+    ret = await asyncio.wrap_future(client.session.request('GET', url, **kwargs))
+    ret.raise_for_status()
+    assert ret.headers['Content-Type'] == 'application/x-ndjson'
+    jobs = [json_decode(r) for r in ret.content.split(b'\n') if r.strip()]
+    assert sorted(j['job_id'] for j in jobs) == sorted(job_ids)
+    assert sorted(j['job_index'] for j in jobs) == list(range(5))
+
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client.request('GET', '/datasets/foo/jobs', {'stream': 'true', 'buffer_size': 0})
+    assert exc_info.value.response.status_code == 400
+
+
 async def test_rest_jobs_dataset_get_details(server):
     client = server(roles=['system'])
 
@@ -311,3 +335,83 @@ async def test_rest_jobs_dataset_counts_status(server):
 
     ret = await client.request('GET', f'/datasets/{data["dataset_id"]}/job_counts/status')
     assert ret == {'processing': 1}
+
+
+async def test_rest_jobs_dataset_bulk_materialize(server):
+    client = server(roles=['system'])
+
+    data = {
+        'description': 'blah',
+        'tasks_per_job': 2,
+        'jobs_submitted': 3,
+        'tasks_submitted': 6,
+        'group': 'users',
+        'username': 'fbar',
+    }
+    ret = await client.request('POST', '/datasets', data)
+    dataset_id = ret['result']
+
+    data = {
+        'jobs': [
+            {'job_index': 0, 'tasks': [
+                {'task_index': 0, 'name': 'foo', 'depends': [], 'requirements': {}, 'priority': .5},
+                {'task_index': 1, 'name': 'bar', 'depends': [0], 'requirements': {'cpu': 2}, 'priority': .6},
+            ]},
+            {'job_index': 1, 'tasks': [
+                {'task_index': 0, 'name': 'foo', 'depends': [], 'requirements': {}, 'priority': .5},
+                {'task_index': 1, 'name': 'bar', 'depends': [0], 'requirements': {'cpu': 2}, 'priority': .6},
+            ]},
+        ],
+    }
+    ret = await client.request('POST', f'/datasets/{dataset_id}/job_actions/bulk_materialize', data)
+    results = ret['results']
+    assert [r['job_index'] for r in results] == [0, 1]
+    assert all(r['created'] for r in results)
+
+    job_id = results[0]['job_id']
+    task_ids = results[0]['task_ids']
+    ret = await client.request('GET', f'/jobs/{job_id}')
+    assert ret['job_index'] == 0
+    assert ret['status'] == iceprod.server.states.JOB_STATUS_START
+
+    ret = await client.request('GET', f'/tasks/{task_ids[1]}')
+    assert ret['job_id'] == job_id
+    assert ret['depends'] == [task_ids[0]]
+    assert ret['priority'] == .6
+    assert ret['status'] == iceprod.server.states.TASK_STATUS_START
+
+    ret = await client.request('GET', f'/datasets/{dataset_id}/task_counts/status')
+    assert ret == {iceprod.server.states.TASK_STATUS_START: 4}
+
+    # retry is idempotent on job_index
+    data['jobs'].append({'job_index': 2, 'tasks': [
+        {'task_index': 0, 'name': 'foo', 'depends': [], 'requirements': {}, 'priority': .5},
+    ]})
+    ret = await client.request('POST', f'/datasets/{dataset_id}/job_actions/bulk_materialize', data)
+    results2 = ret['results']
+    assert [r['created'] for r in results2] == [False, False, True]
+    assert results2[0]['job_id'] == job_id
+    assert results2[0]['task_ids'] == task_ids
+    assert results2[1]['task_ids'] == results[1]['task_ids']
+    assert len(results2[2]['task_ids']) == 1
+
+    ret = await client.request('GET', f'/datasets/{dataset_id}/jobs')
+    assert len(ret) == 3
+    ret = await client.request('GET', f'/datasets/{dataset_id}/task_counts/status')
+    assert ret == {iceprod.server.states.TASK_STATUS_START: 5}
+
+    # bad depends
+    data = {'jobs': [{'job_index': 5, 'tasks': [
+        {'task_index': 0, 'name': 'foo', 'depends': [0], 'requirements': {}, 'priority': .5},
+    ]}]}
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client.request('POST', f'/datasets/{dataset_id}/job_actions/bulk_materialize', data)
+    assert exc_info.value.response.status_code == 400
+
+    # unknown dataset
+    data = {'jobs': [{'job_index': 0, 'tasks': [
+        {'task_index': 0, 'name': 'foo', 'depends': [], 'requirements': {}, 'priority': .5},
+    ]}]}
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client.request('POST', '/datasets/foo/job_actions/bulk_materialize', data)
+    assert exc_info.value.response.status_code == 404
@@ -152,6 +152,45 @@ async def test_rest_logs_s3_post(s3conn, server):
         s3conn.get_object(Bucket='iceprod2-logs', Key=log_id)
 
 
+async def test_rest_logs_bulk(s3conn, server):
+    client = server(roles=['system'])
+
+    data = {'logs': [
+        {'data': 'foo', 'dataset_id': 'd', 'task_id': 't', 'name': 'stdout'},
+        {'data': fake_data(2000000), 'dataset_id': 'd', 'task_id': 't', 'name': 'stderr'},
+        {'dataset_id': 'd', 'task_id': 't', 'name': 'stdlog'},
+    ]}
+    ret = await client.request('POST', '/logs/bulk', data)
+    results = ret['results']
+    assert len(results) == 3
+    assert 'upload_url' not in results[0]
+    assert 'upload_url' not in results[1]
+    assert results[2]['upload_url']
+
+    ret = await client.request('GET', f'/logs/{results[0]["log_id"]}')
+    assert ret['data'] == 'foo'
+    assert ret['name'] == 'stdout'
+
+    body = s3conn.get_object(Bucket='iceprod2-logs', Key=results[1]['log_id'])['Body'].read().decode('utf-8')
+    assert body == data['logs'][1]['data']
+
+    # the presigned log is hidden until the upload is confirmed
+    ret = await client.request('GET', '/logs', {'task_id': 't', 'keys': 'log_id|name'})
+    assert len(ret) == 2
+
+    with pytest.raises(Exception):
+        await client.request('PATCH', f'/logs/{results[2]["log_id"]}')
+
+    s3conn.put_object(Bucket='iceprod2-logs', Key=results[2]['log_id'], Body=b'bar')
+    await client.request('PATCH', f'/logs/{results[2]["log_id"]}')
+
+    ret = await client.request('GET', '/logs', {'task_id': 't', 'keys': 'log_id|name'})
+    assert len(ret) == 3
+
+    with pytest.raises(Exception):
+        await client.request('POST', '/logs/bulk', {})
+
+
 async def test_rest_logs_s3_get(s3conn, server):
     client = server(roles=['system'])
 
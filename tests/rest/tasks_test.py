@@ -1,6 +1,10 @@
+import asyncio
 from collections import Counter
+import os
 import pytest
 import requests.exceptions
+from pymongo import AsyncMongoClient
+from rest_tools.utils.json_util import json_decode
 from iceprod.server import states
 
 
@@ -77,6 +81,33 @@ async def test_rest_tasks_get(server):
     assert ret['tasks'][0]['task_id'] == task_id
 
 
+async def test_rest_tasks_get_stream(server):
+    client = server(roles=['system'])
+
+    task_ids = []
+    for i in range(5):
+        data = {
+            'dataset_id': 'foo',
+            'job_id': 'foo1',
+            'task_index': i,
+            'job_index': 0,
+            'name': 'bar',
+            'depends': [],
+            'requirements': {},
+        }
+        ret = await client.request('POST', '/tasks', data)
+        task_ids.append(ret['result'])
+
+    args = {'stream': 'true', 'buffer_size': 2, 'sort': 'task_index', 'keys': 'task_id|task_index'}
+    url, kwargs = client._prepare('GET', '/tasks', args)
+    ret = await asyncio.wrap_future(client.session.request('GET', url, **kwargs))
+    ret.raise_for_status()
+    assert ret.headers['Content-Type'] == 'application/x-ndjson'
+    tasks = [json_decode(r) for r in ret.content.split(b'\n') if r.strip()]
+    assert [t['task_id'] for t in tasks] == task_ids
+    assert set(tasks[0]) == {'task_id', 'task_index'}
+
+
 async def test_rest_tasks_get_by_site(server):
     client = server(roles=['system'])
 
@@ -342,6 +373,73 @@ async def test_rest_tasks_dataset_counts_name_status(server):
     assert ret == {'bar': {states.TASK_STATUS_START: 1}}
 
 
+async def test_rest_tasks_dataset_counters(server):
+    client = server(roles=['system'])
+
+    task_ids = []
+    for i,name in enumerate(('bar', 'baz')):
+        data = {
+            'dataset_id': 'foo',
+            'job_id': 'foo1',
+            'task_index': i,
+            'job_index': 0,
+            'name': name,
+            'depends': [],
+            'requirements': {},
+            'status': 'waiting',
+        }
+        ret = await client.request('POST', '/tasks', data)
+        task_ids.append(ret['result'])
+
+    async def check(expected):
+        ret = await client.request('GET', '/datasets/foo/task_counts/name_status')
+        assert ret == expected
+        assert list(ret) == list(expected)
+        ret = await client.request('POST', '/datasets/foo/task_counts/rebuild')
+        assert ret == {'drift': {}}
+
+    await check({'bar': {'waiting': 1}, 'baz': {'waiting': 1}})
+
+    ret = await client.request('POST', '/task_actions/queue', {})
+    task = ret
+    await check({task['name']: {'queued': 1}, ({'bar','baz'}-{task['name']}).pop(): {'waiting': 1}})
+
+    await client.request('PUT', f'/tasks/{task["task_id"]}/status', {'status': 'processing', 'instance_id': task['instance_id']})
+    await client.request('POST', f'/tasks/{task["task_id"]}/task_actions/complete', {'instance_id': task['instance_id']})
+    ret = await client.request('GET', '/datasets/foo/task_counts/status')
+    assert ret == {'waiting': 1, 'complete': 1}
+
+    await client.request('POST', '/datasets/foo/task_actions/bulk_suspend', {})
+    await check({task['name']: {'complete': 1}, ({'bar','baz'}-{task['name']}).pop(): {'suspended': 1}})
+
+    await client.request('POST', '/datasets/foo/task_actions/bulk_hard_reset', {})
+    await check({'bar': {'waiting': 1}, 'baz': {'waiting': 1}})
+
+    # introduce drift
+    db_url = os.environ['DB_URL'].rsplit('/', 1)[0]
+    db = AsyncMongoClient(db_url)['tasks']
+    await db.task_counters.update_one({'dataset_id': 'foo', 'name': 'bar', 'status': 'waiting'}, {'$inc': {'count': 2}})
+
+    ret = await client.request('POST', '/datasets/foo/task_counts/rebuild')
+    assert ret == {'drift': {'bar': {'waiting': -2}}}
+    await check({'bar': {'waiting': 1}, 'baz': {'waiting': 1}})
+
+    # lazy rebuild of missing counters
+    await db.task_counters.delete_many({})
+    await db.task_counter_datasets.delete_many({})
+    ret = await client.request('GET', '/datasets/foo/task_counts/status')
+    assert ret == {'waiting': 2}
+
+    # a status change on a dataset without counters rebuilds them first
+    await db.task_counters.delete_many({})
+    await db.task_counter_datasets.delete_many({})
+    await client.request('PUT', f'/tasks/{task_ids[0]}/status', {'status': 'suspended'})
+    ret = await client.request('GET', '/datasets/foo/task_counts/status')
+    assert ret == {'waiting': 1, 'suspended': 1}
+    ret = await client.request('POST', '/datasets/foo/task_counts/rebuild')
+    assert ret == {'drift': {}}
+
+
 async def test_rest_tasks_dataset_stats(server):
     client = server(roles=['system'])
 
@@ -871,6 +969,115 @@ async def test_rest_tasks_actions_complete(server):
     assert exc_info.value.response.status_code == 400
 
 
+async def test_rest_tasks_actions_bulk_transitions(server):
+    client = server(roles=['system'])
+
+    task_ids = []
+    for i in range(4):
+        data = {
+            'dataset_id': 'foo',
+            'job_id': 'foo1',
+            'task_index': i,
+            'job_index': 0,
+            'status': 'queued',
+            'priority': .5,
+            'name': f'bar{i}',
+            'depends': [],
+            'requirements': {'memory': 1.},
+            'instance_id': f'inst{i}',
+        }
+        ret = await client.request('POST', '/tasks', data)
+        task_ids.append(ret['result'])
+
+    args = {'transitions': [
+        {'task_id': task_ids[0], 'instance_id': 'inst0', 'action': 'processing', 'site': 'here'},
+        {'task_id': task_ids[1], 'instance_id': 'inst1', 'action': 'complete', 'time_used': 3600},
+        {'task_id': task_ids[2], 'instance_id': 'inst2', 'action': 'reset', 'resources': {'memory': 3.}},
+        {'task_id': task_ids[3], 'instance_id': 'inst3', 'action': 'failed'},
+        {'task_id': task_ids[0], 'instance_id': 'inst0', 'action': 'complete'},
+        {'task_id': 'missing', 'instance_id': 'inst0', 'action': 'complete'},
+        {'task_id': task_ids[1], 'action': 'complete'},
+        {'task_id': task_ids[1], 'instance_id': 'inst1', 'action': 'foo'},
+    ]}
+    ret = await client.request('POST', '/task_actions/bulk_transitions', args)
+    assert [r['code'] for r in ret['results']] == [200, 200, 200, 200, 400, 404, 400, 400]
+    assert ret['results'][0]['task_id'] == task_ids[0]
+
+    ret = await client.request('GET', f'/tasks/{task_ids[0]}')
+    assert ret['status'] == 'processing'
+    assert ret['site'] == 'here'
+    ret = await client.request('GET', f'/tasks/{task_ids[1]}')
+    assert ret['status'] == 'complete'
+    assert ret['walltime'] == 1.
+    ret = await client.request('GET', f'/tasks/{task_ids[2]}')
+    assert ret['status'] == 'waiting'
+    assert ret['failures'] == 1
+    assert ret['requirements']['memory'] == 4.5
+    ret = await client.request('GET', f'/tasks/{task_ids[3]}')
+    assert ret['status'] == 'failed'
+
+    # duplicate calls are ok, bad transitions are not
+    args = {'transitions': [
+        {'task_id': task_ids[0], 'instance_id': 'inst0', 'action': 'processing'},
+        {'task_id': task_ids[1], 'instance_id': 'inst1', 'action': 'processing'},
+        {'task_id': task_ids[0], 'instance_id': 'inst0', 'action': 'queued'},
+    ]}
+    ret = await client.request('POST', '/task_actions/bulk_transitions', args)
+    assert [r['code'] for r in ret['results']] == [200, 400, 400]
+
+    ret = await client.request('POST', '/datasets/foo/task_counts/rebuild')
+    assert ret == {'drift': {}}
+
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client.request('POST', '/task_actions/bulk_transitions', {})
+    assert exc_info.value.response.status_code == 400
+
+
+async def test_rest_tasks_actions_bulk_priority(server):
+    client = server(roles=['system'])
+
+    task_ids = []
+    for i in range(3):
+        data = {
+            'dataset_id': 'foo',
+            'job_id': 'foo1',
+            'task_index': i,
+            'job_index': 0,
+            'status': 'waiting',
+            'priority': .5,
+            'name': f'bar{i}',
+            'depends': [],
+            'requirements': {},
+        }
+        ret = await client.request('POST', '/tasks', data)
+        task_ids.append(ret['result'])
+
+    args = {'priorities': {
+        task_ids[0]: .1,
+        task_ids[1]: 1,
+        task_ids[2]: 'foo',
+        'missing': .3,
+    }}
+    ret = await client.request('POST', '/task_actions/bulk_priority', args)
+    assert {k: v['code'] for k, v in ret['results'].items()} == {
+        task_ids[0]: 200,
+        task_ids[1]: 200,
+        task_ids[2]: 400,
+        'missing': 404,
+    }
+
+    ret = await client.request('GET', f'/tasks/{task_ids[0]}')
+    assert ret['priority'] == .1
+    ret = await client.request('GET', f'/tasks/{task_ids[1]}')
+    assert ret['priority'] == 1
+    ret = await client.request('GET', f'/tasks/{task_ids[2]}')
+    assert ret['priority'] == .5
+
+    with pytest.raises(requests.exceptions.HTTPError) as exc_info:
+        await client.request('POST', '/task_actions/bulk_priority', {})
+    assert exc_info.value.response.status_code == 400
+
+
 async def test_rest_tasks_actions_bulk_status(server):
     client = server(roles=['system'])
 
@@ -7,6 +7,7 @@ from datetime import datetime, timedelta, UTC
 from unittest.mock import MagicMock, AsyncMock
 
 import pytest
+from iceprod.common.cleanup import AsyncCleaner
 from iceprod.scheduled_tasks import job_temp_cleaning
 
 logger = logging.getLogger('scheduled_tasks_job_temp_cleaning_test')
@@ -104,3 +105,17 @@ async def test_scheduled_tasks_job_temp_cleaning_run():
     assert rc.request.await_count == 0
     listdir.assert_awaited()
     rmtree.assert_not_awaited()
+
+
+async def test_scheduled_tasks_job_temp_cleaning_list_dirs(tmp_path):
+    (tmp_path / '0' / '1').mkdir(parents=True)
+    (tmp_path / '0' / '2').mkdir(parents=True)
+    (tmp_path / '3').mkdir(parents=True)
+    (tmp_path / 'file').write_text('foo')
+
+    cleaner = AsyncCleaner()
+    ret = await job_temp_cleaning.list_dataset_job_dirs_fs(cleaner, str(tmp_path))
+    assert {k: sorted(v) for k, v in ret.items()} == {'0': ['1', '2'], '3': []}
+
+    ret = await job_temp_cleaning.list_dataset_job_dirs_fs(cleaner, str(tmp_path), prefix='0')
+    assert {k: sorted(v) for k, v in ret.items()} == {'0': ['1', '2']}
@@ -0,0 +1,46 @@
+"""
+Test script for scheduled_tasks/task_counts_check
+"""
+
+import logging
+from unittest.mock import MagicMock
+
+import pytest
+from iceprod.scheduled_tasks import task_counts_check
+
+logger = logging.getLogger('scheduled_tasks_task_counts_check_test')
+
+
+async def test_200_run():
+    rc = MagicMock()
+    dataset_summaries = {'processing': ['foo'], 'suspended': ['bar'], 'complete': ['baz']}
+    async def client(method, url, args=None):
+        logger.info('REST: %s, %s', method, url)
+        if url.startswith('/dataset_summaries'):
+            return dataset_summaries
+        elif url.endswith('/task_counts/rebuild') and method == 'POST':
+            client.called.append(url.split('/')[2])
+            return {'drift': {'generate': {'waiting': 1}}}
+        else:
+            raise Exception()
+    client.called = []
+    rc.request = client
+
+    await task_counts_check.run(rc, debug=True)
+    assert client.called == ['foo', 'bar']
+
+
+async def test_201_run():
+    rc = MagicMock()
+    async def client(method, url, args=None):
+        logger.info('REST: %s, %s', method, url)
+        if url.startswith('/dataset_summaries'):
+            return {'processing': ['foo']}
+        else:
+            raise Exception()
+    rc.request = client
+
+    await task_counts_check.run(rc)
+
+    with pytest.raises(Exception):
+        await task_counts_check.run(rc, debug=True)
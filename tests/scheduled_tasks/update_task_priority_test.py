@@ -15,9 +15,10 @@ async def test_200_run():
     rc = MagicMock()
     async def client(method, url, args=None):
         logger.info('REST: %s, %s', method, url)
-        if url == '/tasks/bar':
+        if url == '/task_actions/bulk_priority':
+            assert list(args['priorities']) == ['bar']
             client.called = True
-            return {}
+            return {'results': {'bar': {'code': 200, 'reason': ''}}}
         elif url == '/tasks':
             return {'tasks':[{'task_id':'bar','dataset_id':'foo'}]}
         elif url == '/datasets':
@@ -0,0 +1,49 @@
+"""
+Test script for file_watcher
+"""
+import asyncio
+
+import pytest
+
+from iceprod.server.file_watcher import FileWatcher
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+async def test_file_watcher(tmp_path, use_inotify):
+    path = tmp_path / 'foo.log'
+    path.write_text('foo\n')
+
+    w = FileWatcher(poll_interval=.01, use_inotify=use_inotify)
+    if not use_inotify:
+        assert not w.inotify
+    w.add(path)
+    try:
+        w.clear()
+        assert not await w.wait(timeout=.05)
+
+        async def append():
+            await asyncio.sleep(.05)
+            with path.open('a') as f:
+                f.write('bar\n')
+
+        t = asyncio.create_task(append())
+        assert await w.wait(timeout=5)
+        await t
+
+        # change is latched until cleared
+        assert await w.wait(timeout=0)
+        w.clear()
+        assert not await w.wait(timeout=.05)
+
+        # changes between clear and wait are not lost
+        with path.open('a') as f:
+            f.write('baz\n')
+        assert await w.wait(timeout=5)
+
+        w.remove(path)
+        w.clear()
+        with path.open('a') as f:
+            f.write('baz\n')
+        assert not await w.wait(timeout=.05)
+    finally:
+        w.close()
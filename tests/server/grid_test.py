@@ -1,3 +1,4 @@
+import asyncio
 from collections import Counter
 from dataclasses import dataclass
 import logging
@@ -308,23 +309,55 @@ class GT(iceprod.server.grid.GridTask):
     instance_id: str | None = None
 
 
-async def test_grid_upload_log():
-    override = ['queue.type=test']
+async def test_grid_upload_logs(i3prod_path, monkeypatch):
+    override = ['queue.type=test', 'queue.log_s3_size=100']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
 
     rc = MagicMock()
-    rc.request = AsyncMock()
+    rc.request = AsyncMock(return_value={'results': [{'log_id': 'a'}, {'log_id': 'b', 'upload_url': 'http://s3/b'}, {'log_id': 'c'}]})
     g = iceprod.server.grid.BaseGrid(cfg=cfg, rest_client=rc, cred_client=None)
 
+    put = MagicMock()
+    monkeypatch.setattr(requests, 'put', put)
+
     task = GT(dataset_id='ddd', task_id='ttt')
-    name = 'name'
-    data = 'the log\ndata'
-    await g._upload_log(task, name=name, data=data)
+    outfile = i3prod_path / 'outfile'
+    outfile.write_text('out data')
+    errfile = i3prod_path / 'errfile'
+    errfile.write_text('e' * 1000)
+    await g._upload_logs(task, {
+        'stdout': outfile,
+        'stderr': errfile,
+        'stdlog': 'reason',
+        'missing': i3prod_path / 'missing',
+    })
 
-    assert rc.request.call_count == 1
+    # one request for all logs, with large files sent to S3
+    assert rc.request.call_count == 2
+    assert rc.request.call_args_list[0].args[:2] == ('POST', '/logs/bulk')
+    logs = rc.request.call_args_list[0].args[-1]['logs']
+    assert [log['name'] for log in logs] == ['stdout', 'stderr', 'stdlog']
+    assert logs[0]['data'] == 'out data'
+    assert 'data' not in logs[1]
+    assert logs[2]['data'] == 'reason'
+    assert put.call_count == 1
+    assert put.call_args.args[0] == 'http://s3/b'
+
+    # the S3 upload is confirmed
+    assert rc.request.call_args_list[1].args == ('PATCH', '/logs/b')
+
+    # a failed S3 upload deletes the pending log
+    rc.request.reset_mock()
+    put.side_effect = requests.exceptions.HTTPError()
+    await g._upload_logs(task, {'stdout': outfile, 'stderr': errfile})
+    assert rc.request.call_args_list[1].args == ('DELETE', '/logs/b')
 
     rc.request = AsyncMock(side_effect=requests.exceptions.HTTPError())
-    await g._upload_log(task, name=name, data=data)
+    await g._upload_logs(task, {'stdout': outfile})
+
+    rc.request = AsyncMock()
+    await g._upload_logs(task, {'missing': i3prod_path / 'missing'})
+    assert rc.request.call_count == 0
 
 
 async def test_grid_upload_stats():
@@ -411,6 +444,11 @@ async def test_grid_task_reset():
 
     assert rc.request.call_count == 1
 
+    # the reason is uploaded as a log
+    await g.task_reset(task, reason='reason')
+    assert rc.request.call_args.args[:2] == ('POST', '/logs/bulk')
+    assert rc.request.call_args.args[-1]['logs'][0]['data'] == 'reason'
+
     response = MagicMock()
     response.status_code = 404
     rc.request = AsyncMock(side_effect=requests.exceptions.HTTPError(response=response))
@@ -467,7 +505,8 @@ async def test_grid_task_failure(i3prod_path):
     errfile = i3prod_path / 'errfile'
     errfile.write_text('err message')
     await g.task_failure(task, stdout=outfile, stderr=errfile, reason='reason')
-    assert rc.request.call_count == 4
+    assert rc.request.call_count == 2
+    assert [log['name'] for log in rc.request.call_args.args[-1]['logs']] == ['stdout', 'stderr', 'stdlog']
 
 
 async def test_grid_task_success(i3prod_path):
@@ -509,6 +548,62 @@ async def test_grid_task_success(i3prod_path):
     errfile = i3prod_path / 'errfile'
     errfile.write_text('err message')
     await g.task_success(task, stdout=outfile, stderr=errfile)
-    assert rc.request.call_count == 3
+    assert rc.request.call_count == 2
 
 
+
+
+async def test_grid_task_actions_batched():
+    override = ['queue.type=test', 'queue.task_action_batch_size=3']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    async def client(method, url, args=None):
+        assert method == 'POST'
+        assert url == '/task_actions/bulk_transitions'
+        client.batches.append([t['action'] for t in args['transitions']])
+        codes = {'ttt0': 200, 'ttt1': 404, 'ttt2': 400, 'ttt3': 200}
+        return {'results': [{'task_id': t['task_id'], 'code': codes[t['task_id']], 'reason': ''} for t in args['transitions']]}
+    client.batches = []
+    rc.request = client
+    g = iceprod.server.grid.BaseGrid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    tasks = [GT(dataset_id='ddd', task_id=f'ttt{i}', instance_id='iii') for i in range(4)]
+    ret = await asyncio.gather(
+        g.task_idle(tasks[0]),
+        g.task_processing(tasks[1]),
+        g.task_success(tasks[2]),
+        g.task_reset(tasks[3]),
+        return_exceptions=True,
+    )
+    assert client.batches == [['queued', 'processing', 'complete'], ['reset']]
+    assert ret[0] is None
+    assert ret[1] is None  # 404 is ignored
+    assert isinstance(ret[2], requests.exceptions.HTTPError)
+    assert ret[2].response.status_code == 400
+    assert ret[3] is None
+
+    # same task goes in separate batches
+    client.batches = []
+    await asyncio.gather(
+        g.task_idle(tasks[0]),
+        g.task_processing(tasks[0]),
+    )
+    assert client.batches == [['queued'], ['processing']]
+
+    # request errors are raised for each action
+    response = MagicMock()
+    response.status_code = 500
+    rc.request = AsyncMock(side_effect=requests.exceptions.HTTPError(response=response))
+    with pytest.raises(requests.exceptions.HTTPError):
+        await g.task_idle(tasks[0])
+
+    # missing results fail instead of hanging
+    rc.request = AsyncMock(return_value={'results': [{'task_id': 'ttt0', 'code': 200, 'reason': ''}]})
+    ret = await asyncio.wait_for(asyncio.gather(
+        g.task_idle(tasks[0]),
+        g.task_idle(tasks[3]),
+        return_exceptions=True,
+    ), timeout=5)
+    assert ret[0] is None
+    assert isinstance(ret[1], Exception)
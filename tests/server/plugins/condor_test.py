@@ -1,3 +1,4 @@
+import asyncio
 from collections import Counter
 import datetime
 import json
@@ -5,19 +6,20 @@ import logging
 from pathlib import Path
 import os
 import shutil
+import threading
 import time
 from unittest.mock import MagicMock, AsyncMock
 
 import htcondor2 as htcondor
 import pytest
 
-from iceprod.core.config import Job, Task
+from iceprod.core.config import Dataset, Job, Task
 from iceprod.core.exe import Data, Transfer
 import iceprod.server.config
 import iceprod.server.grid
 from iceprod.server.util import datetime2str
 import iceprod.server.plugins.condor
-from iceprod.server.plugins.condor import CondorJob, CondorJobId, JobStatus
+from iceprod.server.plugins.condor import CondorJob, CondorJobId, CondorJobs, JobStatus
 
 htcondor.enable_debug()
 
@@ -61,6 +63,97 @@ def test_CondorJobId():
     assert str(j1) == '0.0'
 
 
+def test_CondorJobs():
+    jobs = CondorJobs()
+    j1 = CondorJobId(cluster_id=1, proc_id=0)
+    j2 = CondorJobId(cluster_id=2, proc_id=0)
+    jobs[j1] = CondorJob(submit_dir=Path('/foo'))
+    jobs.update({j2: CondorJob()})
+    assert jobs.get_by_submit_dir(Path('/foo')) == [j1]
+    assert jobs.get_by_submit_dir(Path('/bar')) == []
+
+    jobs[j2].submit_dir = Path('/foo')
+    jobs.reindex(j2)
+    assert set(jobs.get_by_submit_dir(Path('/foo'))) == {j1, j2}
+
+    jobs[j1] = CondorJob(submit_dir=Path('/bar'))
+    assert jobs.get_by_submit_dir(Path('/foo')) == [j2]
+    assert jobs.get_by_submit_dir(Path('/bar')) == [j1]
+
+    del jobs[j2]
+    assert jobs.get_by_submit_dir(Path('/foo')) == []
+    jobs.pop(j1)
+    assert jobs.get_by_submit_dir(Path('/bar')) == []
+    assert jobs == {}
+
+
+def test_CondorJobs_benchmark():
+    """Look up 50k submit dirs against 50k jobs"""
+    num = 50000
+    start = time.monotonic()
+    jobs = CondorJobs({
+        CondorJobId(cluster_id=i, proc_id=0): CondorJob(submit_dir=Path(f'/submit/2024-10-10T10/{i}'))
+        for i in range(num)
+    })
+    found = 0
+    for i in range(num):
+        found += len(jobs.get_by_submit_dir(Path(f'/submit/2024-10-10T10/{i+num//2}')))
+    for i in range(num):
+        del jobs[CondorJobId(cluster_id=i, proc_id=0)]
+    duration = time.monotonic() - start
+    logging.info('benchmark: %d jobs and dirs in %.3f seconds', num, duration)
+
+    assert found == num // 2
+    assert not jobs
+    assert duration < 10
+
+
+def test_QueueController():
+    q = iceprod.server.plugins.condor.QueueController(idle_time=100, min_idle=5, max_latency=10, window=100, now=1000)
+
+    # use the hard cap until the window fills
+    d = q.size(idle=0, cap=50, now=1050)
+    assert d.num == 50
+
+    # no activity, so keep the min idle
+    d = q.size(idle=0, cap=50, now=1100)
+    assert d.num == 5
+    d = q.size(idle=10, cap=50, now=1100)
+    assert d.num == 0
+
+    # 1 job start/sec -> 100 idle jobs
+    for i in range(100):
+        q.observe_start(1001 + i)
+    d = q.size(idle=20, cap=1000, now=1100)
+    assert d.start_rate == 1.
+    assert d.target_idle == 100
+    assert d.num == 80
+
+    # hard cap
+    d = q.size(idle=20, cap=30, now=1100)
+    assert d.num == 30
+
+    # completions drive the target when higher
+    for i in range(200):
+        q.observe_completion(1001 + i/2)
+    d = q.size(idle=20, cap=1000, now=1100)
+    assert d.completion_rate == 2.
+    assert d.num == 180
+
+    # slow schedd backs off
+    for _ in range(100):
+        q.observe_latency(20)
+    d = q.size(idle=20, cap=1000, now=1100)
+    assert 19 < d.schedd_latency <= 20
+    assert 85 <= d.num <= 95
+
+    # old events expire
+    d = q.size(idle=0, cap=1000, now=1300)
+    assert d.start_rate == 0
+    assert d.completion_rate == 0
+    assert d.num < 5
+
+
 def test_CondorSubmit_init(schedd):
     override = ['queue.type=condor']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -71,6 +164,27 @@ def test_CondorSubmit_init(schedd):
     assert set(sub.transfer_plugins.keys()) == {'gsiftp', 'iceprod-plugin'}
 
 
+async def test_CondorSubmit_call_latency(schedd, i3prod_path):
+    override = ['queue.type=condor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+    sub = iceprod.server.plugins.condor.CondorSubmit(cfg=cfg, submit_dir=i3prod_path/'submit', credentials_dir=i3prod_path/'creds')
+    sub.latency_callback = MagicMock()
+
+    def slow(ret, delay=.1):
+        time.sleep(delay)
+        return ret
+
+    # only the call itself is timed, not waiting for the previous call
+    ret = await asyncio.gather(sub.call(slow, 1), sub.call(slow, 2, delay=0))
+    assert ret == [1, 2]
+    assert sub.latency_callback.call_count == 2
+    assert sub.latency_callback.call_args_list[1].args[0] < .05
+
+    # bulk calls are not timed
+    assert await sub.call(slow, 3, latency=False) == 3
+    assert sub.latency_callback.call_count == 2
+
+
 @pytest.mark.parametrize("os_arch,container", [
     ('RHEL_6_x86_64', 'el6'),
     ('RHEL_7_x86_64', 'el7'),
@@ -514,6 +628,99 @@ async def test_CondorSubmit_submit(schedd):
     assert 'if [ -f baz ]' in exe
     assert 'object put baz osdf:///baz' in exe
 
+def _submit_tasks(num, requirements=None):
+    dataset = Dataset('dataset', 0, num, num, 1, 'processing', 1., 'grp', 'usr', False, {
+        'tasks': [{
+            'name': 'generate',
+            'trays': [{
+                'modules': [{
+                    'name': 'foo',
+                    'src': 'foo.py',
+                    'args': '--seed=$(job)',
+                }]
+            }],
+        }]
+    })
+    dataset.fill_defaults()
+    dataset.validate()
+    tasks = []
+    for i in range(num):
+        job = Job(dataset=dataset, job_id=f'job{i}', job_index=i, status='processing')
+        tasks.append(Task(
+            dataset=dataset,
+            job=job,
+            task_id=f'task{i}',
+            task_index=0,
+            name='generate',
+            depends=[],
+            requirements=requirements(i) if requirements else {'cpu': 1},
+            status='queued',
+            site='site',
+            stats={},
+        ))
+    return tasks
+
+
+async def test_CondorSubmit_submit_cache(schedd, i3prod_path):
+    override = ['queue.type=condor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+    submit_dir = Path(os.path.expanduser(os.path.expandvars(cfg['queue']['submit_dir'])))
+    cred_dir = Path(os.path.expanduser(os.path.expandvars(cfg['queue']['credentials_dir'])))
+
+    sub = iceprod.server.plugins.condor.CondorSubmit(cfg=cfg, submit_dir=submit_dir, credentials_dir=cred_dir)
+    sub.condor_schedd.submit = MagicMock()
+
+    tasks = _submit_tasks(5, requirements=lambda i: {'gpu': 1} if i % 2 else {'cpu': 1})
+    jel = submit_dir / 'today' / 'condor.log'
+    validate = MagicMock(wraps=tasks[0].dataset.validate)
+    tasks[0].dataset.validate = validate
+    await sub.submit(tasks[:2], jel=jel)
+    await sub.submit(tasks[2:], jel=jel)
+
+    # dataset config is only validated once
+    assert validate.call_count == 1
+    assert len(sub._submit_headers) == 1
+
+    # per-task values are still filled in
+    for i in range(5):
+        exe = (submit_dir / 'today' / f'task{i}' / 'task_runner.sh').read_text()
+        assert f'--seed={i}' in exe
+
+    # tasks in the same resource bin share a requirements macro
+    submitfile = sub.condor_schedd.submit.call_args.args[0]
+    itemdata = list(sub.condor_schedd.submit.call_args.kwargs['itemdata'])
+    assert [item['reqs'] for item in itemdata] == ['reqsnone', 'reqs0', 'reqsnone']
+    assert 'GPUs_Capability' in submitfile['reqs0']
+
+    # a new dataset config is picked up
+    tasks = _submit_tasks(1)
+    await sub.submit(tasks, jel=jel)
+    assert sub.get_cfgparser(tasks[0].dataset).config is tasks[0].dataset.config
+
+
+async def test_CondorSubmit_submit_benchmark(schedd, i3prod_path):
+    """Measure tasks submitted per second"""
+    override = ['queue.type=condor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+    submit_dir = Path(os.path.expanduser(os.path.expandvars(cfg['queue']['submit_dir'])))
+    cred_dir = Path(os.path.expanduser(os.path.expandvars(cfg['queue']['credentials_dir'])))
+
+    sub = iceprod.server.plugins.condor.CondorSubmit(cfg=cfg, submit_dir=submit_dir, credentials_dir=cred_dir)
+    sub.condor_schedd.submit = MagicMock()
+
+    num = 500
+    tasks = _submit_tasks(num, requirements=lambda i: {'cpu': 1 + i % 4, 'memory': 2.})
+    jel = submit_dir / 'today' / 'condor.log'
+    start = time.monotonic()
+    for i in range(0, num, 100):
+        await sub.submit(tasks[i:i+100], jel=jel)
+    duration = time.monotonic() - start
+    logging.info('benchmark: %d tasks in %.3f seconds = %.1f tasks/s', num, duration, num / duration)
+
+    assert sub.condor_schedd.submit.call_count == num // 100
+    assert len(list(submit_dir.glob('today/task*'))) == num
+
+
 async def test_Grid_save_load_timestamp(schedd, i3prod_path):
     override = ['queue.type=htcondor']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -529,6 +736,24 @@ async def test_Grid_save_load_timestamp(schedd, i3prod_path):
     assert g.last_event_timestamp == 12345.
 
 
+async def test_Grid_save_load_history_hwm(schedd, i3prod_path):
+    override = ['queue.type=htcondor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    g.history_completion_date = 12345
+    g.history_job_ids = {'1.0', '2.0'}
+    g.save_history_hwm()
+
+    g.history_completion_date = 0
+    g.history_job_ids = set()
+    g.load_history_hwm()
+    assert g.history_completion_date == 12345
+    assert g.history_job_ids == {'1.0', '2.0'}
+
+
 async def test_Grid_run(schedd, i3prod_path):
     override = ['queue.type=htcondor', 'queue.submit_interval=0', 'queue.check_time=0']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -717,7 +942,7 @@ async def test_Grid_wait_no_events(schedd, i3prod_path, set_time):
 
 
 async def test_Grid_wait_JEL(schedd, i3prod_path, set_time):
-    override = ['queue.type=htcondor']
+    override = ['queue.type=htcondor', 'queue.adaptive_queue=true']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
 
     rc = MagicMock()
@@ -747,6 +972,7 @@ async def test_Grid_wait_JEL(schedd, i3prod_path, set_time):
     assert g.jobs[CondorJobId(cluster_id=110828038, proc_id=0)].dataset_id == '4ksd8'
     assert g.jobs[CondorJobId(cluster_id=110828038, proc_id=0)].task_id == 'lnk3f'
     assert g.jobs[CondorJobId(cluster_id=110828038, proc_id=0)].submit_dir == Path('/scratch/dschultz')
+    assert CondorJobId(cluster_id=110828038, proc_id=0) in g.jobs.get_by_submit_dir(Path('/scratch/dschultz'))
     #assert g.jobs[CondorJobId(cluster_id=110828038, proc_id=0)].status == JobStatus.COMPLETED
     
     #assert g.jobs[CondorJobId(cluster_id=110828038, proc_id=1)].status == JobStatus.COMPLETED
@@ -761,6 +987,43 @@ async def test_Grid_wait_JEL(schedd, i3prod_path, set_time):
     assert g.task_reset.call_count == 0
     #assert g.finish.call_count == 6
 
+    # events are recorded for adaptive queue sizing, with the held job completing on hold
+    assert len(g.queue_controller.starts) == 7
+    assert len(g.queue_controller.completions) == 7
+
+
+async def test_Grid_wait_JEL_change(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    g.task_idle = AsyncMock()
+    g.task_processing = AsyncMock()
+    g.task_reset = AsyncMock()
+    g.finish = AsyncMock()
+
+    jel_path = g.get_current_JEL()
+    TEST_JEL = Path(__file__).parent / 'condor_test_logfile'
+
+    async def write_jel():
+        await asyncio.sleep(.1)
+        with jel_path.open('a') as f:
+            f.write(TEST_JEL.read_text())
+        while g.task_processing.call_count < 7:
+            await asyncio.sleep(.01)
+        return time.monotonic()
+
+    # the wait wakes up on the JEL change, well before the timeout
+    start = time.monotonic()
+    t = asyncio.create_task(write_jel())
+    await g.wait(timeout=1)
+    processed = await t
+    assert g.task_idle.call_count == 1
+    assert g.task_processing.call_count == 7
+    assert processed - start < 1
+
 
 async def test_Grid_wait_JEL_finish(schedd, i3prod_path, set_time):
     override = ['queue.type=htcondor']
@@ -862,6 +1125,34 @@ async def test_Grid_check_empty(schedd, i3prod_path, set_time):
     assert dirs == {}
 
 
+async def test_Grid_check_timeout(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor', 'queue.batch_timeout=.1']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    # a hung schedd query must not block the event loop
+    hung = threading.Event()
+    g.submitter.get_jobs = MagicMock(side_effect=lambda: hung.wait(5))
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(.01)
+
+    t = asyncio.create_task(ticker())
+    try:
+        with pytest.raises(TimeoutError):
+            await g.check()
+    finally:
+        t.cancel()
+        hung.set()
+    assert ticks > 1
+
+
 async def test_Grid_check_delete_day(schedd, i3prod_path, set_time):
     override = ['queue.type=htcondor', 'queue.max_task_queued_time=10', 'queue.max_task_processing_time=10', 'queue.suspend_submit_dir_time=10']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -887,6 +1178,34 @@ async def test_Grid_check_delete_day(schedd, i3prod_path, set_time):
     assert g.jels == {}
 
 
+async def test_Grid_check_delete_day_expired(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor', 'queue.max_task_queued_time=10', 'queue.max_task_processing_time=10', 'queue.suspend_submit_dir_time=10']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    g.submitter.get_jobs = MagicMock(return_value={})
+    g.submitter.get_history = MagicMock(return_value={})
+    g.submitter.remove = MagicMock()
+    g.get_tasks_on_queue = AsyncMock(return_value=[])
+
+    jel = g.get_current_JEL()
+    jels = dict(g.jels)
+
+    # run out of time after listing the daydirs, so the daydir is not scanned and must be kept
+    scandir = g.cleaner.scandir
+    async def scandir_expire(path):
+        ret = await scandir(path)
+        g.cleaner.time_budget = 0
+        return ret
+    g.cleaner.scandir = scandir_expire
+    await g.check()
+
+    assert jel.parent.exists()
+    assert g.jels == jels
+
+
 async def test_Grid_check_old_delete(schedd, i3prod_path, set_time):
     override = ['queue.type=htcondor', 'queue.max_task_queued_time=10', 'queue.max_task_processing_time=10', 'queue.suspend_submit_dir_time=10']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -943,6 +1262,39 @@ async def test_Grid_check_oldjob_remove(schedd, i3prod_path, set_time):
     assert g.submitter.remove.call_count == 1
 
 
+async def test_Grid_check_oldjob_remove_delete(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor', 'queue.max_task_queued_time=10', 'queue.max_task_processing_time=10', 'queue.suspend_submit_dir_time=10']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    jobs = {}
+    g.submitter.get_jobs = MagicMock(return_value=jobs)
+    g.submitter.get_history = MagicMock(return_value={})
+    g.get_tasks_on_queue = AsyncMock(return_value=[])
+
+    jel = g.get_current_JEL()
+    daydir = jel.parent
+    p = daydir / 'olddir'
+    p.mkdir()
+    t = time.mktime(set_time.utctimetuple()) - 35  # must be older than all times added together
+    os.utime(p, (t, t))
+    logging.info('set time to %d', t)
+
+    jobs[CondorJobId(cluster_id=1, proc_id=0)] = CondorJob(status=JobStatus.IDLE, submit_dir=p, task_id=p.name)
+
+    # the job is removed before its submit dir is deleted
+    exists = []
+    g.submitter.remove = MagicMock(side_effect=lambda *args, **kwargs: exists.append(p.exists()))
+
+    await g.check()
+
+    dirs = {x.name: [x for x in x.iterdir() if x.is_dir()] for x in g.submit_dir.glob('[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9]')}
+    assert dirs == {daydir.name: []}
+    assert exists == [True]
+
+
 async def test_Grid_check_oldjob_delete(schedd, i3prod_path, set_time):
     override = ['queue.type=htcondor', 'queue.max_task_queued_time=10', 'queue.max_task_processing_time=10', 'queue.suspend_submit_dir_time=10']
     cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
@@ -1061,6 +1413,126 @@ async def test_Grid_check_queue_jel_mismatch(schedd, i3prod_path, set_time, jel_
     assert g.finish.call_count == finish_calls
 
 
+async def test_Grid_check_history_incremental(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor', 'queue.history_batch_size=2']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+    g.finish = AsyncMock()
+
+    # history is newest first
+    hjobs = [
+        (CondorJobId(cluster_id=3, proc_id=0), CondorJob(extra={'CompletionDate': 300, 'JobStatus': 4, 'ExitCode': 0})),
+        (CondorJobId(cluster_id=2, proc_id=1), CondorJob(extra={'CompletionDate': 200, 'JobStatus': 4, 'ExitCode': 0})),
+        (CondorJobId(cluster_id=2, proc_id=0), CondorJob(extra={'CompletionDate': 200, 'JobStatus': 4, 'ExitCode': 0})),
+        (CondorJobId(cluster_id=1, proc_id=0), CondorJob(extra={'CompletionDate': 100, 'JobStatus': 4, 'ExitCode': 0})),
+        (CondorJobId(cluster_id=1, proc_id=1), CondorJob(extra={'CompletionDate': 100, 'JobStatus': 4, 'ExitCode': 1})),
+    ]
+    def get_history(since=None, before=None, limit=-1):
+        ret = []
+        for job_id, job in hjobs:
+            date = job.get('CompletionDate')
+            if before and (date > before[0] or (date == before[0] and job_id in before[1])):
+                continue
+            ret.append((job_id, job))
+        return iter(ret[:limit])
+    g.submitter.get_history = MagicMock(side_effect=get_history)
+    await g.check_history()
+
+    assert g.finish.call_count == 5
+    assert g.submitter.get_history.call_count == 3
+    assert g.submitter.get_history.call_args_list[1].kwargs['before'] == (200, {CondorJobId(cluster_id=2, proc_id=1)})
+    assert g.submitter.get_history.call_args_list[2].kwargs['before'] == (100, {CondorJobId(cluster_id=1, proc_id=0)})
+    assert g.history_completion_date == 300
+    assert g.history_job_ids == {'3.0'}
+
+    # the schedd returns jobs completed at or after the high-water mark
+    g.finish.reset_mock()
+    hjobs = [
+        (CondorJobId(cluster_id=4, proc_id=0), CondorJob(extra={'CompletionDate': 300, 'JobStatus': 4, 'ExitCode': 0})),
+        (CondorJobId(cluster_id=3, proc_id=0), CondorJob(extra={'CompletionDate': 300, 'JobStatus': 4, 'ExitCode': 0})),
+    ]
+    g.submitter.get_history = MagicMock(return_value=iter(hjobs))
+    await g.check_history()
+
+    assert g.submitter.get_history.call_args.kwargs['since'] == 300
+    assert g.finish.call_count == 1
+    assert g.finish.call_args.args[0] == CondorJobId(cluster_id=4, proc_id=0)
+    assert g.history_job_ids == {'3.0', '4.0'}
+
+    # restart from the saved high-water mark
+    g.history_completion_date = 0
+    g.history_job_ids = set()
+    g.load_history_hwm()
+    assert g.history_completion_date == 300
+    assert g.history_job_ids == {'3.0', '4.0'}
+
+
+async def test_Grid_check_incremental(schedd, i3prod_path, set_time):
+    override = ['queue.type=htcondor']
+    cfg = iceprod.server.config.IceProdConfig(save=False, override=override)
+
+    rc = MagicMock()
+    g = iceprod.server.plugins.condor.Grid(cfg=cfg, rest_client=rc, cred_client=None)
+
+    jel = g.get_current_JEL()
+    daydir = jel.parent
+    def mkjob(c, status):
+        p = daydir / f'{c}.0'
+        p.mkdir(exist_ok=True)
+        return CondorJob(dataset_id='d', task_id=f't{c}', instance_id='i', status=status, submit_dir=p)
+
+    qjobs = {CondorJobId(cluster_id=c, proc_id=0): mkjob(c, JobStatus.IDLE) for c in range(1, 4)}
+    g.submitter.get_jobs = MagicMock(return_value=qjobs)
+    g.submitter.get_job_states = MagicMock()
+    g.submitter.get_history = MagicMock(return_value=[])
+    g.submitter.remove = MagicMock()
+    g.job_update = AsyncMock()
+    g.get_tasks_on_queue = AsyncMock(return_value=[])
+
+    # first check is a full query
+    await g.check()
+    assert g.submitter.get_jobs.call_count == 1
+    assert g.submitter.get_job_states.call_count == 0
+    assert g.job_update.call_count == 3
+
+    # later checks only query job states, and only process changes
+    g.job_update.reset_mock()
+    g.submitter.get_job_states.return_value = {
+        CondorJobId(cluster_id=1, proc_id=0): JobStatus.IDLE,
+        CondorJobId(cluster_id=2, proc_id=0): JobStatus.RUNNING,
+        CondorJobId(cluster_id=3, proc_id=0): JobStatus.FAILED,
+        CondorJobId(cluster_id=4, proc_id=0): JobStatus.IDLE,
+    }
+    g.submitter.get_jobs.return_value = {CondorJobId(cluster_id=4, proc_id=0): mkjob(4, JobStatus.IDLE)}
+    await g.check()
+    assert g.submitter.get_job_states.call_count == 1
+    assert g.submitter.get_jobs.call_count == 2
+    assert g.submitter.get_jobs.call_args.kwargs['cluster_ids'] == {4}
+    assert {j.task_id for j in (c.args[0] for c in g.job_update.call_args_list)} == {'t2', 't4'}
+    assert g.submitter.remove.call_count == 1
+    assert g.jobs[CondorJobId(cluster_id=2, proc_id=0)].status == JobStatus.RUNNING
+
+    # nothing changed, so no updates
+    g.job_update.reset_mock()
+    g.submitter.remove.reset_mock()
+    g.submitter.get_job_states.return_value = {
+        CondorJobId(cluster_id=1, proc_id=0): JobStatus.IDLE,
+        CondorJobId(cluster_id=2, proc_id=0): JobStatus.RUNNING,
+    }
+    await g.check()
+    assert g.submitter.get_jobs.call_count == 2
+    assert g.job_update.call_count == 0
+    assert g.submitter.remove.call_count == 0
+    assert set(g.jobs) == {CondorJobId(cluster_id=1, proc_id=0), CondorJobId(cluster_id=2, proc_id=0)}
+
+    # full query after the interval
+    g.check_full_time -= g.check_full_interval
+    await g.check()
+    assert g.submitter.get_jobs.call_count == 3
+
+
 @pytest.mark.parametrize('queue_jobs,hist_jobs,iceprod_tasks,reset_calls', [
     ({(1,0): ("dataset", "task", "instance")},
      {},
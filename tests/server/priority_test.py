@@ -118,3 +118,130 @@ async def test_20_get_task_prio():
     prio4 = await p.get_task_prio('d2', 't5')
     assert prio3 < prio1 
     assert prio3 < prio4  # ordering of tasks in a job
+
+
+async def test_30_get_task_prios():
+    """Test get_task_prios matches get_task_prio"""
+    p = prio_setup()
+    tasks = [(d, t) for d in p.dataset_cache for t in p.dataset_cache[d]['tasks']]
+    expected = [await p.get_task_prio(d, t) for d, t in tasks]
+
+    p = prio_setup()
+    ret = await p.get_task_prios(tasks)
+    assert ret == expected
+
+    ret = await p.get_task_prios([('d0', 't0'), ('missing', 't0')])
+    assert ret == [expected[0], 0.]
+
+
+async def test_31_get_dataset_prios():
+    """Test get_dataset_prios matches get_dataset_prio"""
+    p = prio_setup()
+    expected = {d: await p.get_dataset_prio(d) for d in p.dataset_cache}
+    ret = await p.get_dataset_prios()
+    assert ret == expected
+
+
+async def test_40_get_task_prios_benchmark():
+    """Benchmark get_task_prios for 100k tasks across 1k datasets"""
+    num_datasets = 1000
+    tasks_per_dataset = 100
+    p = priority.Priority(None)
+    p.user_cache = {f'u{i}': {'username': f'u{i}', 'priority': .5} for i in range(10)}
+    tasks = []
+    for i in range(num_datasets):
+        dataset_id = f'd{i}'
+        p.dataset_cache[dataset_id] = {
+            'dataset_id': dataset_id,
+            'jobs_submitted': 1000,
+            'tasks_submitted': 2000,
+            'priority': 1 + i % 5,
+            'start_date': '2023-10-01T01:00:00',
+            'group': 'users' if i % 2 else 'simprod',
+            'username': f'u{i % 10}',
+            'tasks': {
+                f'{dataset_id}t{j}': {'task_id': f'{dataset_id}t{j}', 'task_index': j % 2, 'job_index': j // 2}
+                for j in range(tasks_per_dataset)
+            },
+        }
+        tasks.extend((dataset_id, task_id) for task_id in p.dataset_cache[dataset_id]['tasks'])
+
+    start = time.perf_counter()
+    ret = await p.get_task_prios(tasks)
+    duration = time.perf_counter() - start
+
+    assert len(ret) == num_datasets * tasks_per_dataset
+    assert all(0. <= x <= 1. for x in ret)
+    logger.info('get_task_prios: %d tasks in %.3fs, %.2f us/task', len(ret), duration, duration / len(ret) * 1e6)
+    assert duration / len(ret) < 1e-3
+
+
+async def test_50_priority_cache():
+    """Test PriorityCache full load and incremental refresh"""
+    rc = MagicMock()
+    datasets = {
+        'd0': {'dataset_id': 'd0', 'priority': 1, 'status': 'processing'},
+        'd1': {'dataset_id': 'd1', 'priority': 1, 'status': 'processing'},
+    }
+    tasks = {
+        'd0': {'t0': {'task_id': 't0', 'task_index': 0, 'job_index': 0}},
+        'd1': {'t1': {'task_id': 't1', 'task_index': 0, 'job_index': 0}},
+        'd2': {'t2': {'task_id': 't2', 'task_index': 0, 'job_index': 0}},
+    }
+    changed_tasks = []
+    requests = []
+
+    async def client(method, path, args=None):
+        requests.append((path, args))
+        if path == '/datasets':
+            return {k: dict(v) for k, v in datasets.items()}
+        elif path == '/tasks':
+            return {'tasks': changed_tasks}
+        elif path.startswith('/datasets/'):
+            return tasks[path.split('/')[2]]
+        raise Exception('unexpected path')
+    rc.request = client
+
+    cache = priority.PriorityCache(rc)
+    await cache.refresh()
+    assert set(cache.datasets) == {'d0', 'd1'}
+    assert cache.datasets['d0']['tasks'] == {'t0': {'task_index': 0, 'job_index': 0}}
+    assert requests[0] == ('/datasets', {'keys': priority.PriorityCache.DATASET_KEYS, 'status': 'processing'})
+    assert cache.last_refresh
+
+    # d0 changes priority, d1 finishes, d2 is new
+    requests.clear()
+    datasets = {
+        'd0': {'dataset_id': 'd0', 'priority': 2, 'status': 'processing'},
+        'd1': {'dataset_id': 'd1', 'priority': 1, 'status': 'complete'},
+        'd2': {'dataset_id': 'd2', 'priority': 1, 'status': 'processing'},
+    }
+    changed_tasks = [
+        {'task_id': 't0', 'dataset_id': 'd0', 'task_index': 0, 'job_index': 0, 'status': 'complete'},
+        {'task_id': 't3', 'dataset_id': 'd0', 'task_index': 0, 'job_index': 1, 'status': 'idle'},
+        {'task_id': 't4', 'dataset_id': 'd9', 'task_index': 0, 'job_index': 0, 'status': 'idle'},
+    ]
+    p = priority.Priority(rc, cache=cache)
+    await p.refresh()
+    assert p.dataset_cache is cache.datasets
+    assert set(cache.datasets) == {'d0', 'd2'}
+    assert cache.datasets['d0']['priority'] == 2
+    assert cache.datasets['d0']['tasks'] == {'t3': {'task_index': 0, 'job_index': 1}}
+    assert cache.datasets['d2']['tasks'] == {'t2': {'task_index': 0, 'job_index': 0}}
+    assert 'updated_since' in requests[0][1]
+    assert 'status' not in requests[0][1]
+    assert not any(path == '/datasets/d0/tasks' for path, _ in requests)
+
+
+async def test_60_get_new_task_prios():
+    """Test get_new_task_prios matches get_task_prios"""
+    p = prio_setup()
+    expected = await p.get_task_prios([('d2', 't4'), ('d2', 't5')])
+    indexes = [(p.dataset_cache['d2']['tasks'][t]['job_index'], p.dataset_cache['d2']['tasks'][t]['task_index']) for t in ('t4', 't5')]
+
+    p = prio_setup()
+    ret = await p.get_new_task_prios('d2', indexes)
+    assert ret == expected
+
+    ret = await p.get_new_task_prios('missing', indexes)
+    assert ret == [0., 0.]
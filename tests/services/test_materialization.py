@@ -1,11 +1,16 @@
+import asyncio
 import re
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 import requests
+from prometheus_client import REGISTRY
 from rest_tools.client import RestClient
+from tornado.web import HTTPError
 
-from iceprod.services.actions.materialization.materialize import Materialize
+from iceprod.services.actions.materialization.action import Action
+from iceprod.services.base import AuthData
+from iceprod.services.actions.materialization.materialize import Materialize, MaterializeRun
 
 
 async def test_materialization_server_request(server):
@@ -73,11 +78,12 @@ async def test_materialize_run_none(requests_mock):
 async def test_materialize_run_one_job(requests_mock):
     rc = RestClient('http://test.iceprod')
     m = Materialize(rc)
-    m.buffer_job = AsyncMock(return_value=1)
+    m.buffer_jobs = AsyncMock(return_value=1)
 
     requests_mock.get('http://test.iceprod/dataset_summaries/status', json={
         'processing': ['did123']
     })
+    requests_mock.get('http://test.iceprod/datasets', json={})
 
     requests_mock.get('http://test.iceprod/datasets/did123', json={
         'dataset_id': 'did123',
@@ -95,7 +101,94 @@ async def test_materialize_run_one_job(requests_mock):
 
     await m.run_once(num=1)
 
-    m.buffer_job.assert_called_once()
+    m.buffer_jobs.assert_called_once()
+    assert m.buffer_jobs.call_args.args[2] == [0]
+
+async def test_materialize_run_fair_share(requests_mock):
+    rc = RestClient('http://test.iceprod')
+    m = Materialize(rc, parallelism=1)
+
+    requests_mock.get('http://test.iceprod/dataset_summaries/status', json={
+        'processing': ['d0', 'd1', 'd2']
+    })
+    requests_mock.get('http://test.iceprod/datasets', json={})
+    requests_mock.get('http://test.iceprod/tasks', json={'tasks': []})
+
+    quotas = {}
+    async def run_dataset(run, dataset_id, *, quota, **kwargs):
+        quotas[dataset_id] = quota
+        # d0 has nothing to buffer, so its share goes to the others
+        return True, 0 if dataset_id == 'd0' else quota
+    m._run_dataset = run_dataset
+
+    ret = await m.run_once(num=100, cycle_jobs=10)
+    assert ret is True
+    assert quotas == {'d0': 3, 'd1': 5, 'd2': 5}
+
+    # the per dataset limit still applies
+    ret = await m.run_once(num=2, cycle_jobs=10)
+    assert quotas == {'d0': 2, 'd1': 2, 'd2': 2}
+
+    assert REGISTRY.get_sample_value('iceprod_materialization_dataset_seconds_count', {'type': 'materialization', 'dataset_id': 'd1'}) == 2
+
+
+async def test_materialize_run_parallel(requests_mock):
+    rc = RestClient('http://test.iceprod')
+    m = Materialize(rc, parallelism=2)
+
+    requests_mock.get('http://test.iceprod/dataset_summaries/status', json={
+        'processing': ['d0', 'd1', 'd2']
+    })
+    requests_mock.get('http://test.iceprod/datasets', json={})
+
+    running = 0
+    max_running = 0
+    runs = []
+    async def run_dataset(run, dataset_id, **kwargs):
+        nonlocal running, max_running
+        runs.append(run)
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(.01)
+        running -= 1
+        return dataset_id != 'd1', 0
+    m._run_dataset = run_dataset
+
+    ret = await m.run_once(num=1)
+    assert ret is False
+    assert max_running == 2
+
+    # overlapping runs do not share state
+    requests_mock.get('http://test.iceprod/tasks', json={'tasks': []})
+    runs.clear()
+    await asyncio.gather(m.run_once(num=1), m.run_once(num=1))
+    assert len({id(run) for run in runs}) == 2
+
+
+async def test_materialize_action_run_all(monkeypatch):
+    monkeypatch.setenv('SERVICE_MATERIALIZE_PARALLELISM', '2')
+    monkeypatch.setenv('SERVICE_MATERIALIZE_CYCLE_JOBS', '50')
+    a = Action(queue=MagicMock(), logger=MagicMock(), api_client=MagicMock())
+    assert a._materialize.parallelism == 2
+    a._materialize.run_once = AsyncMock(return_value=True)
+
+    # a dataset does not use the cycle budget
+    await a.run(MagicMock(payload={'dataset_id': 'd123', 'num': 10}))
+    assert a._materialize.run_once.call_args.kwargs == {'only_dataset': 'd123', 'num': 10}
+
+    await a.run(MagicMock(payload={'dataset_id': None, 'num': 10}))
+    assert a._materialize.run_once.call_args.kwargs == {'cycle_jobs': 50, 'num': 10}
+
+    # only admin and system can run all datasets
+    a._push = AsyncMock(return_value='id')
+    auth = AuthData(username='foo', groups=[], roles=['user'], token={})
+    with pytest.raises(HTTPError) as exc_info:
+        await a.create({}, auth_data=auth)
+    assert exc_info.value.status_code == 403
+
+    auth = AuthData(username='foo', groups=[], roles=['system'], token={})
+    assert await a.create({}, auth_data=auth) == 'id'
+
 
 async def test_materialize_buffer_job_no_depends(requests_mock):
     rc = RestClient('http://test.iceprod')
@@ -109,8 +202,8 @@ async def test_materialize_buffer_job_no_depends(requests_mock):
         'options': {}
     }
     m.get_config = AsyncMock(return_value=config)
-    m.prio = MagicMock()
-    m.prio.get_task_prio = AsyncMock(return_value=1.)
+    run = MaterializeRun(prio=MagicMock())
+    run.prio.get_task_prios = AsyncMock(side_effect=lambda tasks: [1. for _ in tasks])
 
     dataset = {
         'dataset_id': 'did123',
@@ -124,13 +217,58 @@ async def test_materialize_buffer_job_no_depends(requests_mock):
 
     requests_mock.post('http://test.iceprod/jobs', json={'result': 'j123'})
     requests_mock.post('http://test.iceprod/tasks', json={'result': 't123'})
-    requests_mock.patch('http://test.iceprod/tasks/t123', json={})
+    requests_mock.post('http://test.iceprod/task_actions/bulk_priority', json={'results': {'t123': {'code': 200, 'reason': ''}}})
 
-    ret = await m.buffer_job(dataset, 0)
+    ret = await m.buffer_job(run, dataset, 0)
 
     assert ret == 1
 
 
+async def test_materialize_buffer_jobs(requests_mock):
+    rc = RestClient('http://test.iceprod')
+    m = Materialize(rc)
+    config = {
+        'tasks': [
+            {
+                'name': 'foo',
+            },
+            {
+                'name': 'bar',
+                'depends': ['foo'],
+            }
+        ],
+        'options': {}
+    }
+    m.get_config = AsyncMock(return_value=config)
+    run = MaterializeRun(prio=MagicMock())
+    run.prio.get_new_task_prios = AsyncMock(side_effect=lambda dataset_id, tasks: [.5 for _ in tasks])
+
+    dataset = {
+        'dataset_id': 'did123',
+        'dataset': 123,
+        'status': 'processing',
+        'tasks_per_job': 2,
+        'jobs_submitted': 10,
+        'tasks_submitted': 20,
+        'debug': False,
+    }
+
+    requests_mock.post('http://test.iceprod/datasets/did123/job_actions/bulk_materialize', json={'results': [
+        {'job_index': 0, 'job_id': 'j0', 'created': False},
+        {'job_index': 1, 'job_id': 'j1', 'task_ids': ['t2', 't3'], 'created': True},
+    ]})
+
+    ret = await m.buffer_jobs(run, dataset, [0, 1])
+    assert ret == 2
+
+    assert requests_mock.call_count == 1
+    jobs = requests_mock.last_request.json()['jobs']
+    assert [j['job_index'] for j in jobs] == [0, 1]
+    assert jobs[1]['tasks'][0]['depends'] == []
+    assert jobs[1]['tasks'][1]['depends'] == [0]
+    assert jobs[1]['tasks'][1]['priority'] == .5
+
+
 async def test_materialize_buffer_job_incomplete(monkeypatch, requests_mock):
     rc = RestClient('http://test.iceprod')
     m = Materialize(rc)
@@ -151,7 +289,7 @@ async def test_materialize_buffer_job_incomplete(monkeypatch, requests_mock):
     m.get_config = AsyncMock(return_value=config)
     prio_mock = MagicMock()
     monkeypatch.setattr('iceprod.services.actions.materialization.materialize.Priority', prio_mock)
-    prio_mock.return_value.get_task_prio = AsyncMock(return_value=1.)
+    prio_mock.return_value.get_task_prios = AsyncMock(side_effect=lambda tasks: [1. for _ in tasks])
 
     requests_mock.get('http://test.iceprod/datasets/did123', json={
         'dataset_id': 'did123',
@@ -185,7 +323,7 @@ async def test_materialize_buffer_job_incomplete(monkeypatch, requests_mock):
 
     requests_mock.post('http://test.iceprod/jobs', json={'result': 'j2'})
     requests_mock.post('http://test.iceprod/tasks', json={'result': 't0'})
-    requests_mock.patch('http://test.iceprod/tasks/t0', json={})
+    requests_mock.post('http://test.iceprod/task_actions/bulk_priority', json={'results': {'t0': {'code': 200, 'reason': ''}}})
 
     ret = await m.run_once(only_dataset='did123', num=0)
 
@@ -213,7 +351,7 @@ async def test_materialize_buffer_job_no_tasks(monkeypatch, requests_mock):
     m.get_config = AsyncMock(return_value=config)
     prio_mock = MagicMock()
     monkeypatch.setattr('iceprod.services.actions.materialization.materialize.Priority', prio_mock)
-    prio_mock.return_value.get_task_prio = AsyncMock(return_value=1.)
+    prio_mock.return_value.get_task_prios = AsyncMock(side_effect=lambda tasks: [1. for _ in tasks])
 
     requests_mock.get('http://test.iceprod/datasets/did123', json={
         'dataset_id': 'did123',
@@ -241,7 +379,7 @@ async def test_materialize_buffer_job_no_tasks(monkeypatch, requests_mock):
 
     requests_mock.post('http://test.iceprod/jobs', json={'result': 'j2'})
     requests_mock.post('http://test.iceprod/tasks', json={'result': 't0'})
-    requests_mock.patch('http://test.iceprod/tasks/t0', json={})
+    requests_mock.post('http://test.iceprod/task_actions/bulk_priority', json={'results': {'t0': {'code': 200, 'reason': ''}}})
 
     ret = await m.run_once(only_dataset='did123', num=0)
 
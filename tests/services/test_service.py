@@ -1,10 +1,15 @@
+import asyncio
+
 import pytest
+import prometheus_client
 import requests
+from prometheus_client.parser import text_string_to_metric_families
 from unittest.mock import AsyncMock, MagicMock
 
 from iceprod.common.mongo_queue import AsyncMongoQueue
 from iceprod.services.config import get_config
-from iceprod.services.service import main
+from iceprod.services.service import WorkerPool, main
+import iceprod.services.service
 import iceprod.services.actions.submit
 
 async def test_submit(monkeypatch, mongo_url, mongo_clear):
@@ -34,4 +39,155 @@ async def test_submit(monkeypatch, mongo_url, mongo_clear):
     assert action_mock.return_value.run.called
     assert action_mock.return_value.run.call_args.args[0].payload == {'foo': 'bar'}
 
-    await message_queue.close()
\ No newline at end of file
+    await message_queue.close()
+
+async def test_service_metrics(monkeypatch, port, mongo_url, mongo_clear):
+    monkeypatch.setenv('CI_TESTING', '1')
+    monkeypatch.setenv('PROMETHEUS_PORT', str(port))
+    action_mock = MagicMock()
+    action_mock.return_value.run = AsyncMock(return_value=None)
+    monkeypatch.setattr(iceprod.services.actions.submit, 'Action', action_mock)
+
+    servers = []
+    def start_http_server(*args, **kwargs):
+        servers.append(prometheus_client.start_http_server(*args, **kwargs))
+    monkeypatch.setattr(iceprod.services.service, 'start_http_server', start_http_server)
+
+    config = get_config()
+    message_queue = AsyncMongoQueue(
+        url=config.DB_URL,
+        collection_name='services_queue',
+        timeout=config.DB_TIMEOUT,
+        write_concern=config.DB_WRITE_CONCERN
+    )
+    await message_queue.push({'type': 'submit'})
+
+    try:
+        await main()
+        assert action_mock.return_value.run.called
+
+        # the daemon's pop and complete are visible on its metrics port
+        r = requests.get(f'http://localhost:{port}/metrics', timeout=5)
+        r.raise_for_status()
+        samples = {
+            (s.name, frozenset(s.labels.items())): s.value
+            for family in text_string_to_metric_families(r.text) for s in family.samples
+        }
+        assert samples[('iceprod_mongo_queue_wait_count', frozenset({('queue', 'services_queue')}))] >= 1
+        assert samples[('iceprod_mongo_queue_processing_count', frozenset({('queue', 'services_queue'), ('outcome', 'complete')}))] >= 1
+    finally:
+        for server, thread in servers:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        await message_queue.close()
+
+
+async def test_worker_pool(mongo_url, mongo_clear):
+    config = get_config()
+    message_queue = AsyncMongoQueue(
+        url=config.DB_URL,
+        collection_name='services_queue',
+        timeout=config.DB_TIMEOUT,
+        write_concern=config.DB_WRITE_CONCERN
+    )
+
+    running = {'slow': 0, 'fast': 0}
+    peak = {'slow': 0, 'fast': 0}
+
+    class Action:
+        def __init__(self, type_, delay):
+            self.type_ = type_
+            self.delay = delay
+
+        async def run(self, message):
+            running[self.type_] += 1
+            peak[self.type_] = max(peak[self.type_], running[self.type_])
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                running[self.type_] -= 1
+
+    ids = []
+    for _ in range(3):
+        ids.append(await message_queue.push({'type': 'slow'}))
+        ids.append(await message_queue.push({'type': 'fast'}))
+
+    pool = WorkerPool(
+        message_queue=message_queue,
+        actions={'slow': Action('slow', .1), 'fast': Action('fast', .01)},
+        concurrency=3,
+        action_limits={'slow': 1},
+    )
+    for _ in range(20):
+        await pool.fill()
+        if not pool.running:
+            break
+        await pool.wait(1)
+
+    assert peak == {'slow': 1, 'fast': 2}
+    for id_ in ids:
+        assert await message_queue.get_status(id_) == 'complete'
+
+    await message_queue.close()
+
+
+async def test_worker_pool_drain(mongo_url, mongo_clear):
+    config = get_config()
+    message_queue = AsyncMongoQueue(
+        url=config.DB_URL,
+        collection_name='services_queue',
+        timeout=config.DB_TIMEOUT,
+        write_concern=config.DB_WRITE_CONCERN
+    )
+
+    async def run(message):
+        await asyncio.sleep(10)
+    action = MagicMock()
+    action.run = run
+
+    id_ = await message_queue.push({'type': 'submit'})
+
+    pool = WorkerPool(message_queue=message_queue, actions={'submit': action})
+    await pool.fill()
+    assert pool.running == 1
+
+    pool.stop()
+    assert pool.stopping
+    await pool.drain(.1)
+    assert pool.running == 0
+
+    assert await message_queue.get_status(id_) == 'queued'
+
+    await message_queue.close()
+
+
+async def test_worker_pool_fill_batch():
+    message_queue = MagicMock()
+    messages = [MagicMock(uuid=str(i), payload={'type': 'slow' if i < 2 else 'fast'}) for i in range(4)]
+    batches = [messages[:1], messages[2:4], []]
+    message_queue.pop_many = AsyncMock(side_effect=batches)
+
+    async def run(message):
+        await asyncio.sleep(1)
+    action = MagicMock()
+    action.run = run
+
+    pool = WorkerPool(
+        message_queue=message_queue,
+        actions={'slow': action, 'fast': action},
+        concurrency=4,
+        action_limits={'slow': 1},
+    )
+    started = await pool.fill()
+    assert started == 3
+    assert pool.running == 3
+
+    # the first batch is limited by 'slow', the second excludes it
+    assert message_queue.pop_many.call_args_list[0].args[0] == 1
+    assert message_queue.pop_many.call_args_list[1].args[0] == 3
+    assert message_queue.pop_many.call_args_list[1].kwargs['query'] == {'payload.type': {'$nin': ['slow']}}
+
+    pool.stop()
+    message_queue.release = AsyncMock()
+    await pool.drain(0)